@@ -0,0 +1,245 @@
+# admission.py - Admission control for scans based on projected decode memory
+#
+# The cost of a scan is estimated from the image header alone (dimensions and mode,
+# no pixel decode) and reserved from a shared memory budget before OCR starts.
+# Scans queue while the budget is exhausted, oversized JPEGs get their decode
+# capped (draft mode reduces at decode time), and anything that still cannot fit is rejected with a retry hint
+# instead of taking the worker down.
+#
+# The budget lives in shared arrays created at import. With preload_app=True
+# gunicorn forks workers after this import, so the budget is shared by every worker
+# on the host; without preload it is per worker. Reservations are booked against
+# the pid of the worker holding them, so a worker that is killed or crashes mid-scan
+# can't leak budget: the master reclaims its share in child_exit, and a scan that
+# finds the budget short reclaims the shares of dead pids itself. The arrays are
+# guarded by an flock rather than a multiprocessing lock - the kernel drops it with
+# the process, so a worker killed inside the critical section can't block the rest.
+#
+# The full projected cost is only held while the pixels are decoded; once they are,
+# the reservation shrinks to what the decoded image keeps resident for the OCR wait.
+
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from PIL import Image
+
+import image_asset
+
+ADMISSION_BUDGET_MB = float(os.getenv('ADMISSION_BUDGET_MB', '0')) or None  # set by configure()
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '20'))  # seconds to wait for budget
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '15'))  # hint sent back on rejection
+ADMISSION_POLL_INTERVAL = 0.05   # seconds between budget checks while queued
+
+FIXED_OVERHEAD_MB = 16    # decoder buffers, OCR upload, response parsing
+RESIZE_WORKSPACE = 0.5    # LANCZOS keeps an intermediate of up to half the source size
+
+# Pillow stores every multi-band image at 4 bytes per pixel
+_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16B': 2, 'I;16L': 2, 'LA': 4, 'PA': 4,
+                    'RGB': 4, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4, 'YCbCr': 4, 'LAB': 4, 'HSV': 4,
+                    'I': 4, 'F': 4}
+
+MAX_HOLDERS = 64   # worker processes holding reservations at once
+
+# Slot i: pid of a worker and the MB it has reserved - guarded by _locked()
+_holder_pids = multiprocessing.Array('i', MAX_HOLDERS, lock=False)
+_holder_mb = multiprocessing.Array('d', MAX_HOLDERS, lock=False)
+
+# Named after the importing process, so preloaded workers share it with their master
+_LOCK_PATH = os.path.join(tempfile.gettempdir(), f"foodfixr-admission-{os.getpid()}.lock")
+_thread_lock = threading.Lock()   # flock doesn't exclude threads sharing one descriptor
+_lock_fd = None
+_lock_pid = None
+
+class AdmissionRejected(Exception):
+    """Raised when a scan cannot be admitted - retry_after is None if retrying won't help"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def configure(budget_mb=None, queue_timeout=None):
+    """Set the shared memory budget - env ADMISSION_BUDGET_MB always wins"""
+    global ADMISSION_BUDGET_MB, ADMISSION_QUEUE_TIMEOUT
+
+    if budget_mb is not None and not os.getenv('ADMISSION_BUDGET_MB'):
+        ADMISSION_BUDGET_MB = float(budget_mb)
+    if queue_timeout is not None:
+        ADMISSION_QUEUE_TIMEOUT = float(queue_timeout)
+
+def projected_cost_mb(width, height, mode):
+    """Peak memory for decoding, RGB conversion and resizing an image of this shape"""
+    pixels = width * height
+    decoded = pixels * _BYTES_PER_PIXEL.get(mode, 4)
+    converted = pixels * 4 if mode not in ('RGB', 'L') else 0
+    workspace = pixels * 4 * RESIZE_WORKSPACE
+    return (decoded + converted + workspace) / 1024 / 1024 + FIXED_OVERHEAD_MB
+
+def estimate_decode_mb(asset):
+    """Project the decode cost of an ImageAsset from its header alone - no pixel decode"""
+    try:
+        width, height = asset.decode_size
+        return projected_cost_mb(width, height, asset.mode)
+    except Image.DecompressionBombError as e:
+        raise AdmissionRejected(f"Image has too many pixels to process safely ({e})")
+    except Exception as e:
+        # Not a readable image header - the scan itself will report the failure
+        print(f"DEBUG: Admission could not read image header: {e}")
+        return FIXED_OVERHEAD_MB
+
+@contextmanager
+def _locked():
+    global _lock_fd, _lock_pid
+    with _thread_lock:
+        if _lock_pid != os.getpid():
+            # An inherited descriptor shares its lock with the master - open our own
+            _lock_fd = os.open(_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+            _lock_pid = os.getpid()
+        fcntl.flock(_lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_lock_fd, fcntl.LOCK_UN)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _book(delta_mb):
+    """Add delta_mb to this process's slot - call under _locked()"""
+    pid = os.getpid()
+    free = None
+    for slot in range(MAX_HOLDERS):
+        if _holder_pids[slot] == pid:
+            _holder_mb[slot] = max(0.0, _holder_mb[slot] + delta_mb)
+            return
+        if free is None and _holder_pids[slot] == 0:
+            free = slot
+    if free is None:
+        raise AdmissionRejected("Scanner is busy (no admission slot free)", retry_after=ADMISSION_RETRY_AFTER)
+    _holder_pids[free] = pid
+    _holder_mb[free] = max(0.0, delta_mb)
+
+def _total_mb():
+    return sum(_holder_mb[slot] for slot in range(MAX_HOLDERS) if _holder_pids[slot])
+
+def _reclaim_where(dead):
+    """Free the slots whose pid dead(pid) selects - call under _locked(); returns MB freed"""
+    freed = 0.0
+    for slot in range(MAX_HOLDERS):
+        pid = _holder_pids[slot]
+        if pid and dead(pid):
+            if _holder_mb[slot]:
+                print(f"WARNING: Admission reclaimed {_holder_mb[slot]:.0f} MB held by dead worker {pid}")
+            freed += _holder_mb[slot]
+            _holder_pids[slot] = 0
+            _holder_mb[slot] = 0.0
+    return freed
+
+def reclaim(pid):
+    """Give back everything a worker had reserved - gunicorn child_exit calls this"""
+    with _locked():
+        return _reclaim_where(lambda holder: holder == pid)
+
+def reserved_mb():
+    """Memory currently reserved by admitted scans"""
+    with _locked():
+        return _total_mb()
+
+def _acquire(cost_mb, timeout):
+    deadline = time.monotonic() + timeout
+    waited = False
+
+    while True:
+        with _locked():
+            reserved = _total_mb()
+            if reserved + cost_mb > ADMISSION_BUDGET_MB:
+                reserved -= _reclaim_where(lambda pid: pid != os.getpid() and not _pid_alive(pid))
+            if reserved + cost_mb <= ADMISSION_BUDGET_MB:
+                _book(cost_mb)
+                return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise AdmissionRejected(
+                f"Scanner is busy ({reserved:.0f}/{ADMISSION_BUDGET_MB:.0f} MB reserved)",
+                retry_after=ADMISSION_RETRY_AFTER)
+        if not waited:
+            print(f"DEBUG: Admission queued - need {cost_mb:.0f} MB, "
+                  f"{reserved:.0f}/{ADMISSION_BUDGET_MB:.0f} MB reserved")
+            waited = True
+        time.sleep(min(ADMISSION_POLL_INTERVAL, remaining))
+
+def _release(cost_mb):
+    with _locked():
+        _book(-cost_mb)
+
+def resident_mb(img):
+    """What decoded pixels keep in memory after the decode workspace is gone"""
+    return img.size[0] * img.size[1] * _BYTES_PER_PIXEL.get(img.mode, 4) / 1024 / 1024 + FIXED_OVERHEAD_MB
+
+def _downscale_dim(asset):
+    """Decode dimension of the mildest JPEG draft reduction that fits the budget, or None"""
+    if asset.format != 'JPEG':
+        return None
+
+    # Draft mode only reduces by 1/2, 1/4 or 1/8 - a dimension in between decodes at
+    # the next size up, so try the reductions themselves and cost what each decodes.
+    # The mildest one within half the budget leaves room for other scans.
+    target_mb = max(ADMISSION_BUDGET_MB / 2, FIXED_OVERHEAD_MB + 1)
+    fits = None
+    for factor in (2, 4, 8):
+        max_dim = max(1, max(asset.size) // factor)
+        reduced_cost = projected_cost_mb(*image_asset.draft_size(asset.size, max_dim), 'RGB')
+        if reduced_cost <= target_mb:
+            return max_dim
+        if fits is None and reduced_cost <= ADMISSION_BUDGET_MB:
+            fits = max_dim
+    return fits
+
+@contextmanager
+def reserve(asset, timeout=None):
+    """Reserve the projected decode memory for a scan of an ImageAsset"""
+    if ADMISSION_BUDGET_MB is None:
+        yield asset
+        return
+
+    timeout = ADMISSION_QUEUE_TIMEOUT if timeout is None else timeout
+    cost_mb = estimate_decode_mb(asset)
+
+    if cost_mb > ADMISSION_BUDGET_MB:
+        max_dim = _downscale_dim(asset)
+        if max_dim is None:
+            width, height = asset.size
+            raise AdmissionRejected(
+                f"Image is too large to process ({width}x{height}, ~{cost_mb:.0f} MB). "
+                f"Please upload a smaller photo.")
+        asset.limit_decode(max_dim)
+        cost_mb = estimate_decode_mb(asset)
+        print(f"DEBUG: Admission capped decode of oversized upload at {max_dim}px")
+
+    print(f"DEBUG: Admission request ~{cost_mb:.0f} MB of {ADMISSION_BUDGET_MB:.0f} MB budget")
+    _acquire(cost_mb, timeout)
+    held = [cost_mb]
+
+    def decoded(img):
+        # The conversion and resize workspace is gone - keep only what stays resident
+        resident = resident_mb(img)
+        if resident < held[0]:
+            _release(held[0] - resident)
+            held[0] = resident
+
+    asset.after_decode(decoded)
+    try:
+        yield asset
+    finally:
+        _release(held[0])
@@ -1,35 +1,36 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file, Response
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.exceptions import RequestTimeout
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response
 import os
-import tempfile
 from werkzeug.utils import secure_filename
-from ingredient_scanner import scan_image_for_ingredients, before_scan_cleanup, safe_ocr_with_fallback_professional
-import json
+from ingredient_scanner import scan_image_for_ingredients, OCR_DECODE_DIM
+from image_asset import ImageAsset, RENDITIONS, render_file
+from history_export import EXPORT_FORMATS
+import memory_governor
+import admission
+import db_pool
+import user_cache
+import history_writer
+import history_deletion
+import retention
+import blob_store
+import image_response
+import request_policy
+import request_deadline
+import password_hasher
+import page_cache
+import scratch
+from repositories import UserRepo, ScanHistoryRepo, HistoryDeletionRepo, RetentionRepo, connect_database, rating_type
+import migrations
+import resource_profile
 from datetime import datetime, timedelta
-import uuid
 import stripe
-from PIL import Image
 import time
-import sqlite3
 from functools import wraps
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import gc  # Add for memory management
-import shutil
-from pathlib import Path
-import signal
-import sys
-import psutil
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')
 
 # Professional tier optimizations
 app.config.update(
-    # Can handle larger files now
-    MAX_CONTENT_LENGTH=15 * 1024 * 1024,  # 15MB (was 5MB)
-    
     # Less aggressive session timeout
     PERMANENT_SESSION_LIFETIME=timedelta(hours=4),  # 4 hours (was 1 hour)
     
@@ -37,17 +38,20 @@ app.config.update(
     REQUEST_TIMEOUT=180,  # 3 minutes (was 90 seconds)
 )
 
-# Detect if running on professional tier
-PROFESSIONAL_TIER = os.getenv('RENDER_TIER') == 'professional' or os.getenv('WEB_CONCURRENCY', '1') != '1'
+# Tier-dependent limits come from the resource profile measured at startup
+PROFILE = resource_profile.PROFILE
+app.config['MAX_CONTENT_LENGTH'] = PROFILE.max_content_length_mb * 1024 * 1024
+MAX_FILE_SIZE_MB = PROFILE.max_upload_mb
+
+# Trial limits - also enforced in SQL when a scan is recorded
+FREE_SCAN_LIMIT = 10
+TRIAL_HOURS = 48
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '20'))   # cards per /history page and scroll fetch
 
-if PROFESSIONAL_TIER:
-    print("INFO: Professional tier - enabling large file support")
-    app.config['MAX_CONTENT_LENGTH'] = 15 * 1024 * 1024  # 15MB
-    MAX_FILE_SIZE_MB = 12  # 12MB processing limit
-else:
-    print("INFO: Free tier - using conservative file limits")
-    app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024   # 5MB
-    MAX_FILE_SIZE_MB = 3   # 3MB processing limit
+# Projected decode memory that concurrent scans may reserve (shared by preloaded workers)
+admission.configure(budget_mb=PROFILE.admission_budget_mb)
+db_pool.configure(size=PROFILE.db_pool_size)
 
 # Stripe Configuration
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
@@ -55,169 +59,43 @@ STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 DOMAIN = os.getenv('DOMAIN', 'https://foodfixr-scanner-1.onrender.com')
 
 # Configuration - Reduced limits for memory-constrained environments
-UPLOAD_FOLDER = tempfile.gettempdir()
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'webp'}
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.getenv('STATIC_MAX_AGE', '3600'))   # logos and icons under /static
 app.permanent_session_lifetime = timedelta(days=30)
 
 UPLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
-# Request timeout tracking
-@app.before_request
-def before_request_timeout():
-    """Track request start time and perform memory management"""
-    request.start_time = time.time()
-    
-    try:
-        # Force garbage collection
-        gc.collect()
-        
-        # Set conservative PIL limits
-        Image.MAX_IMAGE_PIXELS = 30000000  # More conservative limit
-        
-        # Check memory usage
-        memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
-        if memory_mb > 250:  # High memory threshold
-            print(f"WARNING: High memory usage before request: {memory_mb:.1f}MB")
-            gc.collect()
-            time.sleep(0.1)  # Brief pause for cleanup
-        
-        print(f"DEBUG: Pre-request cleanup completed, memory: {memory_mb:.1f}MB")
-    except Exception as e:
-        print(f"DEBUG: Pre-request cleanup error: {e}")
+# Every request is timed; only image-decoding endpoints do memory work (request_policy.py)
+request_policy.init_app(app)
 
-@app.after_request
-def after_request_cleanup(response):
-    """Comprehensive cleanup after each request with timeout monitoring"""
-    try:
-        # Check processing time and log warnings
-        if hasattr(request, 'start_time'):
-            processing_time = time.time() - request.start_time
-            if processing_time > 60:  # Log long requests
-                print(f"WARNING: Long request took {processing_time:.1f}s for {request.endpoint}")
-            elif processing_time > 30:
-                print(f"INFO: Moderate request took {processing_time:.1f}s for {request.endpoint}")
-        
-        # Force aggressive garbage collection
-        for _ in range(2):
-            gc.collect()
-        
-        # Add headers to prevent caching of errors
-        if response.status_code >= 500:
-            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-            response.headers['Pragma'] = 'no-cache'
-            response.headers['Expires'] = '0'
-        
-        # Log final memory usage
-        try:
-            memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
-            if memory_mb > 300:
-                print(f"WARNING: High memory after request: {memory_mb:.1f}MB")
-        except:
-            pass
-            
-    except Exception as e:
-        print(f"DEBUG: After-request cleanup error: {e}")
-    
-    return response
+# Templates compiled before the workers fork; per-user pages served from cached shells
+page_cache.init_app(app)
 
 # Database connection function
 def get_db_connection():
-    """Get database connection - PostgreSQL for production, SQLite for local"""
-    database_url = os.getenv('DATABASE_URL')
-    if database_url:
-        return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
-    else:
-        # Fallback to SQLite for local development
-        import sqlite3
-        conn = sqlite3.connect('foodfixr.db')
-        conn.row_factory = sqlite3.Row
-        return conn
+    """Check out a pooled database connection - conn.close() returns it to the pool"""
+    return db_pool.get_connection(connect_database)
+
+user_repo = UserRepo(get_db_connection)
+history_repo = ScanHistoryRepo(get_db_connection)
+history_writer.configure(history_repo.add_many)
+history_deletion.configure(HistoryDeletionRepo(get_db_connection), UPLOADS_DIR)
+retention.configure(RetentionRepo(get_db_connection), UPLOADS_DIR)
 
 # Database initialization
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            email VARCHAR(255) UNIQUE NOT NULL,
-            name VARCHAR(255) NOT NULL,
-            password_hash VARCHAR(255) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_premium BOOLEAN DEFAULT FALSE,
-            stripe_customer_id VARCHAR(255),
-            subscription_status VARCHAR(50) DEFAULT 'trial',
-            subscription_start_date TIMESTAMP,
-            next_billing_date TIMESTAMP,
-            trial_start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            trial_end_date TIMESTAMP,
-            scans_used INTEGER DEFAULT 0,
-            total_scans_ever INTEGER DEFAULT 0,
-            last_login TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS scan_history (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            scan_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            result_rating TEXT,
-            ingredients_found TEXT,
-            image_url TEXT,
-            scan_id VARCHAR(255),
-            extracted_text TEXT,
-            text_length INTEGER DEFAULT 0,
-            confidence VARCHAR(20) DEFAULT 'medium',
-            text_quality VARCHAR(20) DEFAULT 'unknown',
-            has_safety_labels BOOLEAN DEFAULT FALSE
-        )
-    ''')
-    
-    # Add missing columns to existing table (PostgreSQL specific)
-    try:
-        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS extracted_text TEXT")
-        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS text_length INTEGER DEFAULT 0")
-        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS confidence VARCHAR(20) DEFAULT 'medium'")
-        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS text_quality VARCHAR(20) DEFAULT 'unknown'")
-        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS has_safety_labels BOOLEAN DEFAULT FALSE")
-    except Exception as e:
-        print(f"Column addition note: {e}")
-    
-    conn.commit()
-    conn.close()
-    print("Database initialized successfully with all required columns")
+    """Bring the schema up to date - just a version check unless a migration is pending"""
+    with get_db_connection() as conn:
+        applied = migrations.migrate(conn)
+        print(f"Database schema at version {migrations.current_version(conn)} ({len(applied)} migrations applied)")
 
 init_db()
+history_writer.replay()   # rows a crashed worker had queued but not written
 
-# Memory monitoring and worker restart handling
-def setup_memory_monitoring():
-    """Setup memory monitoring and graceful shutdown"""
-    def memory_check():
-        try:
-            memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
-            if memory_mb > 400:  # Critical threshold
-                print(f"CRITICAL: Memory usage: {memory_mb:.1f}MB - forcing cleanup")
-                gc.collect()
-                return False
-            return True
-        except Exception as e:
-            print(f"Memory check error: {e}")
-            return True
-    
-    def signal_handler(signum, frame):
-        print(f"Received signal {signum}, cleaning up...")
-        gc.collect()
-        sys.exit(0)
-    
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
-
-setup_memory_monitoring()
+# preload_app: don't hand the master's connections down to forked workers
+db_pool.close_all()
 
 # Helper functions
 def login_required(f):
@@ -229,12 +107,7 @@ def login_required(f):
     return decorated_function
 
 def get_user_data(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE id = %s', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return dict(user) if user else None
+    return user_repo.get(user_id)
 
 def safe_datetime_parse(date_string):
     if not date_string:
@@ -259,7 +132,7 @@ def safe_datetime_parse(date_string):
 
 def calculate_trial_time_left(trial_start_date):
     trial_start = safe_datetime_parse(trial_start_date)
-    trial_end = trial_start + timedelta(hours=48)
+    trial_end = trial_start + timedelta(hours=TRIAL_HOURS)
     now = datetime.now()
     
     if now >= trial_end:
@@ -274,32 +147,28 @@ def calculate_trial_time_left(trial_start_date):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def can_scan():
+def can_scan(user_data=None):
     if 'user_id' not in session:
         return False
         
-    user_data = get_user_data(session['user_id'])
+    if user_data is None:
+        user_data = get_user_data(session['user_id'])
     if not user_data:
         return False
         
     if user_data['is_premium']:
         return True
     
-    if user_data['scans_used'] >= 10:
+    if user_data['scans_used'] >= FREE_SCAN_LIMIT:
         return False
         
     trial_start = safe_datetime_parse(user_data['trial_start_date'])
-    trial_end = trial_start + timedelta(hours=48)
+    trial_end = trial_start + timedelta(hours=TRIAL_HOURS)
     if datetime.now() > trial_end:
         return False
         
     return True
 
-def format_datetime_for_db(dt=None):
-    if dt is None:
-        dt = datetime.now()
-    return dt.strftime('%Y-%m-%d %H:%M:%S')
-
 def cleanup_uploaded_file(filepath):
     """Safely clean up uploaded files"""
     try:
@@ -309,54 +178,76 @@ def cleanup_uploaded_file(filepath):
     except Exception as e:
         print(f"DEBUG: Error cleaning up file {filepath}: {e}")
 
-def save_scan_image(temp_filepath, user_id):
-    """Save uploaded image permanently for history viewing"""
+def ensure_rendition(path):
+    """Path of a requested rendition, rendered from its image on first request - None if it can't be"""
+    if os.path.exists(path):
+        return path
+    
+    # An original that retention.py has archived - its archive rendition stands in
+    archive_path = blob_store.rendition_path(path, blob_store.ARCHIVE)
+    if os.path.exists(archive_path):
+        return archive_path
+    
+    stem, extension = os.path.splitext(os.path.basename(path))
+    image_stem, _, name = stem.rpartition('_')
+    if extension != '.webp' or name not in RENDITIONS:
+        return None
+    
+    directory = os.path.dirname(path)
+    sources = [entry for entry in os.listdir(directory)
+               if os.path.splitext(entry)[0] in (image_stem, f"{image_stem}_{blob_store.ARCHIVE}")] \
+        if os.path.isdir(directory) else []
+    if not sources:
+        return None
+    sources.sort(key=lambda entry: os.path.splitext(entry)[0] != image_stem)   # the original before its archive
+    
+    try:
+        # Scans saved before renditions existed - rendered once, then served from disk
+        blob_store.write_atomic(path, lambda temp_path: render_file(os.path.join(directory, sources[0]), name, temp_path))
+        print(f"DEBUG: Rendered {name} for {sources[0]}")
+        return path
+    except Exception as e:
+        print(f"DEBUG: Rendition failed for {sources[0]}: {e}")
+        return None
+
+def save_scan_image(asset, user_id):
+    """Store the uploaded image in the blob store for history viewing, plus its renditions from the same decode
+
+    Identical photos are stored once - a rescan only references the existing blob.
+    """
     try:
-        if not temp_filepath or not os.path.exists(temp_filepath):
+        if not asset or not os.path.exists(asset.path):
             return None
-            
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        original_extension = os.path.splitext(temp_filepath)[1].lower()
-        new_filename = f"scan_{user_id}_{timestamp}_{uuid.uuid4().hex[:8]}{original_extension}"
-        
-        user_dir = os.path.join(UPLOADS_DIR, str(user_id))
-        os.makedirs(user_dir, exist_ok=True)
         
-        permanent_path = os.path.join(user_dir, new_filename)
-        shutil.copy2(temp_filepath, permanent_path)
+        original_extension = os.path.splitext(asset.path)[1].lower()
+        image_url, written = blob_store.put(asset.path, asset.content_hash, original_extension)
+        print(f"DEBUG: Saved image for user {user_id} to: {image_url} ({written} bytes written)")
         
-        relative_path = f"static/uploads/{user_id}/{new_filename}"
-        print(f"DEBUG: Saved image to: {relative_path}")
+        image_path = blob_store.path_for_url(image_url)
+        for name in RENDITIONS:
+            rendition_path = blob_store.rendition_path(image_path, name)
+            if os.path.exists(rendition_path):
+                continue
+            try:
+                blob_store.write_atomic(rendition_path, lambda temp_path: asset.save_rendition(name, temp_path))
+            except Exception as rendition_error:
+                # Rendered from the stored image on first request instead
+                print(f"DEBUG: {name} rendition failed: {rendition_error}")
         
-        return relative_path
+        return image_url
         
     except Exception as e:
         print(f"DEBUG: Error saving scan image: {e}")
         return None
 
-# CRITICAL: Add request timeout wrapper
+# Request time limit - a per-thread deadline (request_deadline.py), safe in threaded workers
 def with_timeout(seconds):
     """Decorator to add timeout protection to routes"""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            def timeout_handler(signum, frame):
-                raise TimeoutError(f"Request timed out after {seconds} seconds")
-            
-            # Set the alarm
-            old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(seconds)
-            
-            try:
-                result = func(*args, **kwargs)
-                return result
-            except TimeoutError:
-                gc.collect()  # Force cleanup on timeout
-                raise
-            finally:
-                # Always restore the alarm
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, old_handler)
+            with request_deadline.limit(seconds):
+                return func(*args, **kwargs)
         
         return wrapper
     return decorator
@@ -382,42 +273,13 @@ def register():
             flash('Password must be at least 6 characters long', 'error')
             return render_template('register.html')
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id FROM users WHERE email = %s', (email,))
-        if cursor.fetchone():
+        if user_repo.email_exists(email):
             flash('An account with this email already exists. Please login instead.', 'error')
-            conn.close()
             return render_template('register.html')
         
-        password_hash = generate_password_hash(password)
-        
         try:
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('''
-                    INSERT INTO users (name, email, password_hash, trial_start_date, trial_end_date, last_login)
-                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + INTERVAL '48 hours', CURRENT_TIMESTAMP)
-                    RETURNING id
-                ''', (name, email, password_hash))
-                
-                user_result = cursor.fetchone()
-                user_id = user_result['id']
-            else:
-                now = datetime.now()
-                trial_start = format_datetime_for_db(now)
-                trial_end = format_datetime_for_db(now + timedelta(hours=48))
-                
-                cursor.execute('''
-                    INSERT INTO users (name, email, password_hash, trial_start_date, trial_end_date, last_login)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (name, email, password_hash, trial_start, trial_end, format_datetime_for_db(now)))
-                
-                user_id = cursor.lastrowid
-            
-            conn.commit()
-            conn.close()
+            password_hash = password_hasher.hash_password(password)
+            user_id = user_repo.create(name, email, password_hash)
             
             session.clear()
             session.permanent = True
@@ -433,7 +295,6 @@ def register():
         except Exception as e:
             print(f"Registration error: {e}")
             flash('Registration failed. Please try again.', 'error')
-            conn.close()
             return render_template('register.html')
     
     return render_template('register.html')
@@ -452,30 +313,23 @@ def login():
             flash('Please enter both email and password', 'error')
             return render_template('login.html')
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            cursor.execute('SELECT * FROM users WHERE email = %s', (email,))
-        else:
-            cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        
-        user = cursor.fetchone()
+        user = user_repo.find_by_email(email)
         
         if user:
             print(f"DEBUG: User found: {user['name']}")
-            if check_password_hash(user['password_hash'], password):
+            try:
+                password_ok, new_hash = password_hasher.verify_password(user['password_hash'], password)
+            except password_hasher.HasherBusy:
+                flash('Too many sign-ins right now. Please try again in a moment.', 'error')
+                return render_template('login.html'), 503
+            
+            if password_ok:
                 print("DEBUG: Password correct, logging in...")
                 
-                if database_url:
-                    cursor.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s', (user['id'],))
-                else:
-                    cursor.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                                 (format_datetime_for_db(), user['id']))
-                
-                conn.commit()
-                conn.close()
+                if new_hash:
+                    # Stored with older hashing parameters - upgrade while we have the password
+                    user_repo.set_password(user['email'], new_hash)
+                user_repo.touch_login(user['id'])
                 
                 session.clear()
                 session.permanent = True
@@ -491,12 +345,9 @@ def login():
             else:
                 print("DEBUG: Invalid password")
                 flash('Invalid email or password', 'error')
-                conn.close()
         else:
             print("DEBUG: User not found")
             flash('Invalid email or password', 'error')
-            if 'conn' in locals():
-                conn.close()
     
     print("DEBUG: Rendering login.html template")
     return render_template('login.html')
@@ -521,33 +372,13 @@ def reset_password():
             return render_template('reset_password.html')
         
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('SELECT id, name FROM users WHERE email = %s', (email,))
-            else:
-                cursor.execute('SELECT id, name FROM users WHERE email = ?', (email,))
-            
-            user = cursor.fetchone()
+            user = user_repo.find_by_email(email)
             
             if not user:
                 flash('No account found with this email address', 'error')
-                conn.close()
                 return render_template('reset_password.html')
             
-            password_hash = generate_password_hash(new_password)
-            
-            if database_url:
-                cursor.execute('UPDATE users SET password_hash = %s WHERE email = %s', 
-                             (password_hash, email))
-            else:
-                cursor.execute('UPDATE users SET password_hash = ? WHERE email = ?', 
-                             (password_hash, email))
-            
-            conn.commit()
-            conn.close()
+            user_repo.set_password(email, password_hasher.hash_password(new_password))
             
             flash(f'Password successfully reset for {user["name"]}! You can now login with your new password.', 'success')
             return redirect(url_for('login'))
@@ -578,38 +409,30 @@ def index():
     session['scans_used'] = user_data['scans_used']
     session['is_premium'] = bool(user_data['is_premium'])
     
-    return render_template('scanner.html', 
-                         trial_expired=trial_expired,
-                         trial_time_left=trial_time_left,
-                         user_name=user_data['name'],
-                         stripe_publishable_key=STRIPE_PUBLISHABLE_KEY)
+    return page_cache.render('scanner.html',
+                             state={'trial_expired': trial_expired,
+                                    'stripe_publishable_key': STRIPE_PUBLISHABLE_KEY},
+                             slots={'trial_time_left': trial_time_left,
+                                    'user_name': user_data['name']})
 
 @app.route('/', methods=['POST'])
 @login_required
 @with_timeout(90)  # 90 second timeout protection
+@request_policy.memory_managed
+@scratch.scoped
 def scan():
     """Enhanced scan route with comprehensive 502 error prevention"""
     print("DEBUG: Starting scan with comprehensive error prevention")
     
-    # CRITICAL: Memory cleanup before processing
-    before_scan_cleanup()
-    
-    # Check initial memory state
-    initial_memory = psutil.Process().memory_info().rss / 1024 / 1024
+    # memory_managed has checked the budget - the governor collects only if over it, never sleeps
+    initial_memory = memory_governor.current_rss_mb()
     print(f"DEBUG: Initial memory: {initial_memory:.1f}MB")
     
-    if initial_memory > 250:  # High initial memory
-        print("DEBUG: High initial memory, forcing aggressive cleanup")
-        gc.collect()
-        time.sleep(0.5)
-        initial_memory = psutil.Process().memory_info().rss / 1024 / 1024
-        print(f"DEBUG: Memory after cleanup: {initial_memory:.1f}MB")
-    
     user_data = get_user_data(session['user_id'])
     if not user_data:
         return redirect(url_for('logout'))
     
-    if not can_scan():
+    if not can_scan(user_data):
         flash('You have used all your free scans. Please upgrade to continue.', 'error')
         return redirect(url_for('upgrade'))
     
@@ -631,12 +454,11 @@ def scan():
                              error="Invalid file. Please upload an image.")
     
     filepath = None
+    asset = None
     try:
         # Save uploaded file with memory-conscious handling
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
+        # In the request's scratch workspace - unique, and removed when the scan ends
+        filepath = scratch.path(f"upload_{secure_filename(file.filename)}")
         
         print(f"DEBUG: Saving uploaded file to: {filepath}")
         file.save(filepath)
@@ -645,8 +467,8 @@ def scan():
         file_size_mb = os.path.getsize(filepath) / (1024 * 1024)
         print(f"DEBUG: Uploaded file size: {file_size_mb:.2f} MB")
         
-        # Dynamic file size limits based on current memory
-        max_size_mb = 10 if initial_memory > 200 else 12 # Very restrictive
+        # Profile file size limit - admission control covers the memory side
+        max_size_mb = MAX_FILE_SIZE_MB
         
         if file_size_mb > max_size_mb:
             cleanup_uploaded_file(filepath)
@@ -656,15 +478,19 @@ def scan():
                                  user_name=user_data['name'],
                                  error=f"Image too large ({file_size_mb:.1f}MB). Please upload a smaller image (max {max_size_mb}MB).")
         
-        # Save image permanently for history (before processing to avoid memory issues)
-        saved_image_path = save_scan_image(filepath, session['user_id'])
+        # One asset for the whole scan - admission, OCR, fallback and renditions share a single decode
+        asset = ImageAsset(filepath, decode_dim=OCR_DECODE_DIM)
         
         # Process the image with enhanced memory management
         print("DEBUG: Starting image processing with timeout protection...")
         
         try:
-            # Use the safe OCR function with circuit breaker
-            result = scan_image_for_ingredients(filepath)
+            # Reserve the projected decode memory, then use the safe OCR function with circuit breaker
+            with admission.reserve(asset):
+                result = scan_image_for_ingredients(asset)
+                
+                # Save image permanently for history (successful scans only) - the renditions reuse the pixels OCR decoded
+                saved_image_path = None if result.get('error') else save_scan_image(asset, session['user_id'])
             
             # Check if scan failed due to memory/timeout issues
             if result.get('error'):
@@ -679,9 +505,21 @@ def scan():
                                      user_name=user_data['name'],
                                      error=error_msg)
             
+        except admission.AdmissionRejected as e:
+            cleanup_uploaded_file(filepath)
+            print(f"DEBUG: Scan not admitted: {e}")
+            page = render_template('scanner.html',
+                                 trial_expired=trial_expired,
+                                 trial_time_left=trial_time_left,
+                                 user_name=user_data['name'],
+                                 error=f"{e}. Please try again in {e.retry_after} seconds." if e.retry_after else str(e))
+            if e.retry_after:
+                return page, 503, {'Retry-After': str(e.retry_after)}
+            return page, 413
+        
         except TimeoutError:
             cleanup_uploaded_file(filepath)
-            gc.collect()
+            memory_governor.check("scan error")
             return render_template('scanner.html',
                                  trial_expired=trial_expired,
                                  trial_time_left=trial_time_left,
@@ -690,7 +528,7 @@ def scan():
         
         except MemoryError:
             cleanup_uploaded_file(filepath)
-            gc.collect()
+            memory_governor.check("scan error")
             return render_template('scanner.html',
                                  trial_expired=trial_expired,
                                  trial_time_left=trial_time_left,
@@ -699,7 +537,7 @@ def scan():
         
         except Exception as e:
             cleanup_uploaded_file(filepath)
-            gc.collect()
+            memory_governor.check("scan error")
             print(f"DEBUG: Scan processing error: {e}")
             return render_template('scanner.html',
                                  trial_expired=trial_expired,
@@ -707,68 +545,31 @@ def scan():
                                  user_name=user_data['name'],
                                  error="Processing failed. Please try again with a different image.")
         
-        # Update user scan counts
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        new_scans_used = user_data['scans_used'] + 1 if not user_data['is_premium'] else user_data['scans_used']
-        new_total_scans = user_data['total_scans_ever'] + 1
-        
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            cursor.execute('''
-                UPDATE users 
-                SET scans_used = %s, total_scans_ever = %s
-                WHERE id = %s
-            ''', (new_scans_used, new_total_scans, session['user_id']))
-            
-            cursor.execute('''
-                INSERT INTO scan_history (
-                    user_id, result_rating, ingredients_found, scan_date, scan_id,
-                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
-                )
-                VALUES (%s, %s, %s, CURRENT_TIMESTAMP, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                session['user_id'], 
-                result.get('rating', ''), 
-                json.dumps(result.get('matched_ingredients', {})),
-                str(uuid.uuid4()),
-                result.get('extracted_text', '')[:1000],
-                result.get('extracted_text_length', 0),
-                result.get('confidence', 'medium'),
-                result.get('text_quality', 'unknown'),
-                result.get('has_safety_labels', False),
-                saved_image_path
-            ))
+        trial_cutoff = datetime.now() - timedelta(hours=TRIAL_HOURS)
+        if history_writer.enabled():
+            # Only the quota reservation stays on the request path; the history row is
+            # queued. The result is already computed, so a database error doesn't fail
+            # the scan - the row is charged when it's written instead.
+            charge = False
+            try:
+                new_scans_used = history_repo.reserve_scan(session['user_id'], FREE_SCAN_LIMIT, trial_cutoff)
+            except Exception as e:
+                print(f"DEBUG: Scan reservation failed, charging when history is written: {e}")
+                charge = True
+                new_scans_used = (user_data.get('scans_used') or 0) + (0 if user_data.get('is_premium') else 1)
+            if new_scans_used is not None:
+                history_writer.enqueue(history_repo.dated_entry(session['user_id'], result, saved_image_path), charge=charge)
         else:
-            cursor.execute('''
-                UPDATE users 
-                SET scans_used = ?, total_scans_ever = ?
-                WHERE id = ?
-            ''', (new_scans_used, new_total_scans, session['user_id']))
-            
-            cursor.execute('''
-                INSERT INTO scan_history (
-                    user_id, result_rating, ingredients_found, scan_date, scan_id,
-                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                session['user_id'], 
-                result.get('rating', ''), 
-                json.dumps(result.get('matched_ingredients', {})),
-                format_datetime_for_db(),
-                str(uuid.uuid4()),
-                result.get('extracted_text', '')[:1000],
-                result.get('extracted_text_length', 0),
-                result.get('confidence', 'medium'),
-                result.get('text_quality', 'unknown'),
-                int(result.get('has_safety_labels', False)),
-                saved_image_path
-            ))
-        
-        conn.commit()
-        conn.close()
+            # Reserve the scan against the quota and add the history row atomically -
+            # a concurrent scan may have used the last free scan since can_scan() ran
+            new_scans_used = history_repo.record_scan(
+                session['user_id'], result, saved_image_path,
+                free_scan_limit=FREE_SCAN_LIMIT,
+                trial_cutoff=trial_cutoff)
+        
+        if new_scans_used is None:
+            flash('You have used all your free scans. Please upgrade to continue.', 'error')
+            return redirect(url_for('upgrade'))
         
         session['scans_used'] = new_scans_used
         
@@ -776,7 +577,7 @@ def scan():
         cleanup_uploaded_file(filepath)
         
         # Final memory check
-        final_memory = psutil.Process().memory_info().rss / 1024 / 1024
+        final_memory = memory_governor.current_rss_mb()
         print(f"DEBUG: Final memory after scan: {final_memory:.1f}MB")
         print("DEBUG: Scan completed successfully")
         
@@ -794,8 +595,8 @@ def scan():
         # Clean up uploaded file on error
         cleanup_uploaded_file(filepath)
         
-        # Force memory cleanup on error
-        gc.collect()
+        # Memory cleanup on error - only collects if over budget
+        memory_governor.check("scan error")
         
         error_message = "Scanning failed. Please try again with a smaller, clearer image."
         if "memory" in str(e).lower():
@@ -811,8 +612,10 @@ def scan():
     
     finally:
         # Always ensure cleanup
+        if asset:
+            asset.close()
         cleanup_uploaded_file(filepath)
-        gc.collect()
+        print(f"DEBUG: Scan memory governor report: {memory_governor.request_report()}")
 
 @app.route('/account')
 @login_required
@@ -829,103 +632,70 @@ def account():
     trial_start = safe_datetime_parse(user_data['trial_start_date'])
     formatted_trial_start = trial_start.strftime('%B %d, %Y')
     
-    return render_template('account.html',
-                         user_name=user_data['name'],
-                         user_created_date=formatted_created_date,
-                         total_scans_ever=user_data['total_scans_ever'],
-                         trial_start_date=formatted_trial_start,
-                         trial_time_left=trial_time_left,
-                         trial_expired=trial_expired,
-                         trial_hours_left=trial_hours,
-                         trial_minutes_left=trial_minutes)
+    return page_cache.render('account.html',
+                             state={'trial_expired': trial_expired},
+                             slots={'user_name': user_data['name'],
+                                    'user_initial': (user_data['name'] or session.get('user_email', 'U'))[0].upper(),
+                                    'user_created_date': formatted_created_date,
+                                    'total_scans_ever': user_data['total_scans_ever'],
+                                    'trial_start_date': formatted_trial_start,
+                                    'trial_time_left': trial_time_left,
+                                    'trial_hours_left': trial_hours,
+                                    'trial_minutes_left': trial_minutes})
+
+def history_card(row):
+    """Template fields for one history card"""
+    scan_date = safe_datetime_parse(row['scan_date'])
+    
+    rating = row['result_rating'] or ''
+    
+    # Decoded from the compact id/bitset format by the repository
+    ingredients_data = row['ingredients_found']
+    
+    ingredient_summary = {}
+    detected_ingredients = []
+    has_gmo = False
+    
+    if isinstance(ingredients_data, dict):
+        for category, items in ingredients_data.items():
+            if isinstance(items, list) and items:
+                ingredient_summary[category] = len(items)
+                detected_ingredients.extend(items)
+                if category == 'gmo' and items:
+                    has_gmo = True
+            elif category == 'all_detected' and isinstance(items, list):
+                detected_ingredients = items
+                
+    detected_ingredients = list(set(detected_ingredients))
+    
+    return {
+        'scan_id': row['scan_id'],
+        'date': scan_date.strftime("%m/%d/%Y"),
+        'time': scan_date.strftime("%I:%M %p"),
+        'rating_type': rating_type(rating),
+        'raw_rating': rating,
+        'ingredient_summary': ingredient_summary,
+        'detected_ingredients': detected_ingredients,
+        'has_gmo': has_gmo,
+        'image_url': row.get('image_url', ''),
+        # Cards show the thumbnail and the modal opens the medium rendition - never the original upload
+        'thumb_url': blob_store.rendition_path(row['image_url'], 'thumb') if row.get('image_url') else None,
+        'medium_url': blob_store.rendition_path(row['image_url'], 'medium') if row.get('image_url') else None,
+        'text_length': row.get('text_length', 0),
+        'confidence': row.get('confidence', 'medium')
+    }
 
 @app.route('/history')
 @login_required
 def history():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            cursor.execute('''
-                SELECT * FROM scan_history 
-                WHERE user_id = %s 
-                ORDER BY scan_date DESC 
-                LIMIT 50
-            ''', (session['user_id'],))
-        else:
-            cursor.execute('''
-                SELECT * FROM scan_history 
-                WHERE user_id = ? 
-                ORDER BY scan_date DESC 
-                LIMIT 50
-            ''', (session['user_id'],))
-        
-        scans = []
-        stats = {'total_scans': 0, 'safe_scans': 0, 'danger_scans': 0, 'ingredients_found': 0}
-        
-        for row in cursor.fetchall():
-            scan_date = safe_datetime_parse(row['scan_date'])
-            
-            rating = row['result_rating'] or ''
-            rating_type = 'retry'
-            if 'Safe' in rating or 'Yay' in rating:
-                rating_type = 'safe'
-                stats['safe_scans'] += 1
-            elif 'Danger' in rating or 'NOOOO' in rating:
-                rating_type = 'danger'
-                stats['danger_scans'] += 1
-            elif 'Proceed' in rating or 'carefully' in rating:
-                rating_type = 'caution'
-            
-            ingredients_data = {}
-            try:
-                if row['ingredients_found']:
-                    if row['ingredients_found'].startswith('{'):
-                        ingredients_data = json.loads(row['ingredients_found'])
-                    else:
-                        ingredients_data = eval(row['ingredients_found'])
-            except:
-                ingredients_data = {}
-            
-            ingredient_summary = {}
-            detected_ingredients = []
-            has_gmo = False
-            
-            if isinstance(ingredients_data, dict):
-                for category, items in ingredients_data.items():
-                    if isinstance(items, list) and items:
-                        ingredient_summary[category] = len(items)
-                        detected_ingredients.extend(items)
-                        if category == 'gmo' and items:
-                            has_gmo = True
-                    elif category == 'all_detected' and isinstance(items, list):
-                        detected_ingredients = items
-                        
-            detected_ingredients = list(set(detected_ingredients))
-            stats['ingredients_found'] += len(detected_ingredients)
-            
-            scan_entry = {
-                'scan_id': row['scan_id'],
-                'date': scan_date.strftime("%m/%d/%Y"),
-                'time': scan_date.strftime("%I:%M %p"),
-                'rating_type': rating_type,
-                'raw_rating': rating,
-                'ingredient_summary': ingredient_summary,
-                'detected_ingredients': detected_ingredients,
-                'has_gmo': has_gmo,
-                'image_url': row.get('image_url', ''),
-                'extracted_text': row.get('extracted_text', ''),
-                'text_length': row.get('text_length', 0),
-                'confidence': row.get('confidence', 'medium')
-            }
-            
-            scans.append(scan_entry)
-            stats['total_scans'] += 1
+        rows, next_cursor = history_repo.page(session['user_id'], HISTORY_PAGE_SIZE)
+        scans = [history_card(row) for row in rows]
+        stats = history_repo.scan_stats.get(session['user_id'])   # one primary-key read
+        deletion = history_deletion.status(session['user_id'])
         
-        conn.close()
-        return render_template('history.html', scans=scans, stats=stats)
+        return render_template('history.html', scans=scans, stats=stats, next_cursor=next_cursor,
+                               deletion=deletion if deletion and not deletion['finished'] else None)
         
     except Exception as e:
         print(f"History error: {e}")
@@ -933,16 +703,43 @@ def history():
         traceback.print_exc()
         return render_template('history.html', scans=[], stats={'total_scans': 0, 'safe_scans': 0, 'danger_scans': 0, 'ingredients_found': 0})
 
+@app.route('/history/page')
+@login_required
+def history_page():
+    """Infinite scroll - the next page of cards after ?cursor="""
+    cursor = request.args.get('cursor', '')
+    if cursor and history_repo.decode_cursor(cursor) is None:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    rows, next_cursor = history_repo.page(session['user_id'], HISTORY_PAGE_SIZE, cursor or None)
+    scans = [history_card(row) for row in rows]
+    
+    return jsonify({
+        'html': render_template('_history_cards.html', scans=scans),
+        'scans': scans,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/history/<scan_id>/text')
+@login_required
+def history_text(scan_id):
+    """Extracted text for the detail view - kept out of the page query"""
+    row = history_repo.text(session['user_id'], scan_id)
+    if not row:
+        return jsonify({'error': 'Scan not found'}), 404
+    
+    return jsonify({'extracted_text': row['extracted_text'] or '', 'text_length': row['text_length'] or 0})
+
 @app.route('/upgrade')
 @login_required
 def upgrade():
     user_data = get_user_data(session['user_id'])
     trial_time_left, trial_expired, _, _ = calculate_trial_time_left(user_data['trial_start_date'])
     
-    return render_template('upgrade.html',
-                         trial_expired=trial_expired,
-                         trial_time_left=trial_time_left,
-                         stripe_publishable_key=STRIPE_PUBLISHABLE_KEY)
+    return page_cache.render('upgrade.html',
+                             state={'trial_expired': trial_expired,
+                                    'stripe_publishable_key': STRIPE_PUBLISHABLE_KEY},
+                             slots={'trial_time_left': trial_time_left})
 
 # STRIPE PAYMENT PROCESSING ROUTES
 @app.route('/create-checkout-session', methods=['POST'])
@@ -976,17 +773,7 @@ def create_checkout_session():
             )
             stripe_customer_id = customer.id
             
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('UPDATE users SET stripe_customer_id = %s WHERE id = %s', 
-                             (stripe_customer_id, user_data['id']))
-            else:
-                cursor.execute('UPDATE users SET stripe_customer_id = ? WHERE id = ?', 
-                             (stripe_customer_id, user_data['id']))
-            conn.commit()
-            conn.close()
+            user_repo.set_stripe_customer(user_data['id'], stripe_customer_id)
         
         checkout_session = stripe.checkout.Session.create(
             customer=stripe_customer_id,
@@ -1024,29 +811,7 @@ def payment_success():
         checkout_session = stripe.checkout.Session.retrieve(session_id)
         
         if checkout_session.payment_status == 'paid':
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = TRUE, 
-                        subscription_status = 'active',
-                        subscription_start_date = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                ''', (session['user_id'],))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = 1, 
-                        subscription_status = 'active',
-                        subscription_start_date = ?
-                    WHERE id = ?
-                ''', (format_datetime_for_db(), session['user_id']))
-            
-            conn.commit()
-            conn.close()
+            user_repo.activate_premium(session['user_id'])
             
             session['is_premium'] = True
             
@@ -1083,29 +848,7 @@ def stripe_webhook():
         
         if user_id:
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                database_url = os.getenv('DATABASE_URL')
-                if database_url:
-                    cursor.execute('''
-                        UPDATE users 
-                        SET is_premium = TRUE, 
-                            subscription_status = 'active',
-                            subscription_start_date = CURRENT_TIMESTAMP
-                        WHERE id = %s
-                    ''', (user_id,))
-                else:
-                    cursor.execute('''
-                        UPDATE users 
-                        SET is_premium = 1, 
-                            subscription_status = 'active',
-                            subscription_start_date = ?
-                        WHERE id = ?
-                    ''', (format_datetime_for_db(), user_id))
-                
-                conn.commit()
-                conn.close()
+                user_repo.activate_premium(user_id)
                 print(f"User {user_id} upgraded to premium via webhook")
                 
             except Exception as e:
@@ -1116,27 +859,7 @@ def stripe_webhook():
         customer_id = subscription['customer']
         
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = FALSE, 
-                        subscription_status = 'canceled'
-                    WHERE stripe_customer_id = %s
-                ''', (customer_id,))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = 0, 
-                        subscription_status = 'canceled'
-                    WHERE stripe_customer_id = ?
-                ''', (customer_id,))
-            
-            conn.commit()
-            conn.close()
+            user_repo.cancel_subscription(customer_id)
             print(f"Subscription canceled for customer {customer_id}")
             
         except Exception as e:
@@ -1154,79 +877,49 @@ def clear_history():
         if not user_data or not user_data['is_premium']:
             return jsonify({'success': False, 'error': 'Premium required'}), 403
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Hidden at once; rows and files are deleted in batches by history_deletion's worker thread
+        hidden = history_deletion.request(session['user_id'])
+        print(f"DEBUG: Cleared history for user {session['user_id']}: {hidden} scans queued for deletion")
         
-        user_upload_dir = os.path.join(UPLOADS_DIR, str(session['user_id']))
-        if os.path.exists(user_upload_dir):
-            shutil.rmtree(user_upload_dir)
-            print(f"DEBUG: Deleted user images directory: {user_upload_dir}")
-        
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            cursor.execute('DELETE FROM scan_history WHERE user_id = %s', (session['user_id'],))
-        else:
-            cursor.execute('DELETE FROM scan_history WHERE user_id = ?', (session['user_id'],))
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'pending': hidden})
         
     except Exception as e:
         print(f"Clear history error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
         
+@app.route('/clear-history/status')
+@login_required
+def clear_history_status():
+    """Progress of the user's last clear-history"""
+    return jsonify(history_deletion.status(session['user_id']) or {'total_rows': 0, 'deleted_rows': 0, 'finished': True})
+
 # EXPORT HISTORY ROUTE
 @app.route('/export-history')
 @login_required
 def export_history():
-    """Export user's scan history as JSON (Premium feature)"""
+    """Export user's scan history as JSON, NDJSON or CSV (Premium feature) - streamed, not built in memory"""
     try:
         user_data = get_user_data(session['user_id'])
         if not user_data or not user_data['is_premium']:
             flash('Premium subscription required for export feature', 'error')
             return redirect(url_for('history'))
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            cursor.execute('SELECT * FROM scan_history WHERE user_id = %s ORDER BY scan_date DESC', (session['user_id'],))
-        else:
-            cursor.execute('SELECT * FROM scan_history WHERE user_id = ? ORDER BY scan_date DESC', (session['user_id'],))
-        
-        scans_data = []
-        for row in cursor.fetchall():
-            scan_data = {
-                'scan_id': row['scan_id'],
-                'scan_date': str(row['scan_date']),
-                'result_rating': row['result_rating'],
-                'ingredients_found': row['ingredients_found'],
-                'extracted_text': row.get('extracted_text', ''),
-                'confidence': row.get('confidence', 'unknown'),
-                'text_quality': row.get('text_quality', 'unknown')
-            }
-            scans_data.append(scan_data)
-        
-        conn.close()
+        export_format = request.args.get('format', 'json').lower()
+        if export_format not in EXPORT_FORMATS:
+            flash('Unknown export format', 'error')
+            return redirect(url_for('history'))
+        encode, mimetype, extension = EXPORT_FORMATS[export_format]
         
-        export_data = {
-            'user_email': session['user_email'],
-            'export_date': datetime.now().isoformat(),
-            'total_scans': len(scans_data),
-            'scans': scans_data
-        }
+        user_email = session['user_email']
+        rows = history_repo.stream_for_user(session['user_id'])
+        filename = f'foodfixr_history_{user_email}_{datetime.now().strftime("%Y%m%d")}.{extension}'
         
-        response = Response(
-            json.dumps(export_data, indent=2),
-            mimetype='application/json',
-            headers={'Content-Disposition': f'attachment; filename=foodfixr_history_{session["user_email"]}_{datetime.now().strftime("%Y%m%d")}.json'}
+        return Response(
+            encode(rows, user_email, datetime.now().isoformat()),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
         
-        return response
-        
     except Exception as e:
         print(f"Export history error: {e}")
         flash('Export failed. Please try again.', 'error')
@@ -1240,7 +933,25 @@ def uploaded_file(user_id, filename):
         return "Access denied", 403
         
     user_upload_dir = os.path.join(UPLOADS_DIR, str(user_id))
-    return send_file(os.path.join(user_upload_dir, filename))
+    path = ensure_rendition(os.path.join(user_upload_dir, secure_filename(filename)))
+    if not path:
+        return "Not found", 404
+    return image_response.send_image(path, f"uploads/{user_id}/{os.path.basename(path)}")
+
+@app.route('/static/uploads/blobs/<shard>/<subshard>/<filename>')
+@login_required
+def blob_file(shard, subshard, filename):
+    """Serve stored scan images (only to users with a scan of that image)"""
+    image_url = f"{blob_store.BLOB_URL_PREFIX}{shard}/{subshard}/{filename}"
+    path = blob_store.path_for_url(image_url)
+    if not path or not history_repo.owns_image(session['user_id'], image_url):
+        return "Access denied", 403
+    
+    path = ensure_rendition(path)
+    if not path:
+        return "Not found", 404
+    # Content-addressed - the name is the ETag and the bytes never change
+    return image_response.send_image(path, f"blobs/{shard}/{subshard}/{os.path.basename(path)}", immutable=True)
 
 # CRITICAL: Health check endpoint for load balancer
 @app.route('/health')
@@ -1250,19 +961,12 @@ def health_check():
         start_time = time.time()
         
         # Quick database check
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1')
-        conn.close()
-        
-        # Memory check with automatic cleanup
-        memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
         
-        if memory_mb > 350:  # Critical memory level
-            print(f"HEALTH CHECK: Critical memory level {memory_mb:.1f}MB, forcing cleanup")
-            gc.collect()
-            time.sleep(0.1)
-            memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
+        # Report memory only - collection belongs to the scan path (memory_governor.py)
+        memory_mb = memory_governor.current_rss_mb()
         
         # Check response time
         response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
@@ -1285,7 +989,15 @@ def health_check():
             'memory_mb': round(memory_mb, 1),
             'response_time_ms': round(response_time, 1),
             'timestamp': datetime.now().isoformat(),
-            'database': 'connected'
+            'database': 'connected',
+            'db_pool': db_pool.stats(),
+            'user_cache': user_cache.stats(),
+            'history_writer': history_writer.stats(),
+            'history_deletion': history_deletion.stats(),
+            'retention': retention.stats(),
+            'password_hasher': password_hasher.stats(),
+            'pages': page_cache.stats(),
+            'requests': request_policy.stats()
         }), http_code
         
     except Exception as e:
@@ -1304,29 +1016,7 @@ def test_upgrade_user():
         plan = request.form.get('plan', 'monthly')
         
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            database_url = os.getenv('DATABASE_URL')
-            if database_url:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = TRUE, 
-                        subscription_status = 'active',
-                        subscription_start_date = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                ''', (session['user_id'],))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = 1, 
-                        subscription_status = 'active',
-                        subscription_start_date = ?
-                    WHERE id = ?
-                ''', (format_datetime_for_db(), session['user_id']))
-            
-            conn.commit()
-            conn.close()
+            user_repo.activate_premium(session['user_id'])
             
             session['is_premium'] = True
             
@@ -1401,18 +1091,13 @@ def simple_login():
             error_msg = "Please enter both email and password"
         else:
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
+                user = user_repo.find_by_email(email)
                 
-                database_url = os.getenv('DATABASE_URL')
-                if database_url:
-                    cursor.execute('SELECT * FROM users WHERE email = %s', (email,))
-                else:
-                    cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
+                password_ok, new_hash = password_hasher.verify_password(user['password_hash'], password) if user else (False, None)
                 
-                user = cursor.fetchone()
-                
-                if user and check_password_hash(user['password_hash'], password):
+                if password_ok:
+                    if new_hash:
+                        user_repo.set_password(user['email'], new_hash)
                     session.clear()
                     session.permanent = True
                     session['user_id'] = user['id']
@@ -1422,12 +1107,9 @@ def simple_login():
                     session['scans_used'] = user['scans_used']
                     session['stripe_customer_id'] = user['stripe_customer_id']
                     
-                    conn.close()
                     return redirect('/')
                 else:
                     error_msg = "Invalid email or password"
-                    
-                conn.close()
             except Exception as e:
                 error_msg = f"Login error: {str(e)}"
     else:
@@ -1485,34 +1167,14 @@ def admin_password_reset():
             error_msg = "Password must be at least 6 characters long"
         else:
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                database_url = os.getenv('DATABASE_URL')
-                if database_url:
-                    cursor.execute('SELECT id, name FROM users WHERE email = %s', (email,))
-                else:
-                    cursor.execute('SELECT id, name FROM users WHERE email = ?', (email,))
-                
-                user = cursor.fetchone()
+                user = user_repo.find_by_email(email)
                 
                 if not user:
                     error_msg = f"No user found with email: {email}"
                 else:
-                    password_hash = generate_password_hash(new_password)
-                    
-                    if database_url:
-                        cursor.execute('UPDATE users SET password_hash = %s WHERE email = %s', 
-                                     (password_hash, email))
-                    else:
-                        cursor.execute('UPDATE users SET password_hash = ? WHERE email = ?', 
-                                     (password_hash, email))
-                    
-                    conn.commit()
+                    user_repo.set_password(email, password_hasher.hash_password(new_password))
                     success_msg = f"Password updated for {user['name']} ({email})"
                 
-                conn.close()
-                
             except Exception as e:
                 error_msg = f"Database error: {str(e)}"
     else:
@@ -1521,11 +1183,7 @@ def admin_password_reset():
     
     # Get all users for the dropdown
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT email, name FROM users ORDER BY name')
-        users = cursor.fetchall()
-        conn.close()
+        users = user_repo.list_by_name()
     except:
         users = []
     
@@ -1567,7 +1225,7 @@ def admin_password_reset():
                     <label for="email">Select User Email:</label>
                     <select id="email" name="email" onchange="fillEmail(this.value)" required>
                         <option value="">-- Select a user --</option>
-                        {''.join([f'<option value="{user[0]}">{user[1]} ({user[0]})</option>' for user in users])}
+                        {''.join([f'<option value="{user["email"]}">{user["name"]} ({user["email"]})</option>' for user in users])}
                     </select>
                     <div class="quick-fill">
                         Or type manually: 
@@ -1596,7 +1254,7 @@ def admin_password_reset():
             
             <div class="user-list">
                 <h3>📋 Registered Users ({len(users)} total):</h3>
-                {''.join([f'<div class="user-item"><strong>{user[1]}</strong> - {user[0]}</div>' for user in users]) if users else '<p>No users found</p>'}
+                {''.join([f'<div class="user-item"><strong>{user["name"]}</strong> - {user["email"]}</div>' for user in users]) if users else '<p>No users found</p>'}
             </div>
         </div>
         
@@ -1617,12 +1275,7 @@ def admin_password_reset():
 def check_users():
     """Enhanced user management interface"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id, name, email, created_at, is_premium, scans_used FROM users ORDER BY created_at DESC')
-        users = cursor.fetchall()
-        conn.close()
+        users = user_repo.list_recent()
         
         return f"""
         <!DOCTYPE html>
@@ -1660,11 +1313,11 @@ def check_users():
                         <div>Total Users</div>
                     </div>
                     <div class="stat-box">
-                        <div class="stat-number">{len([u for u in users if u[4]])}</div>
+                        <div class="stat-number">{len([u for u in users if u['is_premium']])}</div>
                         <div>Premium Users</div>
                     </div>
                     <div class="stat-box">
-                        <div class="stat-number">{sum(u[5] or 0 for u in users)}</div>
+                        <div class="stat-number">{sum(u['scans_used'] or 0 for u in users)}</div>
                         <div>Total Scans</div>
                     </div>
                 </div>
@@ -1690,12 +1343,12 @@ def check_users():
                     <tbody>
                         {''.join([f'''
                         <tr>
-                            <td>{user[0]}</td>
-                            <td>{user[1]}</td>
-                            <td>{user[2]}</td>
-                            <td class="{'premium' if user[4] else 'trial'}">{'Premium' if user[4] else 'Trial'}</td>
-                            <td>{user[5] or 0}</td>
-                            <td>{user[3]}</td>
+                            <td>{user['id']}</td>
+                            <td>{user['name']}</td>
+                            <td>{user['email']}</td>
+                            <td class="{'premium' if user['is_premium'] else 'trial'}">{'Premium' if user['is_premium'] else 'Trial'}</td>
+                            <td>{user['scans_used'] or 0}</td>
+                            <td>{user['created_at']}</td>
                         </tr>
                         ''' for user in users]) if users else '<tr><td colspan="6" style="text-align: center;">No users found</td></tr>'}
                     </tbody>
@@ -1719,21 +1372,20 @@ def check_users():
 # Error handlers with better error pages
 @app.errorhandler(413)
 def too_large(e):
-    gc.collect()  # Clean up on error
     return render_template('error.html', 
                          error_title="File Too Large", 
-                         error_message="The uploaded image is too large. Please upload an image smaller than 5MB."), 413
+                         error_message=f"The uploaded image is too large. Please upload an image smaller than {PROFILE.max_content_length_mb}MB."), 413
 
 @app.errorhandler(500)
 def internal_error(e):
-    gc.collect()  # Force cleanup on 500 errors
+    memory_governor.check("500 error")   # collects only if a failed scan left RSS over budget
     return render_template('error.html', 
                          error_title="Internal Server Error", 
                          error_message="Something went wrong. Please try again with a smaller image."), 500
 
 @app.errorhandler(TimeoutError)
 def timeout_error(e):
-    gc.collect()  # Force cleanup on timeout
+    memory_governor.check("timeout")
     return render_template('error.html',
                          error_title="Request Timeout",
                          error_message="The request took too long to process. Please try with a smaller image."), 504
@@ -1743,4 +1395,6 @@ if __name__ == '__main__':
     # Only for local development - production uses Gunicorn
     port = int(os.environ.get("PORT", 5000))
     print("WARNING: Running with Flask development server. Use Gunicorn for production!")
+    history_deletion.resume()   # gunicorn workers do this in post_fork
+    retention.start()
     app.run(host="0.0.0.0", port=port, debug=False)
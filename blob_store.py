@@ -0,0 +1,184 @@
+# blob_store.py - Content-addressed storage for saved scan images
+#
+# Scan images used to be copied to static/uploads/<user_id>/ under a fresh
+# timestamp+uuid name, so every rescan of the same photo stored another copy.
+# Images are now stored once per distinct content, named by the SHA-256 of their
+# bytes and sharded by its first two byte pairs:
+#
+#     static/uploads/blobs/ab/cd/abcd...ef.jpg           the image
+#     static/uploads/blobs/ab/cd/abcd...ef_thumb.webp    WebP renditions share the stem
+#
+# scan_history.image_url holds the blob's URL, and image_blobs counts the history
+# rows pointing at each blob (maintained in the same transactions as history
+# inserts and deletes). Writes go to a temp file in the shard and are renamed into
+# place, so a blob is either complete or absent. A blob that already exists is
+# only touched - its mtime is what protects it from a concurrent GC pass until the
+# history row referencing it has been written.
+#
+# retention.py may replace an old blob with its smaller ARCHIVE rendition; the URL
+# stays the same and the image route serves the archive in its place.
+#
+# GC deletes blobs (with their renditions) that no history row references and
+# that haven't been touched for BLOB_GC_GRACE_HOURS:
+#
+#     python blob_store.py gc               # delete
+#     python blob_store.py gc --dry-run     # report only
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BLOB_DIR = os.getenv('BLOB_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads', 'blobs'))
+BLOB_URL_PREFIX = 'static/uploads/blobs/'
+BLOB_GC_GRACE_HOURS = float(os.getenv('BLOB_GC_GRACE_HOURS', '1'))   # younger blobs may belong to a scan in flight
+
+TEMP_PREFIX = '.tmp-'
+ARCHIVE = 'archive'   # rendition name of an archived original
+
+def shard(digest):
+    """Relative directory for a digest - two levels of 256 keep directories small"""
+    return os.path.join(digest[:2], digest[2:4])
+
+def url_for(digest, extension):
+    return f"{BLOB_URL_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+def is_blob_url(image_url):
+    return bool(image_url) and image_url.startswith(BLOB_URL_PREFIX)
+
+def path_for_url(image_url):
+    """Filesystem path of a blob URL (image or rendition), or None for anything else"""
+    if not is_blob_url(image_url):
+        return None
+    relative = image_url[len(BLOB_URL_PREFIX):]
+    parts = relative.split('/')
+    if len(parts) != 3 or any(not part or part.startswith('.') for part in parts):
+        return None
+    return os.path.join(BLOB_DIR, *parts)
+
+def stem_url(image_url):
+    """URL of a blob or rendition without the extension and rendition suffix - the digest part"""
+    directory, filename = image_url.rsplit('/', 1)
+    return f"{directory}/{os.path.splitext(filename)[0].split('_', 1)[0]}"
+
+def put(source_path, digest, extension):
+    """Store the file at source_path under its digest - returns (url, bytes written)
+
+    Bytes written is 0 when the blob already existed.
+    """
+    extension = extension.lower()
+    directory = os.path.join(BLOB_DIR, shard(digest))
+    path = os.path.join(directory, f"{digest}{extension}")
+
+    if os.path.exists(path):
+        os.utime(path)   # a fresh mtime keeps GC away until the history row lands
+        return url_for(digest, extension), 0
+
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as target, open(source_path, 'rb') as source:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+            target.flush()
+            os.fsync(target.fileno())
+        # Same name, same bytes - if another worker got here first, replacing is harmless
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    return url_for(digest, extension), os.path.getsize(path)
+
+def rendition_path(image_path, name):
+    """Path of a named WebP rendition (image_asset.RENDITIONS, ARCHIVE) stored next to an image"""
+    return f"{os.path.splitext(image_path)[0]}_{name}.webp"
+
+def write_atomic(path, save):
+    """Call save(temp_path) and rename the result to path"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+    os.close(fd)
+    try:
+        save(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def _blob_files():
+    """(stem URL, path, mtime) for every stored or archived image, plus stale temp files as (None, path, mtime)"""
+    if not os.path.isdir(BLOB_DIR):
+        return
+    archive_suffix = f"_{ARCHIVE}"
+    for root, _, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            stem = os.path.splitext(name)[0]
+            if name.startswith(TEMP_PREFIX):
+                yield None, path, mtime
+            elif '_' not in stem or stem.endswith(archive_suffix):
+                relative = os.path.relpath(path, BLOB_DIR).replace(os.sep, '/')
+                yield stem_url(BLOB_URL_PREFIX + relative), path, mtime
+
+def gc(blob_repo, grace_hours=BLOB_GC_GRACE_HOURS, dry_run=False):
+    """Delete unreferenced blobs older than the grace period - returns (blobs, bytes) reclaimed"""
+    started = time.monotonic()
+    cutoff = time.time() - grace_hours * 3600
+    referenced = {stem_url(url) for url in blob_repo.referenced_urls()}
+
+    blobs, reclaimed = 0, 0
+    for stem, path, mtime in _blob_files():
+        if mtime > cutoff or stem in referenced:
+            continue
+        try:
+            if os.stat(path).st_mtime > cutoff:
+                continue   # touched by a scan since the walk started
+        except FileNotFoundError:
+            continue   # an image and its archive share a stem - already gone with the other
+
+        directory = os.path.dirname(path)
+        digest = stem.rsplit('/', 1)[-1] if stem else None
+        victims = [path] if stem is None else \
+            [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.startswith(digest) and not name.startswith(TEMP_PREFIX)]
+
+        for victim in victims:
+            try:
+                size = os.path.getsize(victim)
+                if not dry_run:
+                    os.remove(victim)
+                reclaimed += size
+            except FileNotFoundError:
+                pass
+        if stem is not None:
+            blobs += 1
+            if not dry_run:
+                blob_repo.forget(stem)
+
+    action = 'Would reclaim' if dry_run else 'Reclaimed'
+    print(f"INFO: {action} {blobs} blobs ({reclaimed / 1024 / 1024:.1f}MB) in {time.monotonic() - started:.1f}s")
+    return blobs, reclaimed
+
+if __name__ == '__main__':
+    import db_pool
+    from repositories import ImageBlobRepo, connect_database
+
+    if sys.argv[1:2] != ['gc']:
+        print("usage: python blob_store.py gc [--dry-run] [--grace-hours N]")
+        sys.exit(2)
+
+    grace_hours = BLOB_GC_GRACE_HOURS
+    if '--grace-hours' in sys.argv:
+        grace_hours = float(sys.argv[sys.argv.index('--grace-hours') + 1])
+
+    gc(ImageBlobRepo(lambda: db_pool.get_connection(connect_database)), grace_hours, dry_run='--dry-run' in sys.argv)
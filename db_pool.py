@@ -0,0 +1,296 @@
+# db_pool.py - Per-worker database connection pool
+#
+# get_db_connection() used to open a fresh psycopg2 (or SQLite) connection on every
+# call - three or more per scan. Connections are now checked out of a small pool
+# and go back to it on close(), so existing call sites keep working unchanged.
+#
+# Fork safety: with preload_app=True the master imports the app (and runs init_db)
+# before forking. A pool remembers the pid that created it; a worker that finds a
+# pool from another pid abandons the inherited connections without closing them
+# (closing would terminate the master's session on the shared socket) and starts
+# its own. The master also calls close_all() once start-up queries are done.
+#
+# `with conn:` keeps DB-API semantics - commit if the block succeeds, roll back if
+# it raises - and then returns the connection to the pool.
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '0')) or None             # set by configure()
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))            # seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # recycle connections older than this
+DB_POOL_HEALTH_INTERVAL = 30.0   # ping connections idle longer than this before handing them out
+ORPHAN_CHECK_INTERVAL = 0.5      # how often a queued checkout looks for slots left by unclosed connections
+
+class PoolTimeout(Exception):
+    """Raised when no connection frees up within DB_POOL_TIMEOUT"""
+
+def configure(size=None, timeout=None, max_lifetime=None):
+    """Set the pool limits - env DB_POOL_SIZE always wins"""
+    global DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME
+
+    if size is not None and not os.getenv('DB_POOL_SIZE'):
+        DB_POOL_SIZE = int(size)
+    if timeout is not None:
+        DB_POOL_TIMEOUT = float(timeout)
+    if max_lifetime is not None:
+        DB_POOL_MAX_LIFETIME = float(max_lifetime)
+
+class PooledConnection:
+    """Proxy for a pooled DB-API connection - close() returns it to the pool"""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.checked_out = False
+        self.prepared = set()          # server-side statements prepared on this connection
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.checked_out and exc_type is None:
+                self._raw.commit()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.checked_out:
+            self._pool.release(self)
+
+    def __del__(self):
+        # An error path dropped the connection without close() - don't leak the pool slot.
+        # GC can run this on a thread that holds the pool lock, so only queue the
+        # connection; the next acquire() or release() returns its slot.
+        if self.checked_out:
+            self.checked_out = False
+            self._pool._orphans.append(self._raw)
+
+class _Waiter:
+    """A thread queued for a connection - release() hands it a slot directly"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.conn = None
+
+class ConnectionPool:
+    """Bounded pool of connections created by factory(), owned by one process"""
+
+    def __init__(self, factory, max_size, timeout, max_lifetime, ping_sql='SELECT 1'):
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_sql = ping_sql
+        self.pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._in_use = 0
+        self._waiters = deque()    # FIFO - a releasing thread can't barge ahead of queued ones
+        self._orphans = deque()    # raw connections finalized without close() - appended lock-free
+
+        self._checkouts = 0
+        self._waits = 0            # checkouts that found the pool saturated
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._created = 0
+        self._discarded = 0
+
+    def _expired(self, conn):
+        return time.monotonic() - conn.created_at > self.max_lifetime
+
+    def _healthy(self, conn):
+        if getattr(conn._raw, 'closed', 0):
+            return False
+        if time.monotonic() - conn.last_used_at < DB_POOL_HEALTH_INTERVAL:
+            return True
+        try:
+            cursor = conn._raw.cursor()
+            cursor.execute(self.ping_sql)
+            cursor.fetchall()
+            cursor.close()
+            conn._raw.rollback()
+            return True
+        except Exception as e:
+            print(f"DEBUG: DB pool dropping dead connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn._raw.close()
+        except Exception:
+            pass
+
+    def _return_slot(self, conn):
+        """Give a slot (and its connection, if still usable) to the next waiter, or back to the pool"""
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.conn = conn
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._in_use -= 1
+                if conn is not None:
+                    self._idle.append(conn)
+
+    def _reclaim_orphans(self):
+        """Return the slots of connections that were garbage-collected while checked out"""
+        while self._orphans:
+            try:
+                raw = self._orphans.popleft()
+            except IndexError:
+                break
+            print("DEBUG: DB pool reclaiming a connection that was never closed")
+            # Its transaction state is unknown - close it rather than reuse it
+            self._discarded += 1
+            try:
+                raw.close()
+            except Exception:
+                pass
+            self._return_slot(None)
+
+    def acquire(self):
+        """Check out a connection, waiting up to the pool timeout when saturated"""
+        self._reclaim_orphans()
+        started = time.monotonic()
+        waiter = None
+
+        with self._lock:
+            if not self._waiters and (self._idle or self._in_use < self.max_size):
+                conn = self._idle.pop() if self._idle else None
+                self._in_use += 1
+            else:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+
+        if waiter is not None:
+            # Wake now and then to hand on slots that finalized connections left behind
+            deadline = started + self.timeout
+            while not waiter.event.wait(min(ORPHAN_CHECK_INTERVAL, max(0.0, deadline - time.monotonic()))):
+                self._reclaim_orphans()
+                if time.monotonic() >= deadline:
+                    break
+            with self._lock:
+                if not waiter.granted:
+                    self._waiters.remove(waiter)
+                    raise PoolTimeout(f"No database connection free after {self.timeout:.0f}s "
+                                      f"({self._in_use}/{self.max_size} in use)")
+            conn = waiter.conn
+
+        wait_seconds = time.monotonic() - started
+        with self._lock:
+            self._checkouts += 1
+            if waiter is not None:
+                self._waits += 1
+                self._wait_seconds += wait_seconds
+                self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+
+        try:
+            # Health checks and connects run outside the lock
+            if conn is not None and (self._expired(conn) or not self._healthy(conn)):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = PooledConnection(self, self.factory())
+                self._created += 1
+        except Exception:
+            self._return_slot(None)
+            raise
+
+        conn.checked_out = True
+        return conn
+
+    def release(self, conn):
+        """Return a connection - any open transaction is rolled back first"""
+        conn.checked_out = False
+        conn.last_used_at = time.monotonic()
+
+        keep = not self._expired(conn) and not getattr(conn._raw, 'closed', 0)
+        if keep:
+            try:
+                conn._raw.rollback()
+            except Exception:
+                keep = False
+        if not keep:
+            self._discard(conn)
+
+        self._return_slot(conn if keep else None)
+        self._reclaim_orphans()
+
+    def close_all(self):
+        """Close idle connections - checked-out ones close when they come back"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': len(self._waiters),
+                'checkouts': self._checkouts,
+                'saturated_checkouts': self._waits,
+                'wait_ms_total': round(self._wait_seconds * 1000, 1),
+                'wait_ms_max': round(self._max_wait_seconds * 1000, 1),
+                'created': self._created,
+                'discarded': self._discarded,
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+_abandoned = []   # connections inherited across fork - kept referenced so they are never finalized here
+
+def _get_pool(factory):
+    global _pool
+
+    if _pool is not None and _pool.pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _abandoned.extend(conn._raw for conn in _pool._idle)
+            print(f"DEBUG: DB pool inherited from pid {_pool.pid}, starting a fresh pool in {os.getpid()}")
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(factory, DB_POOL_SIZE or 5, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME)
+        return _pool
+
+def get_connection(factory):
+    """Check out a pooled connection - call close() (or use it as a context manager) to return it"""
+    return _get_pool(factory).acquire()
+
+@contextmanager
+def connection(factory):
+    """Context-manager checkout"""
+    conn = get_connection(factory)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def close_all():
+    """Close this process's idle connections (the master calls this before forking workers)"""
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close_all()
+
+def stats():
+    """Pool metrics for this worker"""
+    if _pool is None or _pool.pid != os.getpid():
+        return {'size': DB_POOL_SIZE or 5, 'in_use': 0, 'idle': 0, 'checkouts': 0}
+    return _pool.stats()
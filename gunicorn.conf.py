@@ -1,14 +1,22 @@
 # gunicorn.conf.py - Professional Tier Optimization
 import os
-import multiprocessing
+from resource_profile import PROFILE
 
 # Bind to the port provided by Render
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
 
-# PROFESSIONAL TIER: Can use multiple workers now!
-workers = 2  # Increased from 1 - can handle concurrent requests
-worker_class = "sync"
-worker_connections = 2000  # Increased from 1000
+# Worker count comes from the resource profile (capped to the host's CPUs)
+workers = int(os.getenv('WEB_CONCURRENCY', PROFILE.workers))
+
+# Concurrent worker model: a scan spends most of its time waiting on OCR.space, so
+# each worker serves PROFILE.threads requests at once. Decode memory stays bounded
+# by the host-wide admission budget (admission.py), timeouts are per-thread
+# deadlines (request_deadline.py) and temp files are uniquely named, so scans in
+# the same worker don't interfere. GUNICORN_WORKER_CLASS=sync restores one request
+# per worker. Both it and GUNICORN_THREADS are applied in resource_profile, so the
+# database pool is sized for the threads that actually run.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = PROFILE.threads
 
 # RELAXED timeout settings - you have more resources
 timeout = 180  # 3 minutes (was 120) - can handle complex OCR
@@ -22,7 +30,6 @@ worker_tmp_dir = "/dev/shm"  # Use RAM for temp files
 
 # Process management
 worker_rlimit_nofile = 2048  # Higher file descriptor limit
-max_worker_connections = 2000
 
 # Graceful shutdowns
 graceful_timeout = 45  # More time for cleanup
@@ -34,11 +41,28 @@ errorlog = "-"
 loglevel = "info"
 access_log_format = '%(h)s %(l)s %(u)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
 
-# Professional tier detection and optimization
-print("INFO: Professional tier configuration loaded")
-print(f"INFO: Using {workers} workers with {timeout}s timeout")
+print(f"INFO: '{PROFILE.name}' resource profile configuration loaded")
+print(f"INFO: Using {workers} {worker_class} workers x {threads} threads with {timeout}s timeout")
 print(f"INFO: Max requests per worker: {max_requests}")
 
 def when_ready(server):
-    print(f"INFO: Professional tier server ready - PID: {os.getpid()}")
-    print(f"INFO: Workers: {workers}, Memory: ~4GB available")
+    print(f"INFO: '{PROFILE.name}' profile server ready - PID: {os.getpid()}")
+    print(f"INFO: Workers: {workers} x {threads} threads, admission budget: {PROFILE.admission_budget_mb}MB")
+
+def post_fork(server, worker):
+    # Pick up clear-history jobs a dead worker left unfinished (history_deletion.py)
+    import history_deletion
+    history_deletion.resume()
+    # Scheduled retention pass - one worker per host runs it (retention.py)
+    import retention
+    retention.start()
+
+def child_exit(server, worker):
+    # Runs in the master for every worker that exits, killed ones included (admission.py)
+    import admission
+    admission.reclaim(worker.pid)
+
+def worker_exit(server, worker):
+    # Write out history rows still queued by the write-behind writer (history_writer.py)
+    import history_writer
+    history_writer.drain()
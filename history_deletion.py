@@ -0,0 +1,173 @@
+# history_deletion.py - Background deletion for clear_history
+#
+# clear_history used to rmtree the user's upload directory and run one unbounded
+# DELETE inside the request. Now the request only writes a tombstone
+# (history_deletions.cleared_at / cleared_id) and resets the user's stats: every
+# history query hides the rows it covers (repositories.VISIBLE), so the history is
+# gone for the user immediately.
+#
+# A thread in each worker then deletes the hidden rows HISTORY_DELETE_BATCH at a
+# time, one short transaction per batch, releasing blob references and unlinking
+# pre-blob-store upload files as it goes. Progress (deleted_rows / total_rows) is
+# in the tombstone row, which /clear-history/status reports.
+#
+# Crash safety: the job lives in the database, not in the worker. A job is claimed
+# with a lease that every batch renews; if the worker dies, the lease runs out and
+# any worker (each polls every POLL_INTERVAL seconds) or the CLI resumes it:
+#
+#     python history_deletion.py    # run every pending job to completion
+#
+# Like history_writer, the thread is started lazily and remembers its pid.
+
+import glob
+import os
+import shutil
+import threading
+import time
+
+import blob_store
+
+HISTORY_DELETE_BATCH = int(os.getenv('HISTORY_DELETE_BATCH', '500'))       # rows per transaction
+HISTORY_DELETE_PAUSE = float(os.getenv('HISTORY_DELETE_PAUSE', '0.05'))    # seconds between batches
+POLL_INTERVAL = 60.0   # seconds between checks for jobs left behind by a dead worker
+
+class HistoryDeleter:
+    """Runs pending deletion jobs on a per-worker background thread"""
+
+    def __init__(self, repo, uploads_dir):
+        self.repo = repo
+        self.uploads_dir = uploads_dir
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = False   # set by wake() - a wake during run_pending() is not lost
+        self._pid = None
+
+        self._jobs_finished = 0
+        self._rows_deleted = 0
+        self._files_removed = 0
+        self._last_error = None
+
+    def request(self, user_id):
+        """Hide the user's history now and queue its deletion - returns the rows hidden"""
+        hidden = self.repo.request(user_id)
+        self.wake()
+        return hidden
+
+    def wake(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                thread = threading.Thread(target=self._run, name='history-deleter', daemon=True)
+                thread.start()
+            self._pending = True
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._pending = False
+            try:
+                self.run_pending()
+            except Exception as e:
+                self._last_error = str(e)
+                print(f"DEBUG: History deletion failed, will retry: {e}")
+
+            with self._lock:
+                if not self._pending:
+                    self._wakeup.wait(POLL_INTERVAL)
+                if self._pid != os.getpid():
+                    return
+
+    def run_pending(self):
+        """Run every unclaimed job to completion - returns the jobs finished"""
+        finished = 0
+        for user_id in self.repo.pending():
+            if self.repo.claim(user_id) and self.run(user_id):
+                finished += 1
+        return finished
+
+    def run(self, user_id):
+        """Delete a claimed job's rows batch by batch - True once the tombstone is finished"""
+        started = time.monotonic()
+        deleted = 0
+        try:
+            while True:
+                count, finished = self.repo.delete_batch(user_id, HISTORY_DELETE_BATCH, self._remove_files)
+                deleted += count
+                self._rows_deleted += count
+                if finished:
+                    break
+                if not count:
+                    # A scan landed before the cut-off meanwhile - the next batch picks it up
+                    continue
+                time.sleep(HISTORY_DELETE_PAUSE)
+        except Exception:
+            self.repo.release_lease(user_id)
+            raise
+
+        # Anything left in the old per-user directory belonged to the cleared scans
+        user_upload_dir = os.path.join(self.uploads_dir, str(user_id))
+        if os.path.isdir(user_upload_dir):
+            shutil.rmtree(user_upload_dir, ignore_errors=True)
+
+        self._jobs_finished += 1
+        print(f"INFO: Cleared history for user {user_id}: {deleted} rows in {time.monotonic() - started:.1f}s")
+        return True
+
+    def _remove_files(self, image_urls):
+        """Unlink upload files saved before the blob store - blobs are left to blob_store GC"""
+        for image_url in image_urls:
+            if blob_store.is_blob_url(image_url) or not image_url.startswith('static/uploads/'):
+                continue
+            path = os.path.join(os.path.dirname(self.uploads_dir), os.path.relpath(image_url, 'static'))
+            for victim in [path] + glob.glob(f"{glob.escape(os.path.splitext(path)[0])}_*"):
+                try:
+                    os.remove(victim)
+                    self._files_removed += 1
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        return {
+            'jobs_finished': self._jobs_finished,
+            'rows_deleted': self._rows_deleted,
+            'files_removed': self._files_removed,
+            'last_error': self._last_error,
+        }
+
+_deleter = None
+
+def configure(repo, uploads_dir):
+    """Set the repository (HistoryDeletionRepo) and the pre-blob-store uploads directory"""
+    global _deleter
+    _deleter = HistoryDeleter(repo, uploads_dir)
+
+def request(user_id):
+    return _deleter.request(user_id)
+
+def status(user_id):
+    """The user's tombstone row as progress fields, or None if they never cleared"""
+    row = _deleter.repo.status(user_id)
+    if row is None:
+        return None
+    return {
+        'total_rows': row['total_rows'],
+        'deleted_rows': row['deleted_rows'],
+        'finished': row['finished_at'] is not None,
+    }
+
+def resume():
+    """Start the worker thread so jobs left by a dead worker are picked up"""
+    _deleter.wake()
+
+def stats():
+    return _deleter.stats() if _deleter is not None else {}
+
+if __name__ == '__main__':
+    import db_pool
+    from repositories import HistoryDeletionRepo, connect_database
+
+    deleter = HistoryDeleter(HistoryDeletionRepo(lambda: db_pool.get_connection(connect_database)),
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads'))
+    print(f"INFO: Finished {deleter.run_pending()} pending history deletions")
@@ -0,0 +1,82 @@
+# history_export.py - Streaming scan history export (JSON, NDJSON, CSV)
+#
+# The export used to fetchall() every row and json.dumps() the whole history into
+# one string. Rows now come from ScanHistoryRepo.stream_for_user() in fetchmany
+# batches and are encoded a batch at a time, so a worker holds one batch of rows
+# and one encoded chunk however long the history is.
+
+import csv
+import io
+import json
+
+CHUNK_ROWS = 200   # rows encoded per yielded chunk
+
+CSV_FIELDS = ['scan_id', 'scan_date', 'result_rating', 'ingredients_found', 'extracted_text', 'confidence', 'text_quality']
+
+def export_record(row):
+    """One exported scan, in the shape the JSON export has always used"""
+    return {
+        'scan_id': row['scan_id'],
+        'scan_date': str(row['scan_date']),
+        'result_rating': row['result_rating'],
+        'ingredients_found': row['ingredients_found'],
+        'extracted_text': row.get('extracted_text', ''),
+        'confidence': row.get('confidence', 'unknown'),
+        'text_quality': row.get('text_quality', 'unknown')
+    }
+
+def _chunked(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(export_record(row))
+        if len(chunk) >= CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def json_chunks(rows, user_email, export_date):
+    """Pretty-printed JSON document - total_scans comes last because it is counted while streaming"""
+    yield ('{\n'
+           f'  "user_email": {json.dumps(user_email)},\n'
+           f'  "export_date": {json.dumps(export_date)},\n'
+           '  "scans": [')
+
+    total = 0
+    for chunk in _chunked(rows):
+        # Encoded JSON never contains a raw newline, so re-indenting is a plain replace
+        encoded = ['    ' + json.dumps(record, indent=2).replace('\n', '\n    ') for record in chunk]
+        yield (',\n' if total else '\n') + ',\n'.join(encoded)
+        total += len(chunk)
+
+    closing = '\n  ]' if total else ']'
+    yield f'{closing},\n  "total_scans": {total}\n}}\n'
+
+def ndjson_chunks(rows, user_email, export_date):
+    """One JSON object per line"""
+    for chunk in _chunked(rows):
+        yield ''.join(json.dumps(record) + '\n' for record in chunk)
+
+def csv_chunks(rows, user_email, export_date):
+    """CSV with a header row - ingredients_found is a JSON column"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+
+    for chunk in _chunked(rows):
+        for record in chunk:
+            record['ingredients_found'] = json.dumps(record['ingredients_found'])
+            writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+# format -> (encoder, mimetype, file extension)
+EXPORT_FORMATS = {
+    'json': (json_chunks, 'application/json', 'json'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson', 'ndjson'),
+    'csv': (csv_chunks, 'text/csv', 'csv'),
+}
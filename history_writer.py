@@ -0,0 +1,264 @@
+# history_writer.py - Write-behind queue for scan_history inserts
+#
+# With HISTORY_WRITE_BEHIND=true, scan() only reserves the scan against the user's
+# quota on the request path. The history row is queued here and written by a
+# background thread in multi-row batches (ScanHistoryRepo.add_many), flushed when
+# HISTORY_BATCH_SIZE rows are waiting, every HISTORY_FLUSH_INTERVAL seconds, and
+# on shutdown (gunicorn's worker_exit hook calls drain(), atexit is the fallback).
+# A failed flush keeps the rows queued and retries with backoff.
+#
+# Durability: every queued row is also appended to a per-process spool file in
+# HISTORY_SPOOL_DIR and the file is rewritten after each flush. A worker that dies
+# with rows queued leaves its spool behind; the next process to start (the master
+# at boot, or any worker) claims spools of dead pids with an atomic rename and
+# replays them. Replays can't duplicate rows - scan_id is unique and add_many skips
+# conflicts. The spool is flushed but not fsynced, so it survives a crashed
+# worker, not a lost host. HISTORY_SPOOL_DIR must be on storage that outlives a
+# restart or deploy (a mounted disk, not the system temp dir) - there is no
+# default, and enabling write-behind without it fails at start-up.
+#
+# Like db_pool, the queue remembers the pid that created it. A forked worker starts
+# with an empty queue, its own spool file and its own flush thread.
+
+import atexit
+import glob
+import json
+import os
+import threading
+import uuid
+
+HISTORY_WRITE_BEHIND = os.getenv('HISTORY_WRITE_BEHIND', 'false').lower() == 'true'
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', '50'))              # rows per multi-row INSERT
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '2'))    # max seconds a row waits
+HISTORY_SPOOL_DIR = os.getenv('HISTORY_SPOOL_DIR')                          # persistent disk - required with write-behind
+MAX_RETRY_DELAY = 30.0   # seconds between flush attempts while the database is failing
+
+class HistoryWriter:
+    """Per-worker write-behind queue - write(entries, charge) does the actual insert"""
+
+    def __init__(self, write, spool_dir):
+        self.write = write
+        self.spool_dir = spool_dir
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()   # one flush at a time - the thread or drain()
+        self._pid = None
+
+        self._queued = 0
+        self._written = 0
+        self._failed_flushes = 0
+        self._replayed = 0
+        self._last_error = None
+
+    def _spool_path(self, pid):
+        return os.path.join(self.spool_dir, f"history-{pid}.spool")
+
+    def _start(self):
+        """Fresh queue, spool and flush thread for this process - call with _lock held"""
+        self._pid = os.getpid()
+        self._items = []
+        self._stopping = False
+        self._retry_delay = 0.0
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = self._spool_path(self._pid)
+        if os.path.exists(path):
+            # Left by an earlier process with the same pid - replay it with the other orphans
+            os.rename(path, self._claimed_path())
+        self._spool = open(path, 'a', encoding='utf-8')
+
+        thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        thread.start()
+
+    def _claimed_path(self):
+        return os.path.join(self.spool_dir, f"history-{os.getpid()}.{uuid.uuid4().hex}.spool")
+
+    def enqueue(self, entry, charge=False):
+        """Queue one ScanHistoryRepo.dated_entry() row - charge also counts it against the quota"""
+        item = {'entry': list(entry), 'charge': charge}
+        line = json.dumps(item, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            self._spool.write(line)
+            self._spool.flush()
+            self._items.append(item)
+            self._queued += 1
+            if len(self._items) >= HISTORY_BATCH_SIZE:
+                self._wakeup.notify()
+
+    def _run(self):
+        self.replay()
+
+        while True:
+            with self._lock:
+                if self._pid != os.getpid() or self._stopping:
+                    return
+                if len(self._items) < HISTORY_BATCH_SIZE:
+                    self._wakeup.wait(max(HISTORY_FLUSH_INTERVAL, self._retry_delay))
+                if self._pid != os.getpid() or self._stopping:
+                    return
+
+            if not self.flush():
+                self._retry_delay = min(max(self._retry_delay * 2, HISTORY_FLUSH_INTERVAL), MAX_RETRY_DELAY)
+            else:
+                self._retry_delay = 0.0
+
+    def flush(self):
+        """Write everything queued so far, a batch at a time - False if the database failed"""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if self._pid != os.getpid() or not self._items:
+                        return True
+                    batch = self._items[:HISTORY_BATCH_SIZE]
+
+                try:
+                    self.write([item['entry'] for item in batch], [item['charge'] for item in batch])
+                except Exception as e:
+                    with self._lock:
+                        self._failed_flushes += 1
+                        self._last_error = str(e)
+                    print(f"DEBUG: History flush of {len(batch)} rows failed, will retry: {e}")
+                    return False
+
+                with self._lock:
+                    # Only flush() removes items, so the batch is still at the front
+                    del self._items[:len(batch)]
+                    self._written += len(batch)
+                    self._rewrite_spool()
+
+    def _rewrite_spool(self):
+        """Replace the spool with the rows still queued - call with _lock held"""
+        path = self._spool_path(self._pid)
+        if not self._items:
+            self._spool.truncate(0)
+            self._spool.seek(0)
+            return
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as temp:
+            for item in self._items:
+                temp.write(json.dumps(item, separators=(',', ':')) + '\n')
+        os.replace(temp_path, path)
+        self._spool.close()
+        self._spool = open(path, 'a', encoding='utf-8')
+
+    def drain(self):
+        """Stop the flush thread and write out everything queued - the spool is kept if that fails"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return True
+            self._stopping = True
+            self._wakeup.notify()
+            pending = len(self._items)
+
+        if not pending:
+            return True
+        print(f"INFO: Draining {pending} queued history rows")
+        if not self.flush():
+            print(f"INFO: History drain failed - {self.pending()} rows left in {self._spool_path(self._pid)}")
+            return False
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._items) if self._pid == os.getpid() else 0
+
+    def replay(self):
+        """Claim and write the spools of processes that are no longer running - returns rows replayed"""
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, 'history-*.spool'))):
+            owner = os.path.basename(path)[len('history-'):].split('.', 1)[0]
+            if not owner.isdigit() or path == self._spool_path(os.getpid()):
+                continue
+            # Our own claimed files are fair game - they are left over from an earlier pid
+            if int(owner) != os.getpid() and _pid_alive(int(owner)):
+                continue
+
+            claimed = self._claimed_path()
+            try:
+                os.rename(path, claimed)   # atomic - only one process wins an orphaned spool
+            except FileNotFoundError:
+                continue
+
+            items = []
+            with open(claimed, encoding='utf-8') as spool:
+                for line in spool:
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        pass   # torn last line from a crash mid-write
+
+            try:
+                for start in range(0, len(items), HISTORY_BATCH_SIZE):
+                    batch = items[start:start + HISTORY_BATCH_SIZE]
+                    self.write([item['entry'] for item in batch], [item['charge'] for item in batch])
+            except Exception as e:
+                print(f"DEBUG: History spool replay of {claimed} failed, kept for the next start: {e}")
+                continue
+
+            os.remove(claimed)
+            replayed += len(items)
+
+        if replayed:
+            print(f"INFO: Replayed {replayed} history rows from orphaned spools")
+            with self._lock:
+                self._replayed += replayed
+        return replayed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': HISTORY_WRITE_BEHIND,
+                'pending': len(self._items) if self._pid == os.getpid() else 0,
+                'queued': self._queued,
+                'written': self._written,
+                'replayed': self._replayed,
+                'failed_flushes': self._failed_flushes,
+                'last_error': self._last_error,
+            }
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+_writer = None
+
+def configure(write):
+    """Set the batch writer - ScanHistoryRepo.add_many"""
+    global _writer
+    if HISTORY_WRITE_BEHIND and not HISTORY_SPOOL_DIR:
+        raise RuntimeError("HISTORY_WRITE_BEHIND=true needs HISTORY_SPOOL_DIR on persistent storage - "
+                           "queued history rows would not survive a restart")
+    _writer = HistoryWriter(write, HISTORY_SPOOL_DIR)
+
+def enabled():
+    return HISTORY_WRITE_BEHIND and _writer is not None
+
+def enqueue(entry, charge=False):
+    _writer.enqueue(entry, charge)
+
+def replay():
+    """Write any spools left by dead processes - run once at start-up"""
+    if _writer is None or not HISTORY_SPOOL_DIR or not os.path.isdir(HISTORY_SPOOL_DIR):
+        return 0
+    return _writer.replay()
+
+def drain():
+    """Flush this process's queue before it exits"""
+    if _writer is None:
+        return True
+    return _writer.drain()
+
+def stats():
+    return _writer.stats() if _writer is not None else {'enabled': False}
+
+atexit.register(drain)
@@ -0,0 +1,277 @@
+# image_asset.py - One upload, opened once per scan
+#
+# Every stage of a scan - admission, OCR renditions, the Tesseract fallback and the
+# history renditions - reads from the same ImageAsset, so the upload is parsed once
+# and decoded at most once. Everything is computed lazily and cached on the asset;
+# close() releases the pixels and removes any rendition temp files.
+
+import hashlib
+import os
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps
+
+import scratch
+
+# History renditions: name -> (longest side in px, WebP quality). 'thumb' is what the
+# history cards show, 'medium' is what the image modal opens.
+RENDITIONS = {
+    'thumb': (320, 70),
+    'medium': (1280, 78),
+}
+
+# What retention.py keeps of an original once it is archived - still enough for OCR
+ARCHIVE_RENDITION = (2048, 80)
+
+EXIF_ORIENTATION = 0x0112
+
+def draft_request(size, max_dim):
+    """Aspect-preserving box to pass to draft() - a square box would let the short side
+    keep the whole image at full size"""
+    width, height = size
+    scale = max_dim / max(width, height)
+    return (max(1, int(width * scale)), max(1, int(height * scale)))
+
+def draft_size(size, max_dim):
+    """Size a JPEG decodes to in draft mode - Pillow only reduces by 1/2, 1/4 or 1/8"""
+    width, height = size
+    if not max_dim or max(width, height) <= max_dim:
+        return size
+
+    requested = draft_request(size, max_dim)
+    ratio = min(width // requested[0], height // requested[1])
+    factor = next(f for f in (8, 4, 2, 1) if ratio >= f)
+    return (-(-width // factor), -(-height // factor))
+
+def render_jpeg(source, max_dim, max_size_kb, quality_levels, output_path):
+    """Downscale source and save the best JPEG quality that fits the budget - returns KB written"""
+    width, height = source.size
+    rendition = source
+
+    if max(width, height) > max_dim:
+        scale = max_dim / max(width, height)
+        rendition = source.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.Resampling.LANCZOS)
+
+    try:
+        result_size_kb = 0
+        for quality in quality_levels:
+            rendition.save(output_path, 'JPEG', quality=quality, optimize=True)
+            result_size_kb = os.path.getsize(output_path) / 1024
+
+            if result_size_kb <= max_size_kb:
+                break
+
+        print(f"DEBUG: Rendition {rendition.size[0]}x{rendition.size[1]} at quality {quality}: {result_size_kb:.1f} KB")
+        return result_size_kb
+
+    finally:
+        if rendition is not source:
+            rendition.close()
+
+def render_webp(source, max_dim, quality, output_path):
+    """Save source downscaled to max_dim as WebP - returns bytes written"""
+    rendition = source.copy() if max(source.size) > max_dim else source
+    try:
+        if rendition is not source:
+            rendition.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+        rendition.save(output_path, 'WEBP', quality=quality, method=4)
+    finally:
+        if rendition is not source:
+            rendition.close()
+    return os.path.getsize(output_path)
+
+def render_file(source_path, name, output_path):
+    """Make a history rendition of a stored image - decodes only as much as the rendition needs"""
+    max_dim, quality = RENDITIONS[name]
+    with ImageAsset(source_path, decode_dim=max_dim) as asset:
+        return render_webp(asset.image(), max_dim, quality, output_path)
+
+def render_archive(source_path, output_path):
+    """WebP that replaces an archived original - returns bytes written"""
+    max_dim, quality = ARCHIVE_RENDITION
+    with ImageAsset(source_path, decode_dim=max_dim) as asset:
+        return render_webp(asset.image(), max_dim, quality, output_path)
+
+class ImageAsset:
+    """An uploaded image whose header, pixels, hash and renditions are computed once"""
+
+    def __init__(self, path, decode_dim=None):
+        self.path = path
+        self.decode_dim = decode_dim   # largest dimension any stage needs - decode never exceeds it
+        self._image = None             # lazily opened PIL image, header only until decoded
+        self._header = None            # (size, mode, format, orientation) of the original
+        self._decoded = None
+        self._grayscale = None
+        self._content_hash = None
+        self._file_size_kb = None
+        self._renditions = {}
+        self._temp_paths = []
+        self._on_decoded = []          # callbacks run with the pixels once they are decoded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self):
+        if self._image is None:
+            self._image = Image.open(self.path)
+            if self._header is None:
+                # Captured before draft() can change the reported size
+                orientation = self._image.getexif().get(EXIF_ORIENTATION, 1)
+                self._header = (self._image.size, self._image.mode, self._image.format, orientation)
+        return self._image
+
+    def _read_header(self):
+        if self._header is None:
+            self._open()
+        return self._header
+
+    @property
+    def size(self):
+        """Original (width, height) from the header - no pixel decode"""
+        return self._read_header()[0]
+
+    @property
+    def mode(self):
+        return self._read_header()[1]
+
+    @property
+    def format(self):
+        return self._read_header()[2]
+
+    @property
+    def orientation(self):
+        """EXIF orientation tag (1 = upright)"""
+        return self._read_header()[3]
+
+    @property
+    def file_size_kb(self):
+        if self._file_size_kb is None:
+            self._file_size_kb = os.path.getsize(self.path) / 1024
+        return self._file_size_kb
+
+    @property
+    def content_hash(self):
+        """SHA-256 of the uploaded bytes"""
+        if self._content_hash is None:
+            with open(self.path, 'rb') as f:
+                self._content_hash = hashlib.file_digest(f, 'sha256').hexdigest()
+        return self._content_hash
+
+    @property
+    def decode_size(self):
+        """Size the pixels will actually be decoded at (JPEG draft mode reduces at decode time)"""
+        if self.format == 'JPEG':
+            return draft_size(self.size, self.decode_dim)
+        return self.size
+
+    def limit_decode(self, max_dim):
+        """Cap the decode size - only effective before the first decode"""
+        if self._decoded is not None:
+            return
+        self.decode_dim = min(self.decode_dim, max_dim) if self.decode_dim else max_dim
+
+    def image(self):
+        """Decoded, EXIF-oriented RGB/L pixels - decoded on first use, then cached"""
+        if self._decoded is None:
+            img = self._open()
+            orientation = self.orientation
+
+            if self.decode_dim and self.format == 'JPEG' and max(self.size) > self.decode_dim:
+                img.draft('RGB', draft_request(self.size, self.decode_dim))
+                if img.size != self.decode_size:
+                    # Admission reserved memory for decode_size - the thumbnail below still
+                    # brings the pixels down to decode_dim, but say the estimate was off
+                    print(f"WARNING: Draft decoded {os.path.basename(self.path)} at {img.size[0]}x{img.size[1]}, "
+                          f"admission expected {self.decode_size[0]}x{self.decode_size[1]}")
+            img.load()
+
+            if orientation != 1:
+                ImageOps.exif_transpose(img, in_place=True)
+
+            if img.mode not in ('RGB', 'L'):
+                converted = img.convert('RGB')
+                img.close()
+                img = converted
+
+            # Formats without draft support decode at full size (and a draft can come out larger
+            # than expected) - shrink before anything else runs
+            if self.decode_dim and max(img.size) > self.decode_dim:
+                img.thumbnail((self.decode_dim, self.decode_dim), Image.Resampling.LANCZOS)
+
+            self._image = None
+            self._decoded = img
+            print(f"DEBUG: Decoded {os.path.basename(self.path)} once: {img.size[0]}x{img.size[1]}, mode: {img.mode}")
+            for callback in self._on_decoded:
+                callback(img)
+
+        return self._decoded
+
+    def after_decode(self, callback):
+        """Call callback(pixels) once the image has been decoded (now, if it already has)"""
+        if self._decoded is not None:
+            callback(self._decoded)
+        else:
+            self._on_decoded.append(callback)
+
+    def grayscale(self):
+        """Cached single-channel copy for Tesseract"""
+        if self._grayscale is None:
+            img = self.image()
+            self._grayscale = img if img.mode == 'L' else img.convert('L')
+        return self._grayscale
+
+    def _temp_path(self, label, extension):
+        path = scratch.path(f"asset_{label}{extension}")
+        self._temp_paths.append(path)
+        return path
+
+    def ocr_rendition(self, max_dim, max_size_kb, quality_levels):
+        """(path, size_kb) of a JPEG no larger than max_dim that fits max_size_kb - cached per budget"""
+        key = (max_dim, max_size_kb)
+
+        if key not in self._renditions:
+            if (self.file_size_kb <= max_size_kb and max(self.size) <= max_dim
+                    and self.orientation == 1 and self.format in ('JPEG', 'PNG')):
+                # Original already fits - upload it untouched
+                print(f"DEBUG: Original fits {max_dim}px / {max_size_kb} KB, no rendition needed")
+                self._renditions[key] = (self.path, self.file_size_kb)
+            else:
+                path = self._temp_path(f"ocr_{max_dim}", '.jpg')
+                self._renditions[key] = (path, render_jpeg(self.image(), max_dim, max_size_kb, quality_levels, path))
+
+        return self._renditions[key]
+
+    def save_rendition(self, name, output_path):
+        """Write a history rendition (RENDITIONS) from the decoded pixels - returns bytes written"""
+        max_dim, quality = RENDITIONS[name]
+        return render_webp(self.image(), max_dim, quality, output_path)
+
+    def close(self):
+        for img in (self._grayscale, self._decoded, self._image):
+            if img is not None:
+                try:
+                    img.close()
+                except Exception:
+                    pass
+        self._grayscale = self._decoded = self._image = None
+
+        for path in self._temp_paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"DEBUG: Asset temp cleanup error: {e}")
+        self._temp_paths = []
+        self._renditions = {}
+
+@contextmanager
+def open_asset(image, decode_dim=None):
+    """Yield an ImageAsset for a path, or the asset itself if a caller already opened one"""
+    if isinstance(image, ImageAsset):
+        yield image
+    else:
+        with ImageAsset(image, decode_dim=decode_dim) as asset:
+            yield asset
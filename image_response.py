@@ -0,0 +1,62 @@
+# image_response.py - Responses for saved scan images
+#
+# Scan images are only served after the route's auth check, so they are always
+# Cache-Control: private. Blob-store files are named by content (blob_store.py), so
+# their name is a strong ETag and they are cached as immutable for a year - a
+# history view revalidates nothing and downloads nothing it already has. Per-user
+# uploads from before the blob store are never rewritten either, but get a
+# shorter max-age and werkzeug's mtime/size ETag. Both answer If-None-Match with
+# 304 and support Range requests.
+#
+# IMAGE_OFFLOAD moves the byte streaming out of the (few, sync) gunicorn workers to
+# the fronting server once Flask has authorized the request:
+#
+#     x-accel-redirect   nginx - X-Accel-Redirect: IMAGE_ACCEL_PREFIX/blobs/... or
+#                        .../uploads/..., which need `internal` locations aliased to
+#                        BLOB_STORE_DIR and static/uploads
+#     x-sendfile         Apache mod_xsendfile / lighttpd - X-Sendfile: absolute path
+#
+# Unset (the default), Flask streams the file itself.
+
+import mimetypes
+import os
+
+from flask import Response, request, send_file
+
+IMAGE_OFFLOAD = os.getenv('IMAGE_OFFLOAD', '').lower()                    # '', 'x-accel-redirect' or 'x-sendfile'
+IMAGE_ACCEL_PREFIX = os.getenv('IMAGE_ACCEL_PREFIX', '/_protected').rstrip('/')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+UPLOAD_MAX_AGE = int(os.getenv('UPLOAD_MAX_AGE', '86400'))
+
+if IMAGE_OFFLOAD not in ('', 'x-accel-redirect', 'x-sendfile'):
+    print(f"WARNING: Unknown IMAGE_OFFLOAD '{IMAGE_OFFLOAD}' - serving images from Flask")
+
+def send_image(path, accel_path, immutable=False):
+    """Response for an authorized image request
+
+    accel_path is the file's path below IMAGE_ACCEL_PREFIX (e.g. 'blobs/ab/cd/...').
+    """
+    etag = os.path.splitext(os.path.basename(path))[0] if immutable else True
+    max_age = IMMUTABLE_MAX_AGE if immutable else UPLOAD_MAX_AGE
+
+    if IMAGE_OFFLOAD in ('x-accel-redirect', 'x-sendfile'):
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if IMAGE_OFFLOAD == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = f"{IMAGE_ACCEL_PREFIX}/{accel_path}"
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        if immutable:
+            response.set_etag(etag)
+        else:
+            response.last_modified = os.path.getmtime(path)
+        response.cache_control.max_age = max_age
+        # 304s are answered here; the fronting server does Range on the file itself
+        response = response.make_conditional(request)
+    else:
+        response = send_file(path, conditional=True, etag=etag, max_age=max_age)
+        response.accept_ranges = 'bytes'
+
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = immutable
+    return response
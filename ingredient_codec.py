@@ -0,0 +1,99 @@
+# ingredient_codec.py - Compact storage format for a scan's ingredient matches
+#
+# match_all_ingredients() returns category -> ingredient-name lists plus an all_detected
+# union and a has_safety_labels flag. scan_history used to store that dict as JSON
+# (several hundred bytes a row, mostly repeated key names and ingredient strings).
+# Rows now store a small JSON array:
+#
+#     [version, flags, code, code, ...]
+#
+#     version  scanner_config.INGREDIENT_DICTIONARY_VERSION used to encode the row
+#     flags    bit 0 = has_safety_labels
+#     code     ingredient_id << 6 | category bits, where ingredient_id indexes
+#              scanner_config.INGREDIENT_DICTIONARY and bit i is CATEGORIES[i];
+#              a name missing from the dictionary is stored as [name, bits]
+#
+# all_detected is the union of the categories, so it isn't stored. The dictionary is
+# append-only, so rows encoded with any earlier version still decode.
+
+import json
+
+from scanner_config import INGREDIENT_DICTIONARY, INGREDIENT_DICTIONARY_VERSION
+
+CATEGORIES = ('trans_fat', 'excitotoxins', 'corn', 'sugar', 'sugar_safe', 'gmo')   # bit i = CATEGORIES[i]
+CATEGORY_BITS = 6
+CATEGORY_MASK = (1 << CATEGORY_BITS) - 1
+
+FLAG_SAFETY_LABELS = 1
+
+_INGREDIENT_IDS = {name: index for index, name in enumerate(INGREDIENT_DICTIONARY)}
+# Category names for every possible bit pattern - decode does one lookup per ingredient
+_MASK_CATEGORIES = [tuple(category for position, category in enumerate(CATEGORIES) if mask & (1 << position))
+                    for mask in range(CATEGORY_MASK + 1)]
+
+def encode(matched):
+    """Compact list for a match_all_ingredients() dict"""
+    if not isinstance(matched, dict):
+        return [INGREDIENT_DICTIONARY_VERSION, 0]
+
+    bits = {}
+    for position, category in enumerate(CATEGORIES):
+        for name in matched.get(category) or ():
+            bits[name] = bits.get(name, 0) | (1 << position)
+
+    # Older rows can list ingredients only under all_detected - keep them with no category
+    for name in matched.get('all_detected') or ():
+        bits.setdefault(name, 0)
+
+    known = sorted((_INGREDIENT_IDS[name] << CATEGORY_BITS) | mask for name, mask in bits.items() if name in _INGREDIENT_IDS)
+    unknown = sorted([name, mask] for name, mask in bits.items() if name not in _INGREDIENT_IDS)
+
+    flags = FLAG_SAFETY_LABELS if matched.get('has_safety_labels') else 0
+    return [INGREDIENT_DICTIONARY_VERSION, flags] + known + unknown
+
+def dumps(matched):
+    """encode() as the JSON text written to scan_history.ingredients_found"""
+    return json.dumps(encode(matched), separators=(',', ':'))
+
+def category_mask(stored):
+    """OR of the category bits of every ingredient in a compact row"""
+    mask = 0
+    for code in stored[2:]:
+        mask |= code[1] if isinstance(code, list) else code & CATEGORY_MASK
+    return mask
+
+def decode(stored):
+    """match_all_ingredients()-shaped dict from a compact row (list or JSON text)
+
+    Dicts from before the compact format are returned as they are; anything
+    unreadable decodes to {}.
+    """
+    if isinstance(stored, str):
+        try:
+            stored = json.loads(stored)
+        except ValueError:
+            return {}
+
+    if isinstance(stored, dict):
+        return stored
+    if not isinstance(stored, list) or len(stored) < 2:
+        return {}
+
+    matched = {category: [] for category in CATEGORIES}
+    detected = []
+
+    for code in stored[2:]:
+        if isinstance(code, list):
+            name, mask = code
+        else:
+            ingredient_id, mask = code >> CATEGORY_BITS, code & CATEGORY_MASK
+            # Written by a newer dictionary than this process has (e.g. during a rollback)
+            name = INGREDIENT_DICTIONARY[ingredient_id] if ingredient_id < len(INGREDIENT_DICTIONARY) else f"ingredient #{ingredient_id}"
+
+        detected.append(name)
+        for category in _MASK_CATEGORIES[mask]:
+            matched[category].append(name)
+
+    matched['all_detected'] = detected
+    matched['has_safety_labels'] = bool(stored[1] & FLAG_SAFETY_LABELS)
+    return matched
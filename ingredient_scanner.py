@@ -1,352 +1,80 @@
 import re
 import os
-import gc
 from scanner_config import *
 import requests
-from PIL import Image, ImageOps, ImageEnhance
+from PIL import Image
 
-import gc
-import psutil  # Add this for memory monitoring
-import os
-import tempfile
 import time
-from PIL import Image
-import requests
+import memory_governor
+import request_deadline
+import resource_profile
+from image_asset import open_asset
+
+# Every tier-dependent threshold comes from the resource profile loaded at startup
+PROFILE = resource_profile.PROFILE
+
+# OCR.space endpoint - point at a stub server for load tests
+OCR_SPACE_URL = os.getenv('OCR_SPACE_URL', 'https://api.ocr.space/parse/image')
+
+# Progressive OCR - send a small rendition first and only escalate when the text looks poor
+OCR_PROGRESSIVE = os.getenv('OCR_PROGRESSIVE', 'true').lower() != 'false'
 
-# Professional tier detection
-PROFESSIONAL_TIER = os.getenv('RENDER_TIER') == 'professional' or int(os.getenv('WEB_CONCURRENCY', '1')) > 1
+# Largest image any OCR step needs - uploads are never decoded above this
+OCR_DECODE_DIM = max(max_dim for max_dim, _ in PROFILE.progressive_ocr_steps)
 
-if PROFESSIONAL_TIER:
-    print("✅ PROFESSIONAL TIER DETECTED in ingredient_scanner - Using enhanced thresholds")
-    MEMORY_THRESHOLD = 2000  # 2GB
-    COMPRESSION_THRESHOLD = 1000  # 1MB
-else:
-    print("ℹ️ Free tier detected - Using conservative thresholds")
-    MEMORY_THRESHOLD = 120   # 120MB
-    COMPRESSION_THRESHOLD = 300  # 300KB
+memory_governor.configure(threshold_mb=PROFILE.memory_threshold_mb, growth_mb=PROFILE.gc_growth_mb)
+
+# Set PIL limits once at import - mutating them per request is not thread safe
+Image.MAX_IMAGE_PIXELS = PROFILE.max_image_pixels
 
 # Enhanced memory monitoring function
-def log_memory_usage(stage="", force_gc=False):
-    """Enhanced memory monitoring with professional tier support"""
+def log_memory_usage(stage=""):
+    """Cheap RSS sample - the memory governor collects only when the budget is exceeded"""
     try:
-        if force_gc:
-            iterations = 2 if PROFESSIONAL_TIER else 3
-            for _ in range(iterations):
-                gc.collect()
-            time.sleep(0.05 if PROFESSIONAL_TIER else 0.1)
-        
-        process = psutil.Process()
-        memory_mb = process.memory_info().rss / 1024 / 1024
+        memory_mb = memory_governor.check(stage)
         print(f"DEBUG: Memory usage {stage}: {memory_mb:.1f} MB")
-        
-        # Use tier-appropriate threshold
-        threshold = MEMORY_THRESHOLD
-        if memory_mb > threshold:
-            print(f"DEBUG: High memory usage! Forcing cleanup...")
-            for _ in range(3):
-                gc.collect()
-            time.sleep(0.1)
-            
-            memory_mb = process.memory_info().rss / 1024 / 1024
-            print(f"DEBUG: Memory after cleanup: {memory_mb:.1f} MB")
-            
         return memory_mb
     except Exception as e:
         print(f"DEBUG: Memory monitoring error: {e}")
         return 0
 
-def aggressive_cleanup():
-    """Ultra-aggressive memory cleanup"""
+def aggressive_cleanup(stage="cleanup"):
+    """Budgeted cleanup - a single collection, and only when memory is actually high"""
     try:
-        # Force multiple garbage collection cycles
-        iterations = 3 if PROFESSIONAL_TIER else 5
-        for _ in range(iterations):
-            gc.collect()
-        
-        # Clear PIL cache
-        max_pixels = 50000000 if PROFESSIONAL_TIER else 30000000
-        Image.MAX_IMAGE_PIXELS = max_pixels
-        
-        # Force Python to release memory back to OS (if possible)
-        if hasattr(gc, 'set_threshold'):
-            gc.set_threshold(0, 0, 0)  # Disable automatic GC temporarily
-            gc.collect()
-            gc.set_threshold(700, 10, 10)  # Re-enable with aggressive settings
-        
-        print("DEBUG: Aggressive cleanup completed")
+        memory_governor.check(stage)
     except Exception as e:
         print(f"DEBUG: Cleanup error: {e}")
 
-def ultra_minimal_compress(image_path, max_size_kb=None):
-    """Ultra-minimal compression with tier-appropriate settings"""
-    if max_size_kb is None:
-        max_size_kb = 500 if PROFESSIONAL_TIER else 60
-        
-    log_memory_usage("before ultra minimal", force_gc=True)
-    
-    temp_path = None
-    img = None
-    
-    try:
-        current_size_kb = os.path.getsize(image_path) / 1024
-        print(f"DEBUG: Ultra minimal - current size: {current_size_kb:.1f} KB")
-        
-        if current_size_kb <= max_size_kb:
-            print("DEBUG: Size OK, no compression needed")
-            return image_path
-        
-        temp_dir = tempfile.gettempdir()
-        prefix = "pro_ultra" if PROFESSIONAL_TIER else "ultra"
-        temp_path = os.path.join(temp_dir, f"{prefix}_compressed_{int(time.time())}.jpg")
-        
-        with Image.open(image_path) as img:
-            width, height = img.size
-            mode = img.mode
-            
-            print(f"DEBUG: Original: {width}x{height}, mode: {mode}")
-            
-            # Tier-appropriate downsizing
-            if PROFESSIONAL_TIER:
-                max_dim = min(600, max(width, height) // 3)
-                min_width, min_height = 300, 200
-            else:
-                max_dim = min(300, max(width, height) // 4)
-                min_width, min_height = 150, 100
-            
-            if width > height:
-                new_width = max_dim
-                new_height = int(height * max_dim / width)
-            else:
-                new_height = max_dim
-                new_width = int(width * max_dim / height)
-            
-            new_width = max(new_width, min_width)
-            new_height = max(new_height, min_height)
-            
-            print(f"DEBUG: Target size: {new_width}x{new_height}")
-            
-            # Convert mode if necessary
-            if mode in ('RGBA', 'LA', 'P'):
-                img = img.convert('RGB')
-                log_memory_usage("after mode conversion")
-            
-            # Single resize operation
-            img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Clear original reference
-            img.close()
-            del img
-            img = None
-            gc.collect()
-            log_memory_usage("after resize")
-            
-            # Tier-appropriate quality levels
-            if PROFESSIONAL_TIER:
-                quality_levels = [25, 20, 15, 12, 10]
-            else:
-                quality_levels = [15, 12, 10, 8]
-            
-            for quality in quality_levels:
-                img_resized.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=False)
-                
-                result_size_kb = os.path.getsize(temp_path) / 1024
-                print(f"DEBUG: Ultra quality {quality}: {result_size_kb:.1f} KB")
-                
-                if result_size_kb <= max_size_kb:
-                    print(f"✅ Ultra success at quality {quality}: {result_size_kb:.1f} KB")
-                    img_resized.close()
-                    del img_resized
-                    gc.collect()
-                    return temp_path
-            
-            # Final attempt with lowest quality
-            img_resized.save(temp_path, 'JPEG', quality=5, optimize=True, progressive=False)
-            result_size_kb = os.path.getsize(temp_path) / 1024
-            print(f"DEBUG: Final result: {result_size_kb:.1f} KB")
-            
-            img_resized.close()
-            del img_resized
-            gc.collect()
-            
-            return temp_path
-            
-    except Exception as e:
-        print(f"DEBUG: Ultra minimal compression failed: {e}")
-        
-        # Emergency cleanup
-        if img:
-            try:
-                img.close()
-            except:
-                pass
-        
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-        
-        gc.collect()
-        return image_path
-    
-    finally:
-        if img:
-            try:
-                img.close()
-            except:
-                pass
-        gc.collect()
-        log_memory_usage("end ultra minimal", force_gc=True)
-
-def compress_image_for_ocr(image_path, max_size_kb=None):
-    """Tier-appropriate image compression for OCR"""
-    if max_size_kb is None:
-        max_size_kb = 500 if PROFESSIONAL_TIER else 80
-        
-    print(f"DEBUG: {'Professional' if PROFESSIONAL_TIER else 'Standard'} tier compression for {image_path}")
-    log_memory_usage("start compression", force_gc=True)
-    
-    try:
-        # Quick size check
-        current_size_kb = os.path.getsize(image_path) / 1024
-        print(f"DEBUG: Current size: {current_size_kb:.1f} KB, target: {max_size_kb} KB")
-        
-        if current_size_kb <= max_size_kb:
-            print("DEBUG: Size acceptable, no compression needed")
-            return image_path
-        
-        # Tier-appropriate threshold for ultra-minimal compression
-        ultra_threshold = COMPRESSION_THRESHOLD
-        if current_size_kb > ultra_threshold:
-            print(f"DEBUG: Large file detected ({current_size_kb:.1f}KB > {ultra_threshold}KB), using ultra-minimal compression")
-            return ultra_minimal_compress(image_path, max_size_kb)
-        
-        # Standard compression with tier-appropriate settings
-        prefix = "pro" if PROFESSIONAL_TIER else "std"
-        temp_path = os.path.join(tempfile.gettempdir(), f"{prefix}_compressed_{int(time.time())}.jpg")
-        
-        try:
-            with Image.open(image_path) as original:
-                width, height = original.size
-                
-                # Tier-appropriate scaling
-                scale_factor_exp = 0.3 if PROFESSIONAL_TIER else 0.4
-                scale_factor = min(1.0, (max_size_kb / current_size_kb) ** scale_factor_exp)
-                
-                if PROFESSIONAL_TIER:
-                    target_width = max(int(width * scale_factor), 400)
-                    target_height = max(int(height * scale_factor), 300)
-                else:
-                    target_width = max(int(width * scale_factor), 200)
-                    target_height = max(int(height * scale_factor), 150)
-                
-                print(f"DEBUG: Scaling {width}x{height} -> {target_width}x{target_height}")
-                
-                # Convert mode if necessary
-                if original.mode in ('RGBA', 'LA', 'P'):
-                    original = original.convert('RGB')
-                
-                # Resize with quality preservation
-                resized = original.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                
-                # Force cleanup
-                original.close()
-                gc.collect()
-                log_memory_usage("after resize")
-                
-                # Tier-appropriate quality levels
-                if PROFESSIONAL_TIER:
-                    quality_levels = [70, 60, 50, 40, 30, 25, 20]
-                else:
-                    quality_levels = [30, 25, 20, 15, 12]
-                
-                for quality in quality_levels:
-                    resized.save(temp_path, 'JPEG', quality=quality, optimize=True)
-                    
-                    result_size_kb = os.path.getsize(temp_path) / 1024
-                    print(f"DEBUG: Quality {quality}: {result_size_kb:.1f} KB")
-                    
-                    if result_size_kb <= max_size_kb:
-                        print(f"✅ Compression success at quality {quality}: {result_size_kb:.1f} KB")
-                        resized.close()
-                        gc.collect()
-                        return temp_path
-                
-                # If standard compression fails, try ultra-minimal
-                resized.close()
-                gc.collect()
-                
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                
-                print("DEBUG: Standard compression failed, trying ultra-minimal")
-                return ultra_minimal_compress(image_path, max_size_kb)
-                
-        except Exception as e:
-            print(f"DEBUG: Compression error: {e}")
-            gc.collect()
-            
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-            
-            return ultra_minimal_compress(image_path, max_size_kb)
-    
-    except Exception as e:
-        print(f"DEBUG: Compression completely failed: {e}")
-        gc.collect()
-        return image_path
-    
-    finally:
-        gc.collect()
-        log_memory_usage("end compression", force_gc=True)
-
-def safe_ocr_with_fallback(image_path, max_attempts=None):
-    """Safe OCR with circuit breaker - tier appropriate"""
+def safe_ocr_with_fallback(image, max_attempts=None):
+    """Safe OCR with circuit breaker - takes an ImageAsset so renditions survive retries"""
     if max_attempts is None:
-        max_attempts = 3 if PROFESSIONAL_TIER else 2
+        max_attempts = PROFILE.ocr_attempts
         
-    print(f"DEBUG: Starting {'professional' if PROFESSIONAL_TIER else 'standard'} OCR with {max_attempts} attempts")
+    print(f"DEBUG: Starting {PROFILE.name} OCR with {max_attempts} attempts")
     
     for attempt in range(max_attempts):
+        # Out of request time - raises to with_timeout instead of starting another attempt
+        request_deadline.check(f"OCR attempt {attempt + 1}")
         try:
             print(f"DEBUG: OCR attempt {attempt + 1}/{max_attempts}")
             
-            # Tier-appropriate memory check
-            memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
-            memory_limit = 1500 if PROFESSIONAL_TIER else 150
-            
-            if memory_mb > memory_limit:
-                print(f"DEBUG: High memory usage ({memory_mb:.1f}MB), forcing cleanup")
-                aggressive_cleanup()
-                time.sleep(0.5)
-                
-                # Check again after cleanup
-                memory_mb = psutil.Process().memory_info().rss / 1024 / 1024
-                critical_limit = 2000 if PROFESSIONAL_TIER else 200
-                
-                if memory_mb > critical_limit:
-                    print(f"DEBUG: Memory still very high ({memory_mb:.1f}MB), skipping attempt")
-                    if attempt == max_attempts - 1:
-                        return ""
-                    continue
-            
-            # OCR with tier-appropriate timeout
-            import signal
-            
-            def ocr_timeout_handler(signum, frame):
-                raise TimeoutError("OCR timeout")
+            # Tier-appropriate memory check - the governor collects once if over budget
+            memory_mb = log_memory_usage(f"OCR attempt {attempt + 1}")
+            critical_limit = PROFILE.memory_critical_mb
             
-            old_handler = signal.signal(signal.SIGALRM, ocr_timeout_handler)
-            timeout_seconds = 90 if PROFESSIONAL_TIER else 45
-            signal.alarm(timeout_seconds)
+            if memory_mb > critical_limit:
+                print(f"DEBUG: Memory still very high ({memory_mb:.1f}MB), skipping attempt")
+                if attempt == max_attempts - 1:
+                    return ""
+                continue
             
+            # OCR with tier-appropriate timeout - a per-thread deadline, never signal.alarm
             try:
-                result = extract_text_ocr_space(image_path)
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, old_handler)
+                with request_deadline.limit(PROFILE.ocr_timeout):
+                    if OCR_PROGRESSIVE:
+                        result = extract_text_ocr_space_progressive(image)
+                    else:
+                        result = extract_text_ocr_space(image)
                 
                 if result and len(result.strip()) > 3:
                     print(f"DEBUG: OCR successful on attempt {attempt + 1}")
@@ -355,12 +83,12 @@ def safe_ocr_with_fallback(image_path, max_attempts=None):
                     print(f"DEBUG: OCR returned empty result on attempt {attempt + 1}")
                     
             except TimeoutError:
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, old_handler)
                 print(f"DEBUG: OCR timed out on attempt {attempt + 1}")
                 aggressive_cleanup()
                 
-                if attempt == max_attempts - 1:
+                # Out of request time too - further attempts would time out at once
+                remaining = request_deadline.remaining()
+                if attempt == max_attempts - 1 or (remaining is not None and remaining <= 0):
                     return ""
                 continue
                 
@@ -372,49 +100,45 @@ def safe_ocr_with_fallback(image_path, max_attempts=None):
                 print("DEBUG: All OCR attempts failed")
                 return ""
             
-            wait_time = 1 if PROFESSIONAL_TIER else 2
-            time.sleep(wait_time)
+            remaining = request_deadline.remaining()
+            time.sleep(PROFILE.ocr_retry_wait if remaining is None else max(0, min(PROFILE.ocr_retry_wait, remaining)))
     
     return ""
 
-def extract_text_with_multiple_methods(image_path):
-    """Main text extraction with tier-appropriate methods"""
+def extract_text_with_multiple_methods(image):
+    """Main text extraction with tier-appropriate methods - every method shares one ImageAsset"""
     try:
-        print(f"DEBUG: Starting {'professional' if PROFESSIONAL_TIER else 'standard'} OCR text extraction from {image_path}")
-        
-        # Tier-appropriate cleanup
-        aggressive_cleanup()
-        
-        # Try safe OCR with circuit breaker
-        text = safe_ocr_with_fallback(image_path)
-        
-        if text and len(text.strip()) > 5:
-            print(f"DEBUG: OCR successful - extracted {len(text)} characters")
-            return text
-        
-        # If OCR fails, try fallback
-        print("DEBUG: OCR failed, trying fallback...")
-        return extract_text_pytesseract_fallback(image_path)
+        with open_asset(image, decode_dim=OCR_DECODE_DIM) as asset:
+            print(f"DEBUG: Starting {PROFILE.name} OCR text extraction from {asset.path}")
+            
+            # Tier-appropriate cleanup
+            aggressive_cleanup()
+            
+            # Try safe OCR with circuit breaker
+            text = safe_ocr_with_fallback(asset)
+            
+            if text and len(text.strip()) > 5:
+                print(f"DEBUG: OCR successful - extracted {len(text)} characters")
+                return text
+            
+            # If OCR fails, try fallback - unless the request is already out of time
+            request_deadline.check("Tesseract fallback")
+            print("DEBUG: OCR failed, trying fallback...")
+            return extract_text_pytesseract_fallback(asset)
         
+    except TimeoutError:
+        raise
     except Exception as e:
         print(f"DEBUG: All OCR methods failed: {e}")
         aggressive_cleanup()
         return ""
 
-def extract_text_ocr_space(image_path):
-    """OCR.space extraction with tier-appropriate settings"""
-    log_memory_usage("start OCR", force_gc=True)
-    
-    processed_image_path = None
+def post_image_to_ocr_space(processed_image_path):
+    """Upload an already-compressed image to OCR.space and return the parsed text"""
     response = None
     
     try:
-        # Use tier-appropriate compression
-        max_kb = 500 if PROFESSIONAL_TIER else 80
-        processed_image_path = compress_image_for_ocr(image_path, max_size_kb=max_kb)
-        log_memory_usage("after compression", force_gc=True)
-        
-        api_url = 'https://api.ocr.space/parse/image'
+        api_url = OCR_SPACE_URL
         api_key = os.getenv('OCR_SPACE_API_KEY', 'helloworld')
         
         print(f"DEBUG: Using compressed image: {processed_image_path}")
@@ -433,8 +157,8 @@ def extract_text_ocr_space(image_path):
             'isSearchablePdfHideTextLayer': False
         }
         
-        # Make API request with tier-appropriate timeout
-        timeout = 30 if PROFESSIONAL_TIER else 20
+        # Make API request with tier-appropriate timeout, capped to the time the scan has left
+        timeout = request_deadline.timeout(PROFILE.ocr_request_timeout)
         with open(processed_image_path, 'rb') as f:
             files = {'file': f}
             print("DEBUG: Sending to OCR.space API...")
@@ -453,16 +177,7 @@ def extract_text_ocr_space(image_path):
         if response and response.status_code == 200:
             try:
                 result = response.json()
-                extracted_text = parse_ocr_space_response(result)
-                
-                # Clear response
-                response.close() if hasattr(response, 'close') else None
-                del response
-                response = None
-                gc.collect()
-                
-                return extracted_text
-                
+                return parse_ocr_space_response(result)
             except Exception as parse_error:
                 print(f"DEBUG: Response parsing error: {parse_error}")
                 return ""
@@ -470,138 +185,86 @@ def extract_text_ocr_space(image_path):
             if response:
                 print(f"DEBUG: OCR API returned status {response.status_code}")
             return ""
-            
-    except Exception as e:
-        print(f"DEBUG: OCR extraction failed: {e}")
-        return ""
     
     finally:
-        # Cleanup
         if response:
             try:
                 response.close() if hasattr(response, 'close') else None
                 del response
             except:
                 pass
-        
-        # Clean up compressed file
-        if processed_image_path and processed_image_path != image_path:
-            try:
-                os.remove(processed_image_path)
-                print("DEBUG: Cleaned up compressed image")
-            except Exception as cleanup_error:
-                print(f"DEBUG: Cleanup error: {cleanup_error}")
-        
-        # Force garbage collection
-        aggressive_cleanup()
-        log_memory_usage("end OCR", force_gc=True)
 
-def extract_text_ocr_space_enhanced(image_path):
-    """Enhanced OCR.space with alternative settings"""
+def extract_text_ocr_space(image):
+    """OCR.space extraction with tier-appropriate settings - one rendition at the largest step"""
+    log_memory_usage("start OCR")
+    
     try:
-        aggressive_cleanup()
-        
-        processed_image_path = compress_image_for_ocr(image_path, max_size_kb=80)
-        aggressive_cleanup()
-        
-        api_url = 'https://api.ocr.space/parse/image'
-        api_key = os.getenv('OCR_SPACE_API_KEY', 'helloworld')
-        
-        response = None
-        try:
-            with open(processed_image_path, 'rb') as f:
-                files = {'file': f}
-                
-                data = {
-                    'apikey': api_key,
-                    'language': 'eng',
-                    'isOverlayRequired': False,
-                    'detectOrientation': True,
-                    'scale': True,
-                    'OCREngine': 1,  # Try engine 1 for difficult images
-                    'isTable': True,
-                    'isSearchablePdfHideTextLayer': False
-                }
-                
-                print("DEBUG: Sending to OCR.space API (enhanced)...")
-                response = requests.post(api_url, files=files, data=data, timeout=20)
-        
-        except Exception as e:
-            print(f"DEBUG: Enhanced OCR API call failed: {e}")
-            return ""
-        finally:
-            if processed_image_path != image_path:
-                try:
-                    os.remove(processed_image_path)
-                except:
-                    pass
-            aggressive_cleanup()
-        
-        if response and response.status_code == 200:
-            result = response.json()
-            extracted_text = parse_ocr_space_response(result)
+        with open_asset(image, decode_dim=OCR_DECODE_DIM) as asset:
+            max_dim, max_kb = PROFILE.progressive_ocr_steps[-1]
+            try:
+                processed_image_path, _ = asset.ocr_rendition(max_dim, max_kb, PROFILE.ocr_quality_levels)
+            except Exception as render_error:
+                print(f"DEBUG: Rendition failed ({render_error}), uploading original")
+                processed_image_path = asset.path
+            log_memory_usage("after compression")
             
-            response.close() if hasattr(response, 'close') else None
-            del response
-            aggressive_cleanup()
-            
-            return extracted_text
-        else:
-            if response:
-                print(f"DEBUG: Enhanced OCR API returned status {response.status_code}")
-            return ""
+            return post_image_to_ocr_space(processed_image_path)
             
+    except TimeoutError:
+        raise
     except Exception as e:
-        print(f"DEBUG: Enhanced OCR method failed: {e}")
-        aggressive_cleanup()
+        print(f"DEBUG: OCR extraction failed: {e}")
         return ""
+    
+    finally:
+        aggressive_cleanup()
+        log_memory_usage("end OCR")
 
-def process_request_with_memory_management():
-    """Pre-request memory management"""
-    try:
-        print("DEBUG: Pre-request memory management")
-        log_memory_usage("pre-request", force_gc=True)
-        
-        temp_dir = tempfile.gettempdir()
-        current_time = time.time()
-        
-        cleaned_count = 0
-        for filename in os.listdir(temp_dir):
-            if ('compressed' in filename or 'ocr_' in filename or 'ultra_' in filename) and filename.endswith('.jpg'):
-                filepath = os.path.join(temp_dir, filename)
-                try:
-                    if os.path.isfile(filepath):
-                        max_age = 30 if PROFESSIONAL_TIER else 60
-                        file_age = current_time - os.path.getmtime(filepath)
-                        if file_age > max_age:
-                            os.remove(filepath)
-                            cleaned_count += 1
-                except Exception as e:
-                    print(f"DEBUG: Temp file cleanup error: {e}")
-        
-        if cleaned_count > 0:
-            print(f"DEBUG: Cleaned up {cleaned_count} old temp files")
+def extract_text_ocr_space_progressive(image):
+    """Progressive OCR.space extraction - small rendition first, escalate only on poor text"""
+    log_memory_usage("start progressive OCR")
+    
+    best_text = ""
+    
+    with open_asset(image, decode_dim=OCR_DECODE_DIM) as asset:
+        try:
+            for step, (max_dim, max_kb) in enumerate(PROFILE.progressive_ocr_steps, 1):
+                # Renditions are cached on the asset, so a retried attempt re-uploads without re-rendering
+                rendition_path, _ = asset.ocr_rendition(max_dim, max_kb, PROFILE.ocr_quality_levels)
+                text = post_image_to_ocr_space(rendition_path)
+                
+                # The original already fit this step - a bigger step would send the same bytes
+                is_last_step = step == len(PROFILE.progressive_ocr_steps) or rendition_path == asset.path
+                
+                quality = assess_text_quality_enhanced(text)
+                print(f"DEBUG: Progressive step {step}/{len(PROFILE.progressive_ocr_steps)} ({max_dim}px, {max_kb} KB): quality {quality}")
+                
+                if len(text.strip()) > len(best_text.strip()):
+                    best_text = text
+                
+                if quality not in ('poor', 'very_poor') or is_last_step:
+                    return text if quality not in ('poor', 'very_poor') else best_text
+                
+                print(f"DEBUG: Text quality {quality} - escalating to higher resolution")
+            
+            return best_text
         
-        log_memory_usage("post-cleanup", force_gc=True)
+        except TimeoutError:
+            print("DEBUG: Progressive OCR ran out of time, keeping the best text so far")
+            if best_text:
+                return best_text
+            raise
+        except Exception as e:
+            print(f"DEBUG: Progressive OCR failed: {e}, falling back to single-pass OCR")
+            return extract_text_ocr_space(asset)
         
-    except Exception as e:
-        print(f"DEBUG: Request memory management error: {e}")
+        finally:
+            log_memory_usage("end progressive OCR")
 
 def before_scan_cleanup():
-    """Pre-scan cleanup with tier-appropriate settings"""
-    process_request_with_memory_management()
-    
-    # Set tier-appropriate PIL limits
-    max_pixels = 50000000 if PROFESSIONAL_TIER else 30000000
-    Image.MAX_IMAGE_PIXELS = max_pixels
-    
-    # Force Python to be more aggressive with memory
-    import sys
-    if hasattr(sys, 'setswitchinterval'):
-        interval = 0.001 if PROFESSIONAL_TIER else 0.005
-        sys.setswitchinterval(interval)
-    
-    aggressive_cleanup()
+    """Pre-scan memory sample - the route (request_policy.memory_managed) owns the request's
+    accounting, and temp files go away with the request's scratch workspace"""
+    log_memory_usage("pre-scan")
 
 def parse_ocr_space_response(result):
     """Parse OCR.space API response with better error handling"""
@@ -645,24 +308,17 @@ def parse_ocr_space_response(result):
         print(f"DEBUG: Raw response: {result}")
         return ""
 
-def extract_text_pytesseract_fallback(image_path):
-    """Pytesseract fallback with memory management"""
+def extract_text_pytesseract_fallback(image):
+    """Pytesseract fallback - reuses the asset's decoded pixels instead of reopening the file"""
     try:
         print("DEBUG: Attempting pytesseract fallback...")
         import pytesseract
-        from PIL import Image
         
         aggressive_cleanup()
         
-        image = Image.open(image_path)
-        
-        if image.mode != 'L':
-            image = image.convert('L')
-            
-        text = pytesseract.image_to_string(image, config='--psm 6')
+        with open_asset(image, decode_dim=OCR_DECODE_DIM) as asset:
+            text = pytesseract.image_to_string(asset.grayscale(), config='--psm 6')
         
-        image.close()
-        del image
         aggressive_cleanup()
         
         if text and len(text.strip()) > 0:
@@ -975,26 +631,42 @@ def rate_ingredients_according_to_hierarchy(matches, text_quality):
     
     return "✅ Yay! Safe!"
 
-def scan_image_for_ingredients(image_path):
-    """Main scanning function with comprehensive memory management and error handling"""
+def scan_image_for_ingredients(image):
+    """Main scanning function - takes a path or an ImageAsset the caller already opened"""
+    try:
+        with open_asset(image, decode_dim=OCR_DECODE_DIM) as asset:
+            return scan_asset_for_ingredients(asset)
+        
+    except TimeoutError:
+        raise   # the route's with_timeout deadline - reported as a timeout, not a scan error
+    except Exception as e:
+        print(f"❌ CRITICAL ERROR in scan_image_for_ingredients: {e}")
+        import traceback
+        traceback.print_exc()
+        
+        aggressive_cleanup()
+        
+        return create_error_result(str(e))
+
+def scan_asset_for_ingredients(asset):
+    """Run OCR, matching and rating for one opened upload"""
     try:
         before_scan_cleanup()
         
         print(f"\n{'='*80}")
-        print(f"🔬 STARTING {'PROFESSIONAL' if PROFESSIONAL_TIER else 'STANDARD'} TIER SCAN: {image_path}")
+        print(f"🔬 STARTING {PROFILE.name.upper()} PROFILE SCAN: {asset.path}")
         print(f"{'='*80}")
-        print(f"DEBUG: File exists: {os.path.exists(image_path)}")
+        print(f"DEBUG: File exists: {os.path.exists(asset.path)}")
         
-        initial_memory = log_memory_usage("scan start", force_gc=True)
+        initial_memory = log_memory_usage("scan start")
         
-        memory_warning_threshold = 1500 if PROFESSIONAL_TIER else 150
+        memory_warning_threshold = PROFILE.memory_warning_mb
         if initial_memory > memory_warning_threshold:
             print(f"WARNING: High initial memory {initial_memory:.1f}MB - may cause issues")
-            aggressive_cleanup()
-            time.sleep(0.5)
         
         print("🔍 Starting tier-appropriate OCR text extraction...")
-        text = extract_text_with_multiple_methods(image_path)
+        text = extract_text_with_multiple_methods(asset)
+        request_deadline.check("ingredient matching")
         print(f"📝 Extracted text length: {len(text)} characters")
         
         if text:
@@ -1031,14 +703,16 @@ def scan_image_for_ingredients(image_path):
         
         print_scan_summary(result)
         
-        aggressive_cleanup()
-        final_memory = log_memory_usage("scan end", force_gc=True)
+        final_memory = log_memory_usage("scan end")
         print(f"DEBUG: Memory change: {initial_memory:.1f}MB -> {final_memory:.1f}MB")
+        print(f"DEBUG: Memory governor report: {memory_governor.request_report()}")
         
         return result
         
+    except TimeoutError:
+        raise
     except Exception as e:
-        print(f"❌ CRITICAL ERROR in scan_image_for_ingredients: {e}")
+        print(f"❌ CRITICAL ERROR in scan_asset_for_ingredients: {e}")
         import traceback
         traceback.print_exc()
         
@@ -1119,41 +793,11 @@ def get_category_emoji(category):
     }
     return emoji_map.get(category, '📝')
 
-# Tier detection and function selection
-def get_compression_function():
-    """Return appropriate compression function based on tier"""
-    return compress_image_for_ocr
-
+# Function selection
 def get_ocr_function():
-    """Return appropriate OCR function based on tier"""
+    """Return the OCR function used for scans"""
     return extract_text_with_multiple_methods
 
-# Professional tier function aliases for compatibility
-def compress_image_for_ocr_professional(image_path, max_size_kb=500):
-    return compress_image_for_ocr(image_path, max_size_kb)
-
-def ultra_minimal_compress_professional(image_path, max_size_kb=500):
-    return ultra_minimal_compress(image_path, max_size_kb)
-
-def extract_text_ocr_space_professional(image_path):
-    return extract_text_ocr_space(image_path)
-
-def safe_ocr_with_fallback_professional(image_path, max_attempts=3):
-    return safe_ocr_with_fallback(image_path, max_attempts)
-
-def extract_text_with_multiple_methods_professional(image_path):
-    return extract_text_with_multiple_methods(image_path)
-
-# Logging
-if PROFESSIONAL_TIER:
-    print("✅ PROFESSIONAL TIER DETECTED - Using enhanced functions")
-    print(f"   - Memory threshold: {MEMORY_THRESHOLD}MB")
-    print(f"   - Compression threshold: {COMPRESSION_THRESHOLD}KB")
-else:
-    print("ℹ️ Free tier detected - Using standard functions")
-    print(f"   - Memory threshold: {MEMORY_THRESHOLD}MB")
-    print(f"   - Compression threshold: {COMPRESSION_THRESHOLD}KB")
-
 # Backwards compatibility
 def analyze_ingredients(text):
     """Wrapper function for backwards compatibility"""
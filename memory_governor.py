@@ -0,0 +1,101 @@
+# memory_governor.py - Budgeted memory management for the scan path
+#
+# Replaces the old gc.collect()/time.sleep() storms. RSS is sampled cheaply and a
+# full collection only runs when a real threshold is crossed, at most once per
+# MIN_GC_INTERVAL and only if memory has grown since the previous collection.
+# Nothing here ever sleeps on the request path.
+
+import gc
+import os
+import threading
+import time
+
+import psutil
+
+GC_THRESHOLD_MB = float(os.getenv('MEMORY_GC_THRESHOLD_MB', '0')) or None  # set by configure()
+GC_GROWTH_MB = 32         # RSS must grow this much past the last collection before collecting again
+MIN_GC_INTERVAL = 2.0     # seconds between full collections
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_lock = threading.Lock()
+_request = threading.local()
+_last_gc_at = 0.0
+_last_gc_rss_mb = 0.0
+
+def configure(threshold_mb=None, growth_mb=None, min_interval=None):
+    """Set the collection budget - env MEMORY_GC_THRESHOLD_MB always wins"""
+    global GC_THRESHOLD_MB, GC_GROWTH_MB, MIN_GC_INTERVAL
+
+    if threshold_mb is not None and not os.getenv('MEMORY_GC_THRESHOLD_MB'):
+        GC_THRESHOLD_MB = float(threshold_mb)
+    if growth_mb is not None:
+        GC_GROWTH_MB = float(growth_mb)
+    if min_interval is not None:
+        MIN_GC_INTERVAL = float(min_interval)
+
+def current_rss_mb():
+    """Resident set size of *this* process - one /proc read, safe after fork"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        # psutil.Process() is looked up per call so preload_app forks report their own pid
+        return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+
+def begin_request():
+    """Reset the per-request GC accounting for the current thread"""
+    _request.gc_seconds = 0.0
+    _request.gc_runs = 0
+    _request.samples = 0
+    _request.peak_mb = 0.0
+    _request.started_at = time.perf_counter()
+
+def request_report():
+    """GC time and memory figures accumulated since begin_request()"""
+    if not hasattr(_request, 'started_at'):
+        begin_request()
+
+    return {
+        'gc_ms': round(_request.gc_seconds * 1000, 1),
+        'gc_runs': _request.gc_runs,
+        'samples': _request.samples,
+        'peak_mb': round(_request.peak_mb, 1),
+        'elapsed_ms': round((time.perf_counter() - _request.started_at) * 1000, 1)
+    }
+
+def check(stage=""):
+    """Sample RSS and collect only if the budget is exceeded - returns RSS in MB"""
+    global _last_gc_at, _last_gc_rss_mb
+
+    if not hasattr(_request, 'started_at'):
+        begin_request()
+
+    memory_mb = current_rss_mb()
+    _request.samples += 1
+    _request.peak_mb = max(_request.peak_mb, memory_mb)
+
+    if GC_THRESHOLD_MB is None or memory_mb <= GC_THRESHOLD_MB:
+        return memory_mb
+
+    now = time.monotonic()
+    with _lock:
+        if now - _last_gc_at < MIN_GC_INTERVAL or memory_mb - _last_gc_rss_mb < GC_GROWTH_MB:
+            return memory_mb
+        # Claim the slot so concurrent threads don't collect at the same time
+        _last_gc_at = now
+
+    started = time.perf_counter()
+    collected = gc.collect()
+    elapsed = time.perf_counter() - started
+
+    after_mb = current_rss_mb()
+    with _lock:
+        _last_gc_rss_mb = after_mb
+
+    _request.gc_seconds += elapsed
+    _request.gc_runs += 1
+
+    print(f"DEBUG: Memory governor {stage}: {memory_mb:.1f} MB > {GC_THRESHOLD_MB:.0f} MB budget, "
+          f"collected {collected} objects in {elapsed * 1000:.1f} ms -> {after_mb:.1f} MB")
+    return after_mb
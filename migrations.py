@@ -0,0 +1,386 @@
+# migrations.py - Versioned schema migrations
+#
+# Each migration runs once, in its own transaction, and is recorded in
+# schema_migrations. At boot init_db() only reads the current version; nothing
+# else runs unless a migration is pending. Deploys run them ahead of time with:
+#
+#     python migrations.py            # apply pending migrations
+#     python migrations.py --status   # show applied / pending
+#
+# Concurrent boots are serialised with an advisory lock (PostgreSQL) or
+# BEGIN IMMEDIATE (SQLite), and the version is re-checked under the lock.
+
+import ast
+import itertools
+import json
+import sys
+
+from repositories import current_dialect
+
+MIGRATION_LOCK_ID = 7304917   # pg_advisory_xact_lock key for this app
+
+USERS_DDL = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        email VARCHAR(255) UNIQUE NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_premium BOOLEAN DEFAULT FALSE,
+        stripe_customer_id VARCHAR(255),
+        subscription_status VARCHAR(50) DEFAULT 'trial',
+        subscription_start_date TIMESTAMP,
+        next_billing_date TIMESTAMP,
+        trial_start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        trial_end_date TIMESTAMP,
+        scans_used INTEGER DEFAULT 0,
+        total_scans_ever INTEGER DEFAULT 0,
+        last_login TIMESTAMP
+    )
+'''
+
+SCAN_HISTORY_DDL = '''
+    CREATE TABLE IF NOT EXISTS scan_history (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        scan_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        result_rating TEXT,
+        ingredients_found TEXT,
+        image_url TEXT,
+        scan_id VARCHAR(255),
+        extracted_text TEXT,
+        text_length INTEGER DEFAULT 0,
+        confidence VARCHAR(20) DEFAULT 'medium',
+        text_quality VARCHAR(20) DEFAULT 'unknown',
+        has_safety_labels BOOLEAN DEFAULT FALSE
+    )
+'''
+
+OCR_COLUMNS = [
+    ('extracted_text', 'TEXT'),
+    ('text_length', 'INTEGER DEFAULT 0'),
+    ('confidence', "VARCHAR(20) DEFAULT 'medium'"),
+    ('text_quality', "VARCHAR(20) DEFAULT 'unknown'"),
+    ('has_safety_labels', 'BOOLEAN DEFAULT FALSE'),
+]
+
+def _sqlite_ddl(ddl):
+    # SERIAL is not a rowid alias in SQLite - ids stayed NULL
+    return ddl.replace('SERIAL PRIMARY KEY', 'INTEGER PRIMARY KEY AUTOINCREMENT')
+
+def _sqlite_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1]: row[2] for row in cursor.fetchall()}
+
+def create_base_tables(cursor, dialect):
+    if dialect == 'sqlite':
+        cursor.execute(_sqlite_ddl(USERS_DDL))
+        cursor.execute(_sqlite_ddl(SCAN_HISTORY_DDL))
+    else:
+        cursor.execute(USERS_DDL)
+        cursor.execute(SCAN_HISTORY_DDL)
+
+def add_ocr_columns(cursor, dialect):
+    """Columns the old init_db ALTERed in on every boot"""
+    if dialect == 'sqlite':
+        existing = _sqlite_columns(cursor, 'scan_history')
+        for column, definition in OCR_COLUMNS:
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE scan_history ADD COLUMN {column} {definition}")
+    else:
+        for column, definition in OCR_COLUMNS:
+            cursor.execute(f"ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+def sqlite_integer_keys(cursor, dialect):
+    """Rebuild SQLite tables created with SERIAL ids - rows keep their rowid as id"""
+    if dialect != 'sqlite':
+        return
+
+    for table, ddl in (('users', USERS_DDL), ('scan_history', SCAN_HISTORY_DDL)):
+        columns = _sqlite_columns(cursor, table)
+        if columns.get('id', '').upper() != 'SERIAL':
+            continue
+
+        others = ', '.join(column for column in columns if column != 'id')
+        cursor.execute(_sqlite_ddl(ddl).replace(f'EXISTS {table} (', f'EXISTS {table}_rebuilt ('))
+        cursor.execute(f"INSERT INTO {table}_rebuilt (id, {others}) SELECT COALESCE(id, rowid), {others} FROM {table}")
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+
+def add_history_indexes(cursor, dialect):
+    """/history and export read one user's scans newest first; scan_id identifies a scan"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_user_date ON scan_history (user_id, scan_date DESC)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_scan_history_scan_id ON scan_history (scan_id)")
+
+def ingredients_json(cursor, dialect):
+    """Rewrite legacy Python-repr ingredient rows as JSON; JSONB column on PostgreSQL"""
+    # json.dumps output starts with {" - anything else is empty, '{}' or a repr() from old code
+    cursor.execute('''
+        SELECT id, ingredients_found FROM scan_history
+        WHERE ingredients_found IS NOT NULL AND ingredients_found NOT LIKE '{"%' AND ingredients_found <> '{}'
+    ''')
+    legacy = cursor.fetchall()
+
+    placeholder = '?' if dialect == 'sqlite' else '%s'
+    for row in legacy:
+        try:
+            converted = json.dumps(ast.literal_eval(row['ingredients_found']))
+        except (ValueError, SyntaxError):
+            converted = None
+        cursor.execute(f"UPDATE scan_history SET ingredients_found = {placeholder} WHERE id = {placeholder}",
+                       (converted, row['id']))
+    if legacy:
+        print(f"INFO: Converted {len(legacy)} legacy ingredient rows to JSON")
+
+    if dialect == 'postgresql':
+        cursor.execute('''
+            ALTER TABLE scan_history
+            ALTER COLUMN ingredients_found TYPE JSONB
+            USING NULLIF(ingredients_found, '')::jsonb
+        ''')
+
+def history_keyset_index(cursor, dialect):
+    """Keyset pages sort on (scan_date, id) - the id tie-breaker joins the index, which replaces the old one"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_user_date_id ON scan_history (user_id, scan_date DESC, id DESC)")
+    cursor.execute("DROP INDEX IF EXISTS idx_scan_history_user_date")
+
+USER_SCAN_STATS_DDL = '''
+    CREATE TABLE IF NOT EXISTS user_scan_stats (
+        user_id INTEGER PRIMARY KEY REFERENCES users(id),
+        total_scans INTEGER NOT NULL DEFAULT 0,
+        safe_scans INTEGER NOT NULL DEFAULT 0,
+        danger_scans INTEGER NOT NULL DEFAULT 0,
+        caution_scans INTEGER NOT NULL DEFAULT 0,
+        ingredients_found INTEGER NOT NULL DEFAULT 0,
+        trans_fat_scans INTEGER NOT NULL DEFAULT 0,
+        excitotoxins_scans INTEGER NOT NULL DEFAULT 0,
+        corn_scans INTEGER NOT NULL DEFAULT 0,
+        sugar_scans INTEGER NOT NULL DEFAULT 0,
+        sugar_safe_scans INTEGER NOT NULL DEFAULT 0,
+        gmo_scans INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+'''
+
+USER_INGREDIENT_STATS_DDL = '''
+    CREATE TABLE IF NOT EXISTS user_ingredient_stats (
+        user_id INTEGER NOT NULL REFERENCES users(id),
+        ingredient VARCHAR(255) NOT NULL,
+        scans INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, ingredient)
+    )
+'''
+
+def user_scan_stats(cursor, dialect):
+    """Per-user stats tables, backfilled from existing history"""
+    from repositories import STAT_COLUMNS, ScanHistoryRepo, ScanStatsRepo, summarize_scans
+
+    cursor.execute(USER_SCAN_STATS_DDL)
+    cursor.execute(USER_INGREDIENT_STATS_DDL)
+
+    add_sql = ScanStatsRepo.SQL['add']
+    add_ingredient_sql = ScanStatsRepo.SQL['add_ingredient']
+    if dialect == 'postgresql':
+        add_sql = add_sql.replace('?', '%s')
+        add_ingredient_sql = add_ingredient_sql.replace('?', '%s')
+
+    # Read with one cursor, write with another - rows arrive grouped by user
+    writer = cursor.connection.cursor()
+    cursor.execute('SELECT user_id, result_rating, ingredients_found FROM scan_history '
+                   'WHERE user_id IS NOT NULL ORDER BY user_id')
+    users = 0
+    for user_id, rows in itertools.groupby(cursor, key=lambda row: row['user_id']):
+        scans = [(row['result_rating'], ScanHistoryRepo.decode_row(dict(row))['ingredients_found']) for row in rows]
+        counters, ingredients = summarize_scans(scans)
+        writer.execute(add_sql, (user_id,) + tuple(counters[column] for column in STAT_COLUMNS))
+        writer.executemany(add_ingredient_sql, [(user_id, name, count) for name, count in sorted(ingredients.items())])
+        users += 1
+    if users:
+        print(f"INFO: Backfilled scan stats for {users} users")
+
+def compact_ingredients(cursor, dialect):
+    """Re-encode ingredient dicts in the compact id/bitset format (ingredient_codec.py)"""
+    import ingredient_codec
+
+    is_object = "jsonb_typeof(ingredients_found) = 'object'" if dialect == 'postgresql' else "ingredients_found LIKE '{%'"
+    placeholder = '?' if dialect == 'sqlite' else '%s'
+    update_sql = f"UPDATE scan_history SET ingredients_found = {placeholder} WHERE id = {placeholder}"
+
+    # Walk by id in batches - one batch of rows in memory however big the table is
+    last_id, converted = 0, 0
+    while True:
+        cursor.execute(f"SELECT id, ingredients_found FROM scan_history WHERE id > {placeholder} AND {is_object} "
+                       f"ORDER BY id LIMIT 1000", (last_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany(update_sql, [(ingredient_codec.dumps(ingredient_codec.decode(row['ingredients_found'])), row['id'])
+                                        for row in rows])
+        last_id = rows[-1]['id']
+        converted += len(rows)
+
+    if converted:
+        print(f"INFO: Re-encoded {converted} ingredient rows in the compact format")
+
+IMAGE_BLOBS_DDL = '''
+    CREATE TABLE IF NOT EXISTS image_blobs (
+        image_url VARCHAR(255) PRIMARY KEY,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+'''
+
+def image_blobs(cursor, dialect):
+    """Reference counts for content-addressed scan images, backfilled from history"""
+    import blob_store
+
+    cursor.execute(IMAGE_BLOBS_DDL)
+    placeholder = '?' if dialect == 'sqlite' else '%s'
+    cursor.execute(f'''
+        INSERT INTO image_blobs (image_url, ref_count, updated_at)
+        SELECT image_url, COUNT(*), CURRENT_TIMESTAMP FROM scan_history
+        WHERE image_url LIKE {placeholder}
+        GROUP BY image_url
+    ''', (f"{blob_store.BLOB_URL_PREFIX}%",))
+
+HISTORY_DELETIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS history_deletions (
+        user_id INTEGER PRIMARY KEY REFERENCES users(id),
+        cleared_at TIMESTAMP NOT NULL,
+        total_rows INTEGER NOT NULL DEFAULT 0,
+        deleted_rows INTEGER NOT NULL DEFAULT 0,
+        requested_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        lease_until TIMESTAMP
+    )
+'''
+
+def history_deletions(cursor, dialect):
+    """Tombstones and progress for background clear_history jobs"""
+    cursor.execute(HISTORY_DELETIONS_DDL)
+
+TEXT_DICTIONARIES_DDL = '''
+    CREATE TABLE IF NOT EXISTS text_dictionaries (
+        id SERIAL PRIMARY KEY,
+        dictionary BYTEA NOT NULL,
+        samples INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+def text_retention(cursor, dialect):
+    """extracted_text_z and its compression dictionaries (text_codec.py), plus indexes for retention.py"""
+    if dialect == 'sqlite':
+        cursor.execute(_sqlite_ddl(TEXT_DICTIONARIES_DDL).replace('BYTEA', 'BLOB'))
+        if 'extracted_text_z' not in _sqlite_columns(cursor, 'scan_history'):
+            cursor.execute("ALTER TABLE scan_history ADD COLUMN extracted_text_z BLOB")
+    else:
+        cursor.execute(TEXT_DICTIONARIES_DDL)
+        cursor.execute("ALTER TABLE scan_history ADD COLUMN IF NOT EXISTS extracted_text_z BYTEA")
+
+    # Rows leave the partial index once compressed, so each pass only reads rows left to do
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_text_date ON scan_history (scan_date, id) "
+                   "WHERE extracted_text IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_date ON scan_history (scan_date, id)")
+
+def history_cleared_id(cursor, dialect):
+    """history_deletions.cleared_id - the last scan_history id a clear covers, since
+    cleared_at alone can't split scans made in the same second as the clear"""
+    if dialect == 'sqlite':
+        if 'cleared_id' not in _sqlite_columns(cursor, 'history_deletions'):
+            cursor.execute("ALTER TABLE history_deletions ADD COLUMN cleared_id INTEGER NOT NULL DEFAULT 0")
+    else:
+        cursor.execute("ALTER TABLE history_deletions ADD COLUMN IF NOT EXISTS cleared_id INTEGER NOT NULL DEFAULT 0")
+
+    # Existing tombstones hid rows at or before cleared_at - keep hiding those
+    cursor.execute('''
+        UPDATE history_deletions SET cleared_id = COALESCE((
+            SELECT MAX(id) FROM scan_history
+            WHERE scan_history.user_id = history_deletions.user_id
+              AND scan_history.scan_date <= history_deletions.cleared_at), 0)
+    ''')
+
+MIGRATIONS = [
+    (1, 'create users and scan_history', create_base_tables),
+    (2, 'scan_history OCR columns', add_ocr_columns),
+    (3, 'sqlite integer primary keys', sqlite_integer_keys),
+    (4, 'scan_history indexes', add_history_indexes),
+    (5, 'ingredients_found as JSON', ingredients_json),
+    (6, 'scan_history keyset index', history_keyset_index),
+    (7, 'user_scan_stats', user_scan_stats),
+    (8, 'compact ingredient encoding', compact_ingredients),
+    (9, 'image_blobs', image_blobs),
+    (10, 'history_deletions', history_deletions),
+    (11, 'text retention', text_retention),
+    (12, 'history_deletions cleared_id', history_cleared_id),
+]
+
+def _ensure_version_table(conn, cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+def current_version(conn):
+    cursor = conn.cursor()
+    _ensure_version_table(conn, cursor)
+    cursor.execute('SELECT MAX(version) AS version FROM schema_migrations')
+    row = cursor.fetchone()
+    return row['version'] or 0
+
+def migrate(conn):
+    """Apply pending migrations in order - returns the versions applied"""
+    dialect = current_dialect()
+    applied = []
+
+    if current_version(conn) >= MIGRATIONS[-1][0]:
+        return applied
+
+    cursor = conn.cursor()
+    placeholder = '?' if dialect == 'sqlite' else '%s'
+
+    for version, name, apply in MIGRATIONS:
+        # Lock, then re-check - another process may have applied it meanwhile
+        if dialect == 'sqlite':
+            cursor.execute('BEGIN IMMEDIATE')
+        else:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+
+        cursor.execute(f'SELECT 1 FROM schema_migrations WHERE version = {placeholder}', (version,))
+        if cursor.fetchone():
+            conn.commit()
+            continue
+
+        try:
+            apply(cursor, dialect)
+            cursor.execute(f'INSERT INTO schema_migrations (version, name) VALUES ({placeholder}, {placeholder})',
+                           (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        print(f"INFO: Applied migration {version}: {name}")
+        applied.append(version)
+
+    return applied
+
+def status(conn):
+    version = current_version(conn)
+    for number, name, _ in MIGRATIONS:
+        print(f"{number:4}  {'applied' if number <= version else 'pending':8}  {name}")
+
+if __name__ == '__main__':
+    import db_pool
+    from repositories import connect_database
+
+    with db_pool.connection(connect_database) as conn:
+        if '--status' in sys.argv:
+            status(conn)
+        else:
+            applied = migrate(conn)
+            print(f"INFO: Schema at version {current_version(conn)} ({len(applied)} applied)")
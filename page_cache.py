@@ -0,0 +1,144 @@
+# page_cache.py - Template bytecode cache and per-user page shells
+#
+# Templates used to be compiled lazily, once per worker, on the first request that
+# rendered them (3-20ms each, paid again after every max_requests restart). They
+# are now compiled at startup - in the master under preload_app, so workers
+# inherit them - through a Jinja bytecode cache on disk (TEMPLATE_CACHE_DIR, else
+# Jinja's per-user temp dir), so a restart loads bytecode instead of recompiling.
+#
+# The scanner, upgrade and account pages are mostly markup that is the same for
+# every user in the same state. render() caches each page as a shell:
+#
+#     page_cache.render('upgrade.html', state={'trial_expired': False},
+#                       slots={'trial_time_left': '12h 3m'})
+#
+# State values pick the template's branches and are part of the cache key; slot
+# values are only printed, so the shell is rendered once with markers in their
+# place and each request splices in the escaped values. The session keys these
+# templates read are split the same way. A falsy slot value is treated as state,
+# since templates test slots with `or` and `if`. Flashed messages make the page
+# fall back to a normal render.
+#
+# Pages go out with Cache-Control: private, no-cache and an ETag over the shell
+# and slot values, so a revalidating browser gets a 304.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app, make_response, render_template, request, session
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR')
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '512'))   # shells per worker, oldest evicted first
+
+SESSION_STATE = ('is_premium', 'scans_used')     # session keys the page templates branch on
+SESSION_SLOTS = ('user_email', 'user_name')      # session keys they only print
+MARK = '\x00'
+
+_lock = threading.Lock()
+_shells = OrderedDict()   # key -> (etag seed, [static, slot, static, ..., static]) or None
+_hits = 0
+_misses = 0
+_fallbacks = 0
+
+def init_app(app):
+    """Install the bytecode cache and compile every template now"""
+    if TEMPLATE_CACHE_DIR:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    print(f"INFO: Compiled {len(names)} templates")
+
+def _split(values):
+    """Slot values that are printed, and falsy ones that go into the state"""
+    printed, state = {}, {}
+    for key, value in values.items():
+        if value:
+            printed[key] = value
+        else:
+            state[key] = value
+    return printed, state
+
+def _build(name, context, slot_names):
+    """Render a shell - None if a slot marker didn't come out intact"""
+    text = current_app.jinja_env.get_template(name).render(context, get_flashed_messages=lambda **kwargs: [])
+    pieces = text.split(MARK)
+    if len(pieces) % 2 == 0 or any(piece not in slot_names for piece in pieces[1::2]):
+        print(f"WARNING: {name} transforms a slot value - rendering it without the page cache")
+        return None
+    seed = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    pieces[::2] = [piece.encode() for piece in pieces[::2]]   # responses are joined as bytes
+    return seed, pieces
+
+def _shell(name, state, printed, session_state, printed_session):
+    """Cached (etag seed, pieces) for this state and set of printed slots, or None"""
+    global _hits, _misses
+
+    key = (name, tuple(sorted(state.items())), tuple(sorted(session_state.items())),
+           tuple(sorted(printed)), tuple(sorted(printed_session)))
+    with _lock:
+        if key in _shells:
+            _shells.move_to_end(key)
+            _hits += 1
+            return _shells[key]
+
+    context = dict(state)
+    context.update((slot, Markup(f"{MARK}{slot}{MARK}")) for slot in printed)
+    context['session'] = dict(session_state)
+    context['session'].update((slot, Markup(f"{MARK}session.{slot}{MARK}")) for slot in printed_session)
+    shell = _build(name, context, set(printed) | {f"session.{slot}" for slot in printed_session})
+
+    with _lock:
+        _misses += 1
+        _shells[key] = shell   # None too, so a page that can't be cached isn't retried every request
+        while len(_shells) > PAGE_CACHE_SIZE:
+            _shells.popitem(last=False)
+    return shell
+
+def render(name, state, slots):
+    """Response for a template rendered from its cached shell, revalidated by ETag"""
+    global _fallbacks
+
+    shell = None
+    if '_flashes' not in session:
+        printed, falsy = _split(slots)
+        printed_session, falsy_session = _split({key: session[key] for key in SESSION_SLOTS if key in session})
+        session_state = {key: session[key] for key in SESSION_STATE if key in session}
+        session_state.update(falsy_session)
+        shell = _shell(name, {**state, **falsy}, printed, session_state, printed_session)
+
+    if shell is None:
+        with _lock:
+            _fallbacks += 1
+        response = make_response(render_template(name, **state, **slots))
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    seed, pieces = shell
+    values = dict(printed)
+    values.update((f"session.{slot}", value) for slot, value in printed_session.items())
+
+    parts = list(pieces)
+    etag = hashlib.blake2b(seed, digest_size=16)
+    for index in range(1, len(parts), 2):
+        parts[index] = str(escape(values[parts[index]])).encode()
+        etag.update(MARK.encode() + parts[index])
+    etag = etag.hexdigest()
+
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(b''.join(parts))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(etag)
+    return response
+
+def stats():
+    with _lock:
+        return {'shells': len(_shells), 'hits': _hits, 'misses': _misses, 'fallbacks': _fallbacks}
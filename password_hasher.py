@@ -0,0 +1,129 @@
+# password_hasher.py - Bounded executor for password hashing
+#
+# A PBKDF2 hash at werkzeug's 600,000 iterations is ~0.3s of pure CPU. Login,
+# register and the reset routes used to run it inline, so a burst of logins took
+# every core from the scans in flight. Hashing now runs on a small per-worker pool
+# (PASSWORD_HASH_WORKERS threads; hashlib releases the GIL while it works), at most
+# PASSWORD_HASH_QUEUE operations wait for it, and a request that can't get a slot
+# within PASSWORD_HASH_WAIT seconds gets HasherBusy instead of piling on.
+#
+# PASSWORD_HASH_METHOD is the werkzeug method string for new hashes (work factor
+# included, e.g. 'pbkdf2:sha256:600000' or 'scrypt:32768:8:1'). A successful
+# verify() of a hash made with other parameters also returns its replacement, so
+# stored hashes migrate as users log in.
+#
+# Like history_writer, the pool is created lazily and remembers its pid.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '1'))   # threads per gunicorn worker
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', '16'))      # operations running or waiting
+PASSWORD_HASH_WAIT = float(os.getenv('PASSWORD_HASH_WAIT', '10'))      # seconds to wait for a slot
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue stays full for PASSWORD_HASH_WAIT seconds"""
+
+def needs_rehash(password_hash, method=PASSWORD_HASH_METHOD):
+    """Whether a stored hash was made with other parameters than method"""
+    return password_hash.split('$', 1)[0] != method
+
+class PasswordHasher:
+    """Hash and verify passwords on a bounded thread pool, with per-operation timings"""
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 queue=PASSWORD_HASH_QUEUE, wait=PASSWORD_HASH_WAIT):
+        self.method = method
+        self.workers = workers
+        self.wait = wait
+
+        self._slots = threading.BoundedSemaphore(queue)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._metrics = {}   # operation -> [count, total seconds, max seconds, total queue seconds]
+        self._rejected = 0
+
+    def _pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # A pool inherited through fork has no threads behind it
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, operation, fn, *args):
+        queued = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusy(f"Password {operation} queue is full")
+        try:
+            timings = {}
+
+            def timed():
+                started = time.perf_counter()
+                timings['queue'] = started - queued
+                try:
+                    return fn(*args)
+                finally:
+                    timings['run'] = time.perf_counter() - started
+
+            result = self._pool().submit(timed).result()
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            entry = self._metrics.get(operation)
+            if entry is None:
+                entry = self._metrics[operation] = [0, 0.0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += timings['run']
+            entry[2] = max(entry[2], timings['run'])
+            entry[3] += timings['queue']
+        return result
+
+    def hash(self, password):
+        """New hash of password with the configured method"""
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """(matches, replacement hash or None) - the replacement is set when the stored
+        hash uses old parameters, computed in the same executor slot"""
+        def check():
+            if not check_password_hash(password_hash, password):
+                return False, None
+            if needs_rehash(password_hash, self.method):
+                return True, generate_password_hash(password, self.method)
+            return True, None
+
+        return self._run('verify', check)
+
+    def stats(self):
+        with self._lock:
+            operations = {
+                operation: {
+                    'count': count,
+                    'avg_ms': round(total / count * 1000, 1),
+                    'max_ms': round(longest * 1000, 1),
+                    'avg_queue_ms': round(queued / count * 1000, 1),
+                }
+                for operation, (count, total, longest, queued) in sorted(self._metrics.items())
+            }
+            return {'method': self.method, 'workers': self.workers, 'rejected': self._rejected, **operations}
+
+_hasher = PasswordHasher()
+
+def hash_password(password):
+    return _hasher.hash(password)
+
+def verify_password(password_hash, password):
+    return _hasher.verify(password_hash, password)
+
+def stats():
+    return _hasher.stats()
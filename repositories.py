@@ -0,0 +1,1067 @@
+# repositories.py - Data access for users and scan history
+#
+# Each repository owns its SQL. Statements are written once with ? placeholders;
+# where PostgreSQL and SQLite differ (timestamps, booleans, RETURNING) the entry
+# holds one string per dialect. On PostgreSQL every statement is PREPAREd once per
+# pooled connection and run with EXECUTE afterwards, so the server parses and
+# plans it once per connection instead of once per request.
+#
+# Handlers make one repository call per logical operation; each call checks out
+# one pooled connection and commits once.
+
+import base64
+import functools
+import json
+import os
+import re
+import sqlite3
+import uuid
+from datetime import datetime, timezone
+
+import blob_store
+import ingredient_codec
+import text_codec
+import user_cache
+
+# Turn off behind a transaction-mode connection pooler (pgbouncer), which can't keep
+# session-level prepared statements
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() != 'false'
+
+SQLITE_NOW = "datetime('now', 'localtime')"   # local time, the format the SQLite fallback always stored
+
+def current_dialect():
+    return 'postgresql' if os.getenv('DATABASE_URL') else 'sqlite'
+
+def connect_database():
+    """Open a new database connection - PostgreSQL for production, SQLite for local"""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        import psycopg2
+        from psycopg2.extras import RealDictCursor
+        return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    else:
+        # Fallback to SQLite for local development - pooled, so usable from any thread
+        conn = sqlite3.connect('foodfixr.db', check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+def _numbered_placeholders(sql):
+    """? -> $1, $2, ... for PREPARE"""
+    counter = iter(range(1, sql.count('?') + 1))
+    return re.sub(r'\?', lambda _: f"${next(counter)}", sql)
+
+# Scanner categories that get their own counter in user_scan_stats
+STAT_CATEGORIES = ingredient_codec.CATEGORIES
+STAT_COLUMNS = ('total_scans', 'safe_scans', 'danger_scans', 'caution_scans', 'ingredients_found') + \
+               tuple(f'{category}_scans' for category in STAT_CATEGORIES)
+
+def rating_type(rating):
+    """safe / danger / caution / retry for a stored result_rating"""
+    rating = rating or ''
+    if 'Safe' in rating or 'Yay' in rating:
+        return 'safe'
+    if 'Danger' in rating or 'NOOOO' in rating:
+        return 'danger'
+    if 'Proceed' in rating or 'carefully' in rating:
+        return 'caution'
+    return 'retry'
+
+def summarize_scans(scans):
+    """Stats counters and per-ingredient scan counts for (rating, ingredients dict) pairs"""
+    counters = dict.fromkeys(STAT_COLUMNS, 0)
+    ingredients = {}
+
+    for rating, matched in scans:
+        counters['total_scans'] += 1
+        kind = rating_type(rating)
+        if kind != 'retry':
+            counters[f'{kind}_scans'] += 1
+
+        detected = set()
+        if isinstance(matched, dict):
+            for category, items in matched.items():
+                if isinstance(items, list) and items:
+                    detected.update(items)
+                    if category in STAT_CATEGORIES:
+                        counters[f'{category}_scans'] += 1
+
+        counters['ingredients_found'] += len(detected)
+        for ingredient in detected:
+            ingredients[ingredient] = ingredients.get(ingredient, 0) + 1
+
+    return counters, ingredients
+
+class Repository:
+    """Base class - runs the subclass's named SQL on a pooled connection"""
+
+    SQL = {}
+
+    def __init__(self, connect):
+        self.connect = connect   # returns a pooled connection; close() gives it back
+
+    @property
+    def dialect(self):
+        return current_dialect()
+
+    def _sql(self, name):
+        sql = self.SQL[name]
+        return sql[self.dialect] if isinstance(sql, dict) else sql
+
+    def _prepare(self, conn, cursor, name):
+        """Prepare a statement on this connection once - returns the EXECUTE template"""
+        statement = f"{type(self).__name__.lower()}_{name}"
+        sql = self._sql(name)
+
+        if statement not in conn.prepared:
+            cursor.execute(f"PREPARE {statement} AS {_numbered_placeholders(sql)}")
+            conn.prepared.add(statement)
+
+        placeholders = ', '.join(['%s'] * sql.count('?'))
+        return f"EXECUTE {statement} ({placeholders})" if placeholders else f"EXECUTE {statement}"
+
+    def _execute(self, conn, cursor, name, params=()):
+        if self.dialect == 'sqlite':
+            cursor.execute(self._sql(name), params)
+        elif DB_PREPARED_STATEMENTS:
+            cursor.execute(self._prepare(conn, cursor, name), params)
+        else:
+            cursor.execute(self._sql(name).replace('?', '%s'), params)
+
+    def _execute_many(self, conn, cursor, name, rows):
+        if self.dialect == 'sqlite':
+            cursor.executemany(self._sql(name), rows)
+            return
+
+        from psycopg2.extras import execute_batch
+        if DB_PREPARED_STATEMENTS:
+            execute_batch(cursor, self._prepare(conn, cursor, name), rows)
+        else:
+            execute_batch(cursor, self._sql(name).replace('?', '%s'), rows)
+
+    def fetch_one(self, name, params=()):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, name, params)
+            row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def fetch_all(self, name, params=()):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, name, params)
+            rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+
+    def write(self, name, params=()):
+        """Run one statement in its own transaction - returns the affected row count"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, name, params)
+            conn.commit()
+            return cursor.rowcount
+
+class UserRepo(Repository):
+    SQL = {
+        'get': 'SELECT * FROM users WHERE id = ?',
+        'find_by_email': 'SELECT * FROM users WHERE email = ?',
+        'email_exists': 'SELECT 1 FROM users WHERE email = ?',
+        'create': {
+            'postgresql': '''
+                INSERT INTO users (name, email, password_hash, trial_start_date, trial_end_date, last_login)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + INTERVAL '48 hours', CURRENT_TIMESTAMP)
+                RETURNING id
+            ''',
+            'sqlite': f'''
+                INSERT INTO users (name, email, password_hash, trial_start_date, trial_end_date, last_login)
+                VALUES (?, ?, ?, {SQLITE_NOW}, datetime('now', 'localtime', '+48 hours'), {SQLITE_NOW})
+            ''',
+        },
+        # Every users UPDATE returns the ids it changed so their cached rows can be dropped
+        'touch_login': {
+            'postgresql': 'UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ? RETURNING id',
+            'sqlite': f'UPDATE users SET last_login = {SQLITE_NOW} WHERE id = ? RETURNING id',
+        },
+        'set_password': 'UPDATE users SET password_hash = ? WHERE email = ? RETURNING id',
+        'set_stripe_customer': 'UPDATE users SET stripe_customer_id = ? WHERE id = ? RETURNING id',
+        'activate_premium': {
+            'postgresql': '''
+                UPDATE users
+                SET is_premium = TRUE,
+                    subscription_status = 'active',
+                    subscription_start_date = CURRENT_TIMESTAMP
+                WHERE id = ?
+                RETURNING id
+            ''',
+            'sqlite': f'''
+                UPDATE users
+                SET is_premium = 1,
+                    subscription_status = 'active',
+                    subscription_start_date = {SQLITE_NOW}
+                WHERE id = ?
+                RETURNING id
+            ''',
+        },
+        'cancel_subscription': {
+            'postgresql': "UPDATE users SET is_premium = FALSE, subscription_status = 'canceled' WHERE stripe_customer_id = ? RETURNING id",
+            'sqlite': "UPDATE users SET is_premium = 0, subscription_status = 'canceled' WHERE stripe_customer_id = ? RETURNING id",
+        },
+        'list_by_name': 'SELECT email, name FROM users ORDER BY name',
+        'list_recent': 'SELECT id, name, email, created_at, is_premium, scans_used FROM users ORDER BY created_at DESC',
+    }
+
+    def get(self, user_id):
+        """Served from user_cache when fresh - writes below invalidate it"""
+        return user_cache.get(user_id, lambda uid: self.fetch_one('get', (uid,)))
+
+    def find_by_email(self, email):
+        return self.fetch_one('find_by_email', (email,))
+
+    def email_exists(self, email):
+        return self.fetch_one('email_exists', (email,)) is not None
+
+    def create(self, name, email, password_hash):
+        """Insert a trial user - returns the new id"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'create', (name, email, password_hash))
+            user_id = cursor.fetchone()['id'] if self.dialect == 'postgresql' else cursor.lastrowid
+            conn.commit()
+        return user_id
+
+    def _update(self, name, params):
+        """Run an UPDATE ... RETURNING id, then drop the changed users from the cache - returns their ids"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, name, params)
+            user_ids = [row['id'] for row in cursor.fetchall()]
+            conn.commit()
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        return user_ids
+
+    def touch_login(self, user_id):
+        self._update('touch_login', (user_id,))
+
+    def set_password(self, email, password_hash):
+        """Returns False if no user has this email"""
+        return bool(self._update('set_password', (password_hash, email)))
+
+    def set_stripe_customer(self, user_id, customer_id):
+        self._update('set_stripe_customer', (customer_id, user_id))
+
+    def activate_premium(self, user_id):
+        self._update('activate_premium', (user_id,))
+
+    def cancel_subscription(self, customer_id):
+        self._update('cancel_subscription', (customer_id,))
+
+    def list_by_name(self):
+        return self.fetch_all('list_by_name')
+
+    def list_recent(self):
+        return self.fetch_all('list_recent')
+
+# Everything a history card shows - extracted_text (up to 1000 chars a row) is fetched on demand
+PAGE_COLUMNS = 'id, scan_id, scan_date, result_rating, ingredients_found, image_url, text_length, confidence'
+EXPORT_COLUMNS = 'scan_id, scan_date, result_rating, ingredients_found, extracted_text, extracted_text_z, confidence, text_quality'
+EXPORT_BATCH_SIZE = 500   # rows per fetchmany() while streaming an export
+
+# Rows a pending clear_history covers are hidden until the background deletion
+# (history_deletion.py) removes them. A clear covers ids up to cleared_id, plus rows
+# dated before cleared_at that a write-behind flush inserted later; a scan made in the
+# clear's second (SQLite times have 1s resolution) is split by id. Binds user_id twice.
+VISIBLE = '''scan_date >= COALESCE((SELECT cleared_at FROM history_deletions WHERE user_id = ?), '1970-01-01')
+    AND id > COALESCE((SELECT cleared_id FROM history_deletions WHERE user_id = ?), 0)'''
+
+class ScanHistoryRepo(Repository):
+    SQL = {
+        'recent': 'SELECT * FROM scan_history WHERE user_id = ? ORDER BY scan_date DESC, id DESC LIMIT ?',
+        # Keyset pages walk idx_scan_history_user_date_id - cost is the page size, not the history size.
+        # extracted_text is left out; the detail view fetches it with 'text'.
+        'first_page': f'''
+            SELECT {PAGE_COLUMNS} FROM scan_history
+            WHERE user_id = ? AND {VISIBLE}
+            ORDER BY scan_date DESC, id DESC LIMIT ?
+        ''',
+        'next_page': f'''
+            SELECT {PAGE_COLUMNS} FROM scan_history
+            WHERE user_id = ? AND {VISIBLE} AND (scan_date, id) < (?, ?)
+            ORDER BY scan_date DESC, id DESC LIMIT ?
+        ''',
+        # Blob access check - matches the image and any of its renditions
+        'owns_image': f'SELECT 1 AS owned FROM scan_history WHERE user_id = ? AND {VISIBLE} AND image_url LIKE ? LIMIT 1',
+        'text': f'SELECT extracted_text, extracted_text_z, text_length FROM scan_history WHERE scan_id = ? AND user_id = ? AND {VISIBLE}',
+        'export': f'SELECT {EXPORT_COLUMNS} FROM scan_history WHERE user_id = ? AND {VISIBLE} ORDER BY scan_date DESC, id DESC',
+        'delete_for_user': 'DELETE FROM scan_history WHERE user_id = ?',
+        # Quota check and increment in one statement - concurrent scans can't both take the last free scan
+        'reserve_scan': {
+            'postgresql': '''
+                UPDATE users
+                SET scans_used = COALESCE(scans_used, 0) + CASE WHEN is_premium THEN 0 ELSE 1 END,
+                    total_scans_ever = COALESCE(total_scans_ever, 0) + 1
+                WHERE id = ?
+                  AND (is_premium OR (COALESCE(scans_used, 0) < ?
+                       AND COALESCE(trial_start_date, LOCALTIMESTAMP) >= ?))
+                RETURNING scans_used
+            ''',
+            'sqlite': f'''
+                UPDATE users
+                SET scans_used = COALESCE(scans_used, 0) + CASE WHEN is_premium THEN 0 ELSE 1 END,
+                    total_scans_ever = COALESCE(total_scans_ever, 0) + 1
+                WHERE id = ?
+                  AND (is_premium OR (COALESCE(scans_used, 0) < ?
+                       AND COALESCE(datetime(trial_start_date), {SQLITE_NOW}) >= datetime(?)))
+                RETURNING scans_used
+            ''',
+        },
+        # Rows add_many just wrote that a clear_history tombstone already hides - {scan_ids} is a ? list
+        'hidden_scan_ids': '''
+            SELECT h.scan_id FROM scan_history h JOIN history_deletions d ON d.user_id = h.user_id
+            WHERE (h.id <= d.cleared_id OR h.scan_date < d.cleared_at) AND h.scan_id IN ({scan_ids})
+        ''',
+        # Count a scan whose reservation couldn't reach the database - it has already been shown
+        'charge_scan': '''
+            UPDATE users
+            SET scans_used = COALESCE(scans_used, 0) + CASE WHEN is_premium THEN 0 ELSE 1 END,
+                total_scans_ever = COALESCE(total_scans_ever, 0) + 1
+            WHERE id = ?
+        ''',
+        # PostgreSQL does the quota reservation and the history insert in a single round-trip
+        'record_scan': '''
+            WITH quota AS (
+                UPDATE users
+                SET scans_used = COALESCE(scans_used, 0) + CASE WHEN is_premium THEN 0 ELSE 1 END,
+                    total_scans_ever = COALESCE(total_scans_ever, 0) + 1
+                WHERE id = ?
+                  AND (is_premium OR (COALESCE(scans_used, 0) < ?
+                       AND COALESCE(trial_start_date, LOCALTIMESTAMP) >= ?))
+                RETURNING id, scans_used
+            )
+            INSERT INTO scan_history (
+                user_id, result_rating, ingredients_found, scan_date, scan_id,
+                extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
+            )
+            SELECT quota.id, ?::text, ?::jsonb, CURRENT_TIMESTAMP, ?::text,
+                   ?::text, ?::integer, ?::text, ?::text, ?::boolean, ?::text
+            FROM quota
+            RETURNING (SELECT scans_used FROM quota) AS scans_used
+        ''',
+        # Batched, explicitly dated inserts for the write-behind queue. A replayed spool
+        # can't duplicate rows: scan_id is unique and conflicts are skipped.
+        'insert_batch': {
+            'postgresql': '''
+                INSERT INTO scan_history (
+                    user_id, result_rating, ingredients_found, scan_date, scan_id,
+                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
+                )
+                VALUES %s
+                ON CONFLICT (scan_id) DO NOTHING
+                RETURNING scan_id
+            ''',
+            'sqlite': '''
+                INSERT INTO scan_history (
+                    user_id, result_rating, ingredients_found, scan_date, scan_id,
+                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (scan_id) DO NOTHING
+            ''',
+        },
+        'insert': {
+            'postgresql': '''
+                INSERT INTO scan_history (
+                    user_id, result_rating, ingredients_found, scan_date, scan_id,
+                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
+                )
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            'sqlite': f'''
+                INSERT INTO scan_history (
+                    user_id, result_rating, ingredients_found, scan_date, scan_id,
+                    extracted_text, text_length, confidence, text_quality, has_safety_labels, image_url
+                )
+                VALUES (?, ?, ?, {SQLITE_NOW}, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+        },
+    }
+
+    def __init__(self, connect):
+        super().__init__(connect)
+        self.scan_stats = ScanStatsRepo(connect)   # written in the same transactions as history
+        self.image_blobs = ImageBlobRepo(connect)
+        self.text_dictionaries = TextDictionaryRepo(connect)
+
+    @staticmethod
+    def entry_params(user_id, result, image_url):
+        """Row values for one scan result, in 'insert' column order"""
+        return (
+            user_id,
+            result.get('rating', ''),
+            ingredient_codec.dumps(result.get('matched_ingredients', {})),
+            str(uuid.uuid4()),
+            result.get('extracted_text', '')[:1000],
+            result.get('extracted_text_length', 0),
+            result.get('confidence', 'medium'),
+            result.get('text_quality', 'unknown'),
+            bool(result.get('has_safety_labels', False)),
+            image_url,
+        )
+
+    def dated_entry(self, user_id, result, image_url):
+        """entry_params plus the scan time, for rows written after the request has finished"""
+        if self.dialect == 'postgresql':
+            # Cast with ::timestamptz - stored in the session time zone, as CURRENT_TIMESTAMP would be
+            scan_date = datetime.now(timezone.utc).isoformat()
+        else:
+            scan_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        entry = self.entry_params(user_id, result, image_url)
+        return entry[:3] + (scan_date,) + entry[3:]
+
+    @staticmethod
+    def decode_row(row):
+        """ingredients_found as a dict - JSONB arrives decoded, SQLite stores JSON text"""
+        row['ingredients_found'] = ingredient_codec.decode(row.get('ingredients_found'))
+        return row
+
+    def inflate_text(self, row, dictionary=None):
+        """extracted_text from extracted_text_z for rows retention.py has compressed
+
+        dictionary(id) looks up preset dictionaries - pass one bound to the caller's
+        connection when it already holds one (see stream_for_user).
+        """
+        payload = row.pop('extracted_text_z', None)
+        if row.get('extracted_text') is None and payload is not None:
+            row['extracted_text'] = text_codec.decompress(payload, dictionary or self.text_dictionaries.get)
+        return row
+
+    def recent(self, user_id, limit=50):
+        return [self.inflate_text(self.decode_row(row)) for row in self.fetch_all('recent', (user_id, limit))]
+
+    @staticmethod
+    def encode_cursor(row):
+        """Opaque cursor for the page after this row - its (scan_date, id) sort key"""
+        scan_date = row['scan_date']
+        if not isinstance(scan_date, str):
+            scan_date = scan_date.isoformat(sep=' ')
+        raw = json.dumps([scan_date, row['id']]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """(scan_date, id) from encode_cursor(), or None if the cursor is malformed"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            scan_date, row_id = json.loads(raw)
+            return str(scan_date), int(row_id)
+        except (ValueError, TypeError):
+            return None
+
+    def page(self, user_id, limit, cursor=None):
+        """One page of history cards, newest first - returns (rows, next_cursor or None)"""
+        after = self.decode_cursor(cursor) if cursor else None
+
+        # One extra row tells us whether another page exists
+        if after:
+            rows = self.fetch_all('next_page', (user_id, user_id, user_id, after[0], after[1], limit + 1))
+        else:
+            rows = self.fetch_all('first_page', (user_id, user_id, user_id, limit + 1))
+
+        next_cursor = self.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return [self.decode_row(row) for row in rows[:limit]], next_cursor
+
+    def owns_image(self, user_id, image_url):
+        """Whether one of the user's scans uses this blob (or the blob this rendition was made from)"""
+        return self.fetch_one('owns_image', (user_id, user_id, user_id, f"{blob_store.stem_url(image_url)}.%")) is not None
+
+    def text(self, user_id, scan_id):
+        """extracted_text for one of the user's scans, or None"""
+        row = self.fetch_one('text', (scan_id, user_id, user_id, user_id))
+        return self.inflate_text(row) if row else None
+
+    def stream_for_user(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """Yield the user's scans newest first, holding at most batch_size rows in memory
+
+        The pooled connection stays checked out until the generator is exhausted or
+        closed (Flask closes it when the client disconnects).
+        """
+        with self.connect() as conn:
+            if self.dialect == 'postgresql':
+                # Named cursor = server-side DECLARE/FETCH; it can't be backed by a prepared statement
+                cursor = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+                cursor.itersize = batch_size
+                cursor.execute(self._sql('export').replace('?', '%s'), (user_id, user_id, user_id))
+            else:
+                cursor = conn.cursor()
+                self._execute(conn, cursor, 'export', (user_id, user_id, user_id))
+
+            # Dictionary lookups share the export's connection instead of checking out a second one
+            lookup = conn.cursor()
+            dictionary = functools.partial(self.text_dictionaries.load, conn, lookup)
+
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield self.inflate_text(self.decode_row(dict(row)), dictionary)
+            finally:
+                lookup.close()
+                cursor.close()
+
+    def delete_for_user(self, user_id):
+        """Delete the user's history, reset their stats and release their images in one transaction"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self.image_blobs.release_for_user(conn, cursor, user_id)
+            self._execute(conn, cursor, 'delete_for_user', (user_id,))
+            deleted = cursor.rowcount
+            self.scan_stats.clear(conn, cursor, user_id)
+            conn.commit()
+        return deleted
+
+    def record_scan(self, user_id, result, image_url, free_scan_limit, trial_cutoff):
+        """Reserve one scan of quota and add the history row atomically
+
+        Returns the user's new scans_used, or None (nothing written) when the free
+        quota or the trial ran out - premium users are never limited.
+        """
+        entry = self.entry_params(user_id, result, image_url)
+
+        with self.connect() as conn:
+            cursor = conn.cursor()
+
+            if self.dialect == 'postgresql':
+                self._execute(conn, cursor, 'record_scan', (user_id, free_scan_limit, trial_cutoff) + entry[1:])
+                row = cursor.fetchone()
+            else:
+                self._execute(conn, cursor, 'reserve_scan', (user_id, free_scan_limit, self._cutoff(trial_cutoff)))
+                row = cursor.fetchone()
+                if row:
+                    self._execute(conn, cursor, 'insert', entry)
+
+            if not row:
+                conn.rollback()
+                return None
+
+            self.scan_stats.add(conn, cursor, user_id, [(result.get('rating', ''), result.get('matched_ingredients', {}))])
+            self.image_blobs.add(conn, cursor, [image_url])
+            conn.commit()
+
+        user_cache.invalidate(user_id)   # scans_used and total_scans_ever changed
+        return row['scans_used']
+
+    def _cutoff(self, trial_cutoff):
+        return trial_cutoff if self.dialect == 'postgresql' else trial_cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+    def reserve_scan(self, user_id, free_scan_limit, trial_cutoff):
+        """Take one scan of quota without writing history - returns the new scans_used, or None"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'reserve_scan', (user_id, free_scan_limit, self._cutoff(trial_cutoff)))
+            row = cursor.fetchone()
+            conn.commit()
+
+        if row:
+            user_cache.invalidate(user_id)
+        return row['scans_used'] if row else None
+
+    def _hidden_scan_ids(self, cursor, scan_ids):
+        """The scan_ids among these that a clear_history tombstone hides - runs in the caller's transaction"""
+        if not scan_ids:
+            return set()
+        # The IN list varies in length, so this one isn't a prepared statement
+        sql = self._sql('hidden_scan_ids').format(scan_ids=', '.join('?' for _ in scan_ids))
+        if self.dialect == 'postgresql':
+            sql = sql.replace('?', '%s')
+        cursor.execute(sql, [str(scan_id) for scan_id in scan_ids])
+        return {str(row['scan_id']) for row in cursor.fetchall()}
+
+    def add_many(self, entries, charge=()):
+        """Insert dated_entry() rows in one multi-row INSERT and one commit - returns how many were new
+
+        Rows whose scan_id already exists are skipped, along with their stats. Users in
+        charge (one item per scan) are also counted against their quota.
+        """
+        if not entries:
+            return 0
+
+        with self.connect() as conn:
+            cursor = conn.cursor()
+
+            if self.dialect == 'postgresql':
+                from psycopg2.extras import execute_values
+                template = '(%s, %s, %s, %s::timestamptz, %s, %s, %s, %s, %s, %s, %s)'
+                inserted = {row['scan_id'] for row in execute_values(
+                    cursor, self._sql('insert_batch'), entries, template=template, page_size=len(entries), fetch=True)}
+            else:
+                inserted = set()
+                for entry in entries:
+                    cursor.execute(self._sql('insert_batch'), entry)
+                    if cursor.rowcount == 1:
+                        inserted.add(entry[4])
+
+            # A row queued before a clear_history and written after it is hidden at once -
+            # it still uses quota and holds its image, but must not count in the stats
+            hidden = self._hidden_scan_ids(cursor, inserted)
+
+            # A replayed spool can repeat a scan_id within one batch - count each row once
+            by_user, charged, images, pending = {}, [], [], set(inserted)
+            for entry, user_charged in zip(entries, charge or [False] * len(entries)):
+                if entry[4] not in pending:
+                    continue
+                pending.discard(entry[4])
+                if entry[4] not in hidden:
+                    by_user.setdefault(entry[0], []).append((entry[1], ingredient_codec.decode(entry[2])))
+                images.append(entry[-1])
+                if user_charged:
+                    charged.append((entry[0],))
+            for user_id, scans in by_user.items():
+                self.scan_stats.add(conn, cursor, user_id, scans)
+            self.image_blobs.add(conn, cursor, images)
+
+            if charged:
+                self._execute_many(conn, cursor, 'charge_scan', charged)
+
+            conn.commit()
+
+        for user_id in {row[0] for row in charged}:
+            user_cache.invalidate(user_id)
+        return len(inserted)
+
+class ScanStatsRepo(Repository):
+    """Per-user dashboard totals, updated by history writes instead of recomputed on read"""
+
+    SQL = {
+        'get': 'SELECT * FROM user_scan_stats WHERE user_id = ?',
+        'top_ingredients': '''
+            SELECT ingredient, scans FROM user_ingredient_stats
+            WHERE user_id = ? ORDER BY scans DESC, ingredient LIMIT ?
+        ''',
+        'add': f'''
+            INSERT INTO user_scan_stats (user_id, {', '.join(STAT_COLUMNS)}, updated_at)
+            VALUES (?, {', '.join('?' for _ in STAT_COLUMNS)}, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET
+                {', '.join(f'{column} = user_scan_stats.{column} + excluded.{column}' for column in STAT_COLUMNS)},
+                updated_at = CURRENT_TIMESTAMP
+        ''',
+        'add_ingredient': '''
+            INSERT INTO user_ingredient_stats (user_id, ingredient, scans) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, ingredient) DO UPDATE SET scans = user_ingredient_stats.scans + excluded.scans
+        ''',
+        'clear': 'DELETE FROM user_scan_stats WHERE user_id = ?',
+        'clear_ingredients': 'DELETE FROM user_ingredient_stats WHERE user_id = ?',
+        # Takes the row lock record_scan's quota UPDATE takes - a rebuild and a scan can't interleave
+        'lock_user': {
+            'postgresql': 'SELECT id FROM users WHERE id = ? FOR UPDATE',
+            'sqlite': 'UPDATE users SET id = id WHERE id = ?',
+        },
+        'scans_for_user': f'SELECT result_rating, ingredients_found FROM scan_history WHERE user_id = ? AND {VISIBLE}',
+        'user_ids': 'SELECT id FROM users ORDER BY id',
+    }
+
+    def get(self, user_id):
+        """The user's stats row - zeros if they have never scanned"""
+        row = self.fetch_one('get', (user_id,))
+        if row is None:
+            row = dict.fromkeys(STAT_COLUMNS, 0)
+            row['user_id'] = user_id
+        return row
+
+    def top_ingredients(self, user_id, limit=10):
+        return self.fetch_all('top_ingredients', (user_id, limit))
+
+    def total_scans(self, conn, cursor, user_id):
+        """The user's total_scans counter - runs on the caller's connection"""
+        self._execute(conn, cursor, 'get', (user_id,))
+        row = cursor.fetchone()
+        return row['total_scans'] if row else 0
+
+    def add(self, conn, cursor, user_id, scans):
+        """Count (rating, ingredients) pairs into the user's stats - runs in the caller's transaction"""
+        counters, ingredients = summarize_scans(scans)
+        self._execute(conn, cursor, 'add', (user_id,) + tuple(counters[column] for column in STAT_COLUMNS))
+        if ingredients:
+            # Sorted so concurrent upserts lock ingredient rows in the same order
+            self._execute_many(conn, cursor, 'add_ingredient',
+                               [(user_id, ingredient, count) for ingredient, count in sorted(ingredients.items())])
+
+    def clear(self, conn, cursor, user_id):
+        """Reset the user's stats - runs in the caller's transaction"""
+        self._execute(conn, cursor, 'clear', (user_id,))
+        self._execute(conn, cursor, 'clear_ingredients', (user_id,))
+
+    def rebuild(self, user_id):
+        """Recount one user's stats from scan_history - returns the number of scans counted"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'lock_user', (user_id,))
+            self.clear(conn, cursor, user_id)
+
+            self._execute(conn, cursor, 'scans_for_user', (user_id, user_id, user_id))
+            scans = [(row['result_rating'], ScanHistoryRepo.decode_row(dict(row))['ingredients_found'])
+                     for row in cursor.fetchall()]
+            if scans:
+                self.add(conn, cursor, user_id, scans)
+
+            conn.commit()
+        return len(scans)
+
+    def user_ids(self):
+        return [row['id'] for row in self.fetch_all('user_ids')]
+
+class ImageBlobRepo(Repository):
+    """Reference counts for content-addressed scan images (blob_store.py)"""
+
+    SQL = {
+        'add': '''
+            INSERT INTO image_blobs (image_url, ref_count, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (image_url) DO UPDATE SET
+                ref_count = image_blobs.ref_count + excluded.ref_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''',
+        # Run before the user's rows are deleted - subtracts each blob's count of them
+        'release_for_user': '''
+            UPDATE image_blobs
+            SET ref_count = ref_count - (
+                    SELECT COUNT(*) FROM scan_history
+                    WHERE scan_history.user_id = ? AND scan_history.image_url = image_blobs.image_url),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE image_url IN (SELECT image_url FROM scan_history WHERE user_id = ?)
+        ''',
+        'release': '''
+            UPDATE image_blobs SET ref_count = ref_count - ?, updated_at = CURRENT_TIMESTAMP
+            WHERE image_url = ?
+        ''',
+        'referenced': 'SELECT image_url FROM image_blobs WHERE ref_count > 0',
+        'forget': 'DELETE FROM image_blobs WHERE image_url LIKE ? AND ref_count <= 0',
+    }
+
+    def add(self, conn, cursor, image_urls):
+        """Count new history rows pointing at these images - runs in the caller's transaction"""
+        counts = {}
+        for image_url in image_urls:
+            if blob_store.is_blob_url(image_url):
+                counts[image_url] = counts.get(image_url, 0) + 1
+        if counts:
+            # Sorted so concurrent upserts lock blob rows in the same order
+            self._execute_many(conn, cursor, 'add', sorted(counts.items()))
+
+    def release_for_user(self, conn, cursor, user_id):
+        """Drop the references held by the user's history - runs in the caller's transaction"""
+        self._execute(conn, cursor, 'release_for_user', (user_id, user_id))
+
+    def release(self, conn, cursor, image_urls):
+        """Drop one reference per deleted history row - runs in the caller's transaction"""
+        counts = {}
+        for image_url in image_urls:
+            if blob_store.is_blob_url(image_url):
+                counts[image_url] = counts.get(image_url, 0) + 1
+        if counts:
+            self._execute_many(conn, cursor, 'release', [(count, image_url) for image_url, count in sorted(counts.items())])
+
+    def referenced_urls(self):
+        return {row['image_url'] for row in self.fetch_all('referenced')}
+
+    def forget(self, stem_url):
+        """Remove an unreferenced blob's row once GC has deleted its files (blob_store.stem_url)"""
+        self.write('forget', (f"{stem_url}.%",))
+
+DELETION_LEASE_SECONDS = 120   # a job whose worker died is picked up again after this
+
+class HistoryDeletionRepo(Repository):
+    """clear_history tombstones and the batched deletes behind them (history_deletion.py)"""
+
+    SQL = {
+        # Hides the user's rows at once (see VISIBLE); a repeated clear moves the cut-off forward
+        'request': {
+            'postgresql': '''
+                INSERT INTO history_deletions (user_id, cleared_at, cleared_id, total_rows, deleted_rows, requested_at)
+                VALUES (?, CURRENT_TIMESTAMP, (SELECT COALESCE(MAX(id), 0) FROM scan_history WHERE user_id = ?),
+                        ?, 0, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    cleared_at = excluded.cleared_at,
+                    cleared_id = excluded.cleared_id,
+                    total_rows = history_deletions.total_rows - history_deletions.deleted_rows + excluded.total_rows,
+                    deleted_rows = 0,
+                    requested_at = excluded.requested_at,
+                    finished_at = NULL
+            ''',
+            'sqlite': f'''
+                INSERT INTO history_deletions (user_id, cleared_at, cleared_id, total_rows, deleted_rows, requested_at)
+                VALUES (?, {SQLITE_NOW}, (SELECT COALESCE(MAX(id), 0) FROM scan_history WHERE user_id = ?),
+                        ?, 0, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    cleared_at = excluded.cleared_at,
+                    cleared_id = excluded.cleared_id,
+                    total_rows = history_deletions.total_rows - history_deletions.deleted_rows + excluded.total_rows,
+                    deleted_rows = 0,
+                    requested_at = excluded.requested_at,
+                    finished_at = NULL
+            ''',
+        },
+        'status': 'SELECT * FROM history_deletions WHERE user_id = ?',
+        'pending': {
+            'postgresql': '''
+                SELECT user_id FROM history_deletions
+                WHERE finished_at IS NULL AND (lease_until IS NULL OR lease_until < CURRENT_TIMESTAMP)
+                ORDER BY requested_at
+            ''',
+            'sqlite': '''
+                SELECT user_id FROM history_deletions
+                WHERE finished_at IS NULL AND (lease_until IS NULL OR lease_until < datetime('now'))
+                ORDER BY requested_at
+            ''',
+        },
+        # One worker per job - the lease is renewed by every batch
+        'claim': {
+            'postgresql': f'''
+                UPDATE history_deletions SET lease_until = CURRENT_TIMESTAMP + INTERVAL '{DELETION_LEASE_SECONDS} seconds'
+                WHERE user_id = ? AND finished_at IS NULL AND (lease_until IS NULL OR lease_until < CURRENT_TIMESTAMP)
+                RETURNING user_id
+            ''',
+            'sqlite': f'''
+                UPDATE history_deletions SET lease_until = datetime('now', '+{DELETION_LEASE_SECONDS} seconds')
+                WHERE user_id = ? AND finished_at IS NULL AND (lease_until IS NULL OR lease_until < datetime('now'))
+                RETURNING user_id
+            ''',
+        },
+        # FOR UPDATE waits out a retention purge of the same rows, then sees its image_url = NULL
+        'batch': {
+            'postgresql': '''
+                SELECT id, image_url FROM scan_history
+                WHERE user_id = ? AND (id <= (SELECT cleared_id FROM history_deletions WHERE user_id = ?)
+                                       OR scan_date < (SELECT cleared_at FROM history_deletions WHERE user_id = ?))
+                ORDER BY scan_date, id LIMIT ?
+                FOR UPDATE
+            ''',
+            'sqlite': '''
+                SELECT id, image_url FROM scan_history
+                WHERE user_id = ? AND (id <= (SELECT cleared_id FROM history_deletions WHERE user_id = ?)
+                                       OR scan_date < (SELECT cleared_at FROM history_deletions WHERE user_id = ?))
+                ORDER BY scan_date, id LIMIT ?
+            ''',
+        },
+        'delete_row': 'DELETE FROM scan_history WHERE id = ?',
+        'progress': {
+            'postgresql': f'''
+                UPDATE history_deletions
+                SET deleted_rows = deleted_rows + ?,
+                    lease_until = CURRENT_TIMESTAMP + INTERVAL '{DELETION_LEASE_SECONDS} seconds'
+                WHERE user_id = ?
+            ''',
+            'sqlite': f'''
+                UPDATE history_deletions
+                SET deleted_rows = deleted_rows + ?, lease_until = datetime('now', '+{DELETION_LEASE_SECONDS} seconds')
+                WHERE user_id = ?
+            ''',
+        },
+        # Only if nothing is left - a clear requested meanwhile moved the cut-off and keeps the job open
+        'finish': '''
+            UPDATE history_deletions SET finished_at = CURRENT_TIMESTAMP, lease_until = NULL
+            WHERE user_id = ? AND NOT EXISTS (
+                SELECT 1 FROM scan_history
+                WHERE scan_history.user_id = history_deletions.user_id
+                  AND (scan_history.id <= history_deletions.cleared_id OR scan_date < history_deletions.cleared_at))
+            RETURNING user_id
+        ''',
+        'release_lease': 'UPDATE history_deletions SET lease_until = NULL WHERE user_id = ?',
+    }
+
+    def __init__(self, connect):
+        super().__init__(connect)
+        self.scan_stats = ScanStatsRepo(connect)
+        self.image_blobs = ImageBlobRepo(connect)
+
+    def request(self, user_id):
+        """Tombstone the user's history and reset their stats - returns the rows now hidden"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            hidden = self.scan_stats.total_scans(conn, cursor, user_id)
+            self._execute(conn, cursor, 'request', (user_id, user_id, hidden))
+            self.scan_stats.clear(conn, cursor, user_id)
+            conn.commit()
+        return hidden
+
+    def status(self, user_id):
+        return self.fetch_one('status', (user_id,))
+
+    def pending(self):
+        return [row['user_id'] for row in self.fetch_all('pending')]
+
+    def claim(self, user_id):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'claim', (user_id,))
+            claimed = cursor.fetchone() is not None
+            conn.commit()
+        return claimed
+
+    def release_lease(self, user_id):
+        self.write('release_lease', (user_id,))
+
+    def delete_batch(self, user_id, limit, remove_files):
+        """Delete up to limit hidden rows in one short transaction - returns (rows deleted, finished)
+
+        remove_files(image_urls) runs before the commit: if the process dies, the rows
+        are still there and the next attempt removes the (already missing) files again.
+        """
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'batch', (user_id, user_id, user_id, limit))
+            rows = cursor.fetchall()
+
+            finished = False
+            if rows:
+                self._execute_many(conn, cursor, 'delete_row', [(row['id'],) for row in rows])
+                self.image_blobs.release(conn, cursor, [row['image_url'] for row in rows])
+                self._execute(conn, cursor, 'progress', (len(rows), user_id))
+                remove_files([row['image_url'] for row in rows if row['image_url']])
+            else:
+                self._execute(conn, cursor, 'finish', (user_id,))
+                finished = cursor.fetchone() is not None
+
+            conn.commit()
+        return len(rows), finished
+
+class TextDictionaryRepo(Repository):
+    """Preset dictionaries for compressed extracted_text (text_codec.py) - never changed once stored"""
+
+    SQL = {
+        'get': 'SELECT dictionary FROM text_dictionaries WHERE id = ?',
+        'latest': 'SELECT id, dictionary FROM text_dictionaries ORDER BY id DESC LIMIT 1',
+        'add': '''
+            INSERT INTO text_dictionaries (dictionary, samples, created_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            RETURNING id
+        ''',
+    }
+
+    def __init__(self, connect):
+        super().__init__(connect)
+        self._cache = {}   # id -> bytes; safe to keep forever, dictionaries are immutable
+
+    def get(self, dictionary_id):
+        if dictionary_id not in self._cache:
+            with self.connect() as conn:
+                return self.load(conn, conn.cursor(), dictionary_id)
+        return self._cache[dictionary_id]
+
+    def load(self, conn, cursor, dictionary_id):
+        """get() on the caller's connection"""
+        if dictionary_id not in self._cache:
+            self._execute(conn, cursor, 'get', (dictionary_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise KeyError(f"Unknown text dictionary {dictionary_id}")
+            self._cache[dictionary_id] = bytes(row['dictionary'])
+        return self._cache[dictionary_id]
+
+    def latest(self):
+        """(id, dictionary) of the newest dictionary, or None before the first is trained"""
+        row = self.fetch_one('latest')
+        if row is None:
+            return None
+        self._cache[row['id']] = bytes(row['dictionary'])
+        return row['id'], self._cache[row['id']]
+
+    def add(self, dictionary, samples):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'add', (dictionary, samples))
+            dictionary_id = cursor.fetchone()['id']
+            conn.commit()
+        self._cache[dictionary_id] = dictionary
+        return dictionary_id
+
+# Old scans of one retention tier (retention.py) - the tier is derived from users.is_premium.
+# Rows hidden by a pending clear_history are left to history_deletion.py.
+_TIER_ROWS = '''
+    FROM scan_history h JOIN users u ON u.id = h.user_id
+    WHERE h.scan_date < ? AND (CASE WHEN u.is_premium THEN 'premium' ELSE 'free' END) = ?
+      AND h.scan_date >= COALESCE((SELECT cleared_at FROM history_deletions d WHERE d.user_id = h.user_id), '1970-01-01')
+      AND h.id > COALESCE((SELECT cleared_id FROM history_deletions d WHERE d.user_id = h.user_id), 0)
+      AND (h.scan_date, h.id) > (?, ?)
+'''
+
+class RetentionRepo(Repository):
+    """Batches for retention.py - compressing old extracted_text and the per-tier purges"""
+
+    SQL = {
+        # Walks idx_scan_history_text_date - compressed rows drop out of that partial index
+        'uncompressed_text': '''
+            SELECT id, scan_date, extracted_text FROM scan_history
+            WHERE extracted_text IS NOT NULL AND scan_date < ? AND (scan_date, id) > (?, ?)
+            ORDER BY scan_date, id LIMIT ?
+        ''',
+        'store_compressed': 'UPDATE scan_history SET extracted_text = NULL, extracted_text_z = ? WHERE id = ?',
+        'text_samples': '''
+            SELECT extracted_text FROM scan_history
+            WHERE extracted_text IS NOT NULL AND extracted_text <> ''
+            ORDER BY scan_date DESC LIMIT ?
+        ''',
+        # Locked on PostgreSQL so a concurrent clear_history batch can't release the same blob reference
+        'expired_images': {
+            'postgresql': f'''
+                SELECT h.id, h.scan_date, h.image_url {_TIER_ROWS} AND h.image_url IS NOT NULL
+                ORDER BY h.scan_date, h.id LIMIT ?
+                FOR UPDATE OF h
+            ''',
+            'sqlite': f'''
+                SELECT h.id, h.scan_date, h.image_url {_TIER_ROWS} AND h.image_url IS NOT NULL
+                ORDER BY h.scan_date, h.id LIMIT ?
+            ''',
+        },
+        'clear_image': 'UPDATE scan_history SET image_url = NULL WHERE id = ?',
+        'expired_text': f'''
+            SELECT h.id, h.scan_date,
+                   COALESCE(LENGTH(h.extracted_text), 0) + COALESCE(LENGTH(h.extracted_text_z), 0) AS size
+            {_TIER_ROWS} AND (h.extracted_text IS NOT NULL OR h.extracted_text_z IS NOT NULL)
+            ORDER BY h.scan_date, h.id LIMIT ?
+        ''',
+        'clear_text': 'UPDATE scan_history SET extracted_text = NULL, extracted_text_z = NULL WHERE id = ?',
+    }
+
+    def __init__(self, connect):
+        super().__init__(connect)
+        self.image_blobs = ImageBlobRepo(connect)
+        self.text_dictionaries = TextDictionaryRepo(connect)
+
+    def text_samples(self, limit):
+        return [row['extracted_text'] for row in self.fetch_all('text_samples', (limit,))]
+
+    def uncompressed_text(self, cutoff, after, limit):
+        return self.fetch_all('uncompressed_text', (cutoff, after[0], after[1], limit))
+
+    def store_compressed(self, payloads):
+        """Replace extracted_text with (row id, payload) pairs in one transaction"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute_many(conn, cursor, 'store_compressed', [(payload, row_id) for row_id, payload in payloads])
+            conn.commit()
+
+    def purge_images(self, tier, cutoff, after, limit, apply=True):
+        """Drop the images of up to limit of a tier's scans older than cutoff, after the (scan_date, id)
+        key - returns the rows, whose blob references are released in the same transaction
+
+        With apply=False the rows are only selected (retention.py --dry-run).
+        """
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'expired_images', (cutoff, tier, after[0], after[1], limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            if rows and apply:
+                self._execute_many(conn, cursor, 'clear_image', [(row['id'],) for row in rows])
+                self.image_blobs.release(conn, cursor, [row['image_url'] for row in rows])
+            conn.commit()
+        return rows
+
+    def purge_text(self, tier, cutoff, after, limit, apply=True):
+        """Drop extracted_text of up to limit of a tier's scans older than cutoff - returns the rows with their size"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            self._execute(conn, cursor, 'expired_text', (cutoff, tier, after[0], after[1], limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            if rows and apply:
+                self._execute_many(conn, cursor, 'clear_text', [(row['id'],) for row in rows])
+            conn.commit()
+        return rows
@@ -0,0 +1,51 @@
+# request_deadline.py - Per-request time limits that work in threaded workers
+#
+# Route and OCR timeouts used signal.alarm(), which only exists in the main thread
+# and is process-wide: under gthread workers a second request's alarm would cancel
+# or hijack the first one's. A deadline is now kept per thread (per greenlet when
+# gevent patches threading) and enforced cooperatively:
+#
+#     with request_deadline.limit(90):
+#         ...
+#         timeout = request_deadline.timeout(30)   # min(30, time left) for a network call
+#         request_deadline.check("OCR step")       # raises TimeoutError once it has passed
+#
+# Nested limits never extend an outer one. CPU-bound work between checks isn't
+# interrupted - the gunicorn worker timeout stays the backstop for that.
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+@contextmanager
+def limit(seconds):
+    """Run the block under a deadline seconds from now (or the enclosing one, if sooner)"""
+    outer = getattr(_local, 'deadline', None)
+    deadline = time.monotonic() + seconds
+    _local.deadline = deadline if outer is None else min(outer, deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def remaining():
+    """Seconds left before the current deadline, or None outside any limit"""
+    deadline = getattr(_local, 'deadline', None)
+    return None if deadline is None else deadline - time.monotonic()
+
+def check(stage=""):
+    """Raise TimeoutError if the current deadline has passed"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise TimeoutError(f"Deadline exceeded{' at ' + stage if stage else ''}")
+
+def timeout(seconds):
+    """Timeout for a blocking call - seconds, capped to the time left (raises if none is)"""
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise TimeoutError("Deadline exceeded before a blocking call")
+    return min(seconds, left)
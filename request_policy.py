@@ -0,0 +1,90 @@
+# request_policy.py - Per-endpoint request middleware
+#
+# The app used to run gc.collect() three times, read RSS twice, reset PIL's pixel
+# limit and sometimes sleep 100ms around every request - static files, /health and
+# the login page included. Now every request gets only cheap timing and metrics (two
+# perf_counter reads and a dict update), and the endpoints that decode images opt in
+# to memory management:
+#
+#     @app.route('/', methods=['POST'])
+#     @request_policy.memory_managed
+#     def scan(): ...
+#
+# memory_managed goes through memory_governor, which only collects when RSS is over
+# budget and never sleeps. Per-endpoint counts and latencies are in /health.
+
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+
+import memory_governor
+
+SLOW_REQUEST_SECONDS = 30    # logged at INFO
+VERY_SLOW_REQUEST_SECONDS = 60   # logged at WARNING
+
+_lock = threading.Lock()
+_metrics = {}   # endpoint -> [requests, server errors, total seconds, max seconds]
+
+def init_app(app):
+    """Install the timing and metrics hooks that every request gets"""
+    app.before_request(_start_timer)
+    app.after_request(_record)
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+def _record(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+
+    with _lock:
+        entry = _metrics.get(endpoint)
+        if entry is None:
+            entry = _metrics[endpoint] = [0, 0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += response.status_code >= 500
+        entry[2] += elapsed
+        entry[3] = max(entry[3], elapsed)
+
+    response.headers['Server-Timing'] = f"app;dur={elapsed * 1000:.1f}"
+    if response.status_code >= 500:
+        # Never let a proxy or browser cache an error page
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    if elapsed > VERY_SLOW_REQUEST_SECONDS:
+        print(f"WARNING: Long request took {elapsed:.1f}s for {endpoint}")
+    elif elapsed > SLOW_REQUEST_SECONDS:
+        print(f"INFO: Moderate request took {elapsed:.1f}s for {endpoint}")
+    return response
+
+def memory_managed(view):
+    """Memory governor accounting and budget checks around an image-decoding endpoint"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        memory_governor.begin_request()
+        memory_governor.check(f"{request.endpoint} start")
+        try:
+            return view(*args, **kwargs)
+        finally:
+            memory_governor.check(f"{request.endpoint} end")
+    return wrapper
+
+def stats():
+    """Per-endpoint request counts and latencies since the worker started"""
+    with _lock:
+        return {
+            endpoint: {
+                'requests': requests,
+                'server_errors': errors,
+                'avg_ms': round(total / requests * 1000, 1),
+                'max_ms': round(longest * 1000, 1),
+            }
+            for endpoint, (requests, errors, total, longest) in sorted(_metrics.items())
+        }
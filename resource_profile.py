@@ -0,0 +1,217 @@
+# resource_profile.py - One resource profile for every stage of the scan service
+#
+# Loaded once at startup. The base profile is picked from RESOURCE_PROFILE (or the
+# host size, with the legacy RENDER_TIER signal), then capped to what the host
+# actually has - CPU quota and memory limit are read from cgroups when present.
+# Tuning for a bigger box is a change to PROFILES, checked with:
+#
+#     python resource_profile.py [image ...]
+
+import os
+import sys
+import time
+from dataclasses import dataclass, replace, asdict
+
+import psutil
+
+# Threads in every worker that check out a database connection besides the request
+# threads: history_writer, history_deletion and retention
+BACKGROUND_DB_THREADS = 3
+
+@dataclass(frozen=True)
+class ResourceProfile:
+    name: str
+
+    # Web server
+    workers: int
+    threads: int                  # request threads per worker - scans mostly wait on OCR.space
+    max_content_length_mb: int
+    max_upload_mb: int
+
+    # Memory management
+    memory_threshold_mb: int      # governor collects above this RSS
+    memory_warning_mb: int        # log a warning when a scan starts above this
+    memory_critical_mb: int       # skip an OCR attempt above this
+    gc_growth_mb: int             # RSS growth needed before collecting again
+    admission_budget_mb: int      # projected decode memory shared by concurrent scans
+    max_image_pixels: int
+
+    # Compression for OCR upload
+    ocr_quality_levels: tuple
+    progressive_ocr_steps: tuple   # (max dimension px, max upload KB) per step
+
+    # OCR
+    ocr_attempts: int
+    ocr_timeout: int               # whole attempt, seconds
+    ocr_request_timeout: int       # single OCR.space HTTP call, seconds
+    ocr_retry_wait: int
+
+    @property
+    def db_pool_size(self):
+        """Database connections per worker - one per request thread and background thread"""
+        return self.threads + BACKGROUND_DB_THREADS
+
+PROFILES = {
+    'standard': ResourceProfile(
+        name='standard',
+        workers=2,
+        threads=4,
+        max_content_length_mb=5,
+        max_upload_mb=3,
+        memory_threshold_mb=120,
+        memory_warning_mb=150,
+        memory_critical_mb=200,
+        gc_growth_mb=32,
+        admission_budget_mb=160,
+        max_image_pixels=30000000,
+        ocr_quality_levels=(30, 25, 20, 15, 12),
+        progressive_ocr_steps=((700, 40), (1200, 80)),
+        ocr_attempts=2,
+        ocr_timeout=45,
+        ocr_request_timeout=20,
+        ocr_retry_wait=2,
+    ),
+    'professional': ResourceProfile(
+        name='professional',
+        workers=2,
+        threads=8,
+        max_content_length_mb=15,
+        max_upload_mb=12,
+        memory_threshold_mb=2000,
+        memory_warning_mb=1500,
+        memory_critical_mb=2000,
+        gc_growth_mb=128,
+        admission_budget_mb=1200,
+        max_image_pixels=50000000,
+        ocr_quality_levels=(70, 60, 50, 40, 30, 25, 20),
+        progressive_ocr_steps=((1000, 120), (2000, 500)),
+        ocr_attempts=3,
+        ocr_timeout=90,
+        ocr_request_timeout=30,
+        ocr_retry_wait=1,
+    ),
+}
+
+# Bigger boxes: same OCR behaviour as professional, more workers and memory
+PROFILES['performance'] = replace(
+    PROFILES['professional'],
+    name='performance',
+    workers=4,
+    admission_budget_mb=4000,
+    memory_threshold_mb=3000,
+    memory_warning_mb=2500,
+    memory_critical_mb=3500,
+    gc_growth_mb=256,
+)
+
+def _read_cgroup(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def measure_host():
+    """CPU and memory actually available to this container"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2 "quota period", then cgroup v1
+    cpu_max = _read_cgroup('/sys/fs/cgroup/cpu.max')
+    if cpu_max and not cpu_max.startswith('max'):
+        quota, period = cpu_max.split()[:2]
+        cpus = min(cpus, max(1, round(int(quota) / int(period))))
+    else:
+        quota = _read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if quota and period and int(quota) > 0:
+            cpus = min(cpus, max(1, round(int(quota) / int(period))))
+
+    memory_limit_mb = psutil.virtual_memory().total / 1024 / 1024
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = _read_cgroup(path)
+        if limit and limit.isdigit():
+            memory_limit_mb = min(memory_limit_mb, int(limit) / 1024 / 1024)
+            break
+
+    return {'cpus': cpus, 'memory_limit_mb': int(memory_limit_mb)}
+
+def select_profile_name(host):
+    """Explicit RESOURCE_PROFILE wins, then host size - RENDER_TIER only lifts a small host to professional"""
+    explicit = os.getenv('RESOURCE_PROFILE')
+    if explicit:
+        if explicit not in PROFILES:
+            raise ValueError(f"Unknown RESOURCE_PROFILE '{explicit}' - expected one of {sorted(PROFILES)}")
+        return explicit
+
+    # WEB_CONCURRENCY is only the worker count (gunicorn.conf.py), not a tier
+    if host['memory_limit_mb'] >= 8192 and host['cpus'] >= 4:
+        return 'performance'
+    if os.getenv('RENDER_TIER') == 'professional' or host['memory_limit_mb'] >= 2048:
+        return 'professional'
+    return 'standard'
+
+def tune_for_host(profile, host):
+    """Cap the memory-dependent settings to what the host can actually hold"""
+    workers = max(1, min(profile.workers, host['cpus'] * 2 + 1))
+    per_worker_mb = host['memory_limit_mb'] / workers
+
+    return replace(
+        profile,
+        workers=workers,
+        admission_budget_mb=int(min(profile.admission_budget_mb, host['memory_limit_mb'] * 0.5)),
+        memory_threshold_mb=int(min(profile.memory_threshold_mb, per_worker_mb * 0.6)),
+        memory_warning_mb=int(min(profile.memory_warning_mb, per_worker_mb * 0.7)),
+        memory_critical_mb=int(min(profile.memory_critical_mb, per_worker_mb * 0.85)),
+    )
+
+def request_threads(profile):
+    """Request threads per worker gunicorn will actually run (gunicorn.conf.py)"""
+    if os.getenv('GUNICORN_WORKER_CLASS', 'gthread') != 'gthread':
+        return 1
+    return int(os.getenv('GUNICORN_THREADS', profile.threads))
+
+def load_profile():
+    """Measure the host and build the profile every stage reads from"""
+    host = measure_host()
+    profile = tune_for_host(PROFILES[select_profile_name(host)], host)
+    profile = replace(profile, threads=request_threads(profile))
+    print(f"INFO: Resource profile '{profile.name}' - {host['cpus']} CPUs, {host['memory_limit_mb']} MB limit, "
+          f"{profile.workers} workers x {profile.threads} threads, {profile.admission_budget_mb} MB admission budget")
+    return profile
+
+PROFILE = load_profile()
+
+def benchmark(image_paths, profile=PROFILE):
+    """Time the OCR rendition ladder for sample images under a profile - no network calls"""
+    from image_asset import ImageAsset
+
+    timings = []
+    for image_path in image_paths:
+        started = time.perf_counter()
+        decode_dim = max(dim for dim, _ in profile.progressive_ocr_steps)
+        with ImageAsset(image_path, decode_dim=decode_dim) as asset:
+            try:
+                steps = [asset.ocr_rendition(max_dim, max_kb, profile.ocr_quality_levels)[1]
+                         for max_dim, max_kb in profile.progressive_ocr_steps]
+            except Exception as e:
+                print(f"BENCH: skipping {os.path.basename(image_path)}: {e}")
+                continue
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        print(f"BENCH: {os.path.basename(image_path)}: {elapsed * 1000:.0f} ms, "
+              f"renditions {' / '.join(f'{kb:.0f} KB' for kb in steps)}")
+
+    if timings:
+        timings.sort()
+        print(f"BENCH: {profile.name}: {len(timings)} images, median {timings[len(timings) // 2] * 1000:.0f} ms, "
+              f"max {timings[-1] * 1000:.0f} ms")
+
+if __name__ == '__main__':
+    for key, value in asdict(PROFILE).items():
+        print(f"{key:28} {value}")
+    print(f"{'db_pool_size':28} {PROFILE.db_pool_size}")
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1:])
@@ -0,0 +1,343 @@
+# retention.py - Retention and tiered compaction for saved scan images and text
+#
+# Storage only ever grew: every original image and every extracted_text was kept
+# at full size forever. A retention pass now runs three phases, cheapest first:
+#
+#     archive    originals nobody has scanned for RETENTION_ARCHIVE_DAYS are
+#                replaced by a 2048px WebP (image_asset.ARCHIVE_RENDITION) next to
+#                them - URLs don't change, the image routes serve the archive instead
+#     compress   extracted_text older than RETENTION_COMPRESS_DAYS moves to
+#                extracted_text_z, deflated with a dictionary trained on stored label
+#                text (text_codec.py); reads inflate it transparently
+#     purge      per tier (RETENTION_TIERS, picked by users.is_premium), images and
+#                text of scans older than the tier's limits are dropped. The rows stay
+#                so history and stats are unchanged; blobs nobody references any more
+#                are deleted by blob_store.gc at the end of the pass
+#
+# Run by hand (--dry-run reports what would be reclaimed without changing anything):
+#
+#     python retention.py run [--dry-run]
+#     python retention.py train-dictionary    # retrain on recent text; old payloads keep theirs
+#
+# Or scheduled: start() (gunicorn post_fork) starts a thread in each worker that
+# checks every CHECK_INTERVAL seconds. An flock on a lock file plus the stamp file's
+# mtime make one worker per host run the pass once every RETENTION_INTERVAL_HOURS.
+# RETENTION_INTERVAL_HOURS=0 turns the schedule off.
+
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import blob_store
+import text_codec
+from image_asset import RENDITIONS, render_archive
+
+RETENTION_ARCHIVE_DAYS = int(os.getenv('RETENTION_ARCHIVE_DAYS', '90'))
+RETENTION_COMPRESS_DAYS = int(os.getenv('RETENTION_COMPRESS_DAYS', '30'))
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+RETENTION_BATCH = int(os.getenv('RETENTION_BATCH', '500'))          # rows per transaction
+RETENTION_PAUSE = float(os.getenv('RETENTION_PAUSE', '0.05'))       # seconds between batches
+RETENTION_STATE_DIR = os.getenv('RETENTION_STATE_DIR', tempfile.gettempdir())
+
+DICTIONARY_SAMPLES = 2000      # recent texts a dictionary is trained on
+MIN_DICTIONARY_SAMPLES = 100   # below this, text is compressed without a dictionary
+CHECK_INTERVAL = 3600.0        # seconds between schedule checks in each worker
+
+def _days(name, default):
+    """Days from the environment - empty or 'never' keeps forever (None)"""
+    value = os.getenv(name, default).strip().lower()
+    return None if value in ('', 'never') else int(value)
+
+@dataclass(frozen=True)
+class RetentionTier:
+    image_days: int = None   # scans older than this lose their image; None keeps it
+    text_days: int = None    # ... and their extracted_text
+
+RETENTION_TIERS = {
+    'free': RetentionTier(_days('RETENTION_FREE_IMAGE_DAYS', '180'), _days('RETENTION_FREE_TEXT_DAYS', '365')),
+    'premium': RetentionTier(_days('RETENTION_PREMIUM_IMAGE_DAYS', 'never'), _days('RETENTION_PREMIUM_TEXT_DAYS', 'never')),
+}
+
+_RENDITION_SUFFIXES = tuple(f"_{name}" for name in list(RENDITIONS) + [blob_store.ARCHIVE])
+_FIRST_KEY = ('1970-01-01 00:00:00', 0)   # (scan_date, id) before every row
+
+def _cutoff(days):
+    """scan_date bound for 'older than days' - local time, like stored scan dates"""
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def _originals(directory):
+    """Saved originals below directory - renditions and temp files are skipped"""
+    if not os.path.isdir(directory):
+        return
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.startswith(blob_store.TEMP_PREFIX) or os.path.splitext(name)[0].endswith(_RENDITION_SUFFIXES):
+                continue
+            yield os.path.join(root, name)
+
+def _remove(path):
+    """Unlink a file - returns its size, 0 if it was already gone"""
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+class RetentionEngine:
+    """One retention pass over the stored images and history rows"""
+
+    def __init__(self, repo, uploads_dir, dry_run=False):
+        self.repo = repo                # RetentionRepo
+        self.uploads_dir = uploads_dir  # static/uploads - per-user files from before the blob store
+        self.dry_run = dry_run
+
+    def run(self):
+        """All phases - returns {phase: {'items': n, 'bytes': reclaimed}}"""
+        started = time.monotonic()
+        report = {
+            'archive': self.archive_images(),
+            'compress': self.compress_text(),
+        }
+        for tier_name, tier in RETENTION_TIERS.items():
+            report[f"purge_images_{tier_name}"] = self.purge_images(tier_name, tier.image_days)
+            report[f"purge_text_{tier_name}"] = self.purge_text(tier_name, tier.text_days)
+        blobs, reclaimed = blob_store.gc(self.repo.image_blobs, dry_run=self.dry_run)
+        report['blob_gc'] = {'items': blobs, 'bytes': reclaimed}
+
+        action = 'Would reclaim' if self.dry_run else 'Reclaimed'
+        for phase, result in report.items():
+            print(f"INFO: Retention {phase}: {result['items']} items, {result['bytes'] / 1024 / 1024:.2f}MB")
+        total = sum(result['bytes'] for result in report.values())
+        print(f"INFO: {action} {total / 1024 / 1024:.2f}MB in {time.monotonic() - started:.1f}s")
+        return report
+
+    def archive_images(self):
+        """Replace originals untouched for RETENTION_ARCHIVE_DAYS with their archive rendition
+
+        Blob mtimes are refreshed by every scan that stores the image again
+        (blob_store.put), so a photo that is still being scanned stays original.
+        """
+        cutoff = time.time() - RETENTION_ARCHIVE_DAYS * 86400
+        directories = [blob_store.BLOB_DIR]
+        if os.path.isdir(self.uploads_dir):
+            # Pre-blob-store uploads live in static/uploads/<user_id>/
+            directories += [os.path.join(self.uploads_dir, entry) for entry in sorted(os.listdir(self.uploads_dir))
+                            if entry.isdigit()]
+
+        archived, reclaimed = 0, 0
+        for directory in directories:
+            for path in _originals(directory):
+                try:
+                    size, mtime = os.path.getsize(path), os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if mtime > cutoff:
+                    continue
+                saved = self._archive(path, size)
+                if saved:
+                    archived += 1
+                    reclaimed += saved
+        return {'items': archived, 'bytes': reclaimed}
+
+    def _archive(self, path, size):
+        """Archive one original - returns the bytes saved, 0 if it was kept"""
+        archive_path = blob_store.rendition_path(path, blob_store.ARCHIVE)
+        try:
+            blob_store.write_atomic(archive_path, lambda temp_path: render_archive(path, temp_path))
+        except Exception as e:
+            print(f"DEBUG: Archiving {path} failed: {e}")
+            return 0
+
+        saved = size - os.path.getsize(archive_path)
+        if saved <= 0 or self.dry_run:
+            # Already compact - keep the original and don't look at it again for a while
+            os.remove(archive_path)
+            if saved <= 0 and not self.dry_run:
+                os.utime(path)
+            return max(saved, 0)
+        os.remove(path)
+        return saved
+
+    def dictionary(self, retrain=False):
+        """(id, bytes) of the dictionary new payloads use - trains the first one when needed"""
+        latest = None if retrain else self.repo.text_dictionaries.latest()
+        if latest is not None:
+            return latest
+
+        samples = self.repo.text_samples(DICTIONARY_SAMPLES)
+        if len(samples) < MIN_DICTIONARY_SAMPLES:
+            return text_codec.NO_DICTIONARY, None
+        dictionary = text_codec.train(samples)
+        if self.dry_run:
+            return text_codec.NO_DICTIONARY, dictionary   # only sizes are reported, nothing is stored
+        dictionary_id = self.repo.text_dictionaries.add(dictionary, len(samples))
+        print(f"INFO: Trained text dictionary {dictionary_id} on {len(samples)} samples ({len(dictionary)} bytes)")
+        return dictionary_id, dictionary
+
+    def compress_text(self):
+        """Move extracted_text older than RETENTION_COMPRESS_DAYS to extracted_text_z"""
+        cutoff = _cutoff(RETENTION_COMPRESS_DAYS)
+        dictionary_id, dictionary = self.dictionary()
+
+        after, compressed, reclaimed = _FIRST_KEY, 0, 0
+        while True:
+            rows = self.repo.uncompressed_text(cutoff, after, RETENTION_BATCH)
+            if not rows:
+                break
+            payloads = []
+            for row in rows:
+                text = row['extracted_text']
+                payload = text_codec.compress(text, dictionary_id, dictionary) if text else None
+                payloads.append((row['id'], payload))
+                reclaimed += len(text.encode('utf-8')) - (len(payload) if payload else 0)
+            if not self.dry_run:
+                self.repo.store_compressed(payloads)
+                time.sleep(RETENTION_PAUSE)
+            compressed += len(rows)
+            after = (rows[-1]['scan_date'], rows[-1]['id'])
+        return {'items': compressed, 'bytes': reclaimed}
+
+    def purge_images(self, tier_name, days):
+        """Drop the images of the tier's scans older than days - blobs are reclaimed by GC"""
+        if days is None:
+            return {'items': 0, 'bytes': 0}
+        cutoff = _cutoff(days)
+
+        after, purged, reclaimed = _FIRST_KEY, 0, 0
+        while True:
+            rows = self.repo.purge_images(tier_name, cutoff, after, RETENTION_BATCH, apply=not self.dry_run)
+            if not rows:
+                break
+            for row in rows:
+                if not blob_store.is_blob_url(row['image_url']):
+                    reclaimed += self._remove_upload(row['image_url'])
+            purged += len(rows)
+            after = (rows[-1]['scan_date'], rows[-1]['id'])
+            if not self.dry_run:
+                time.sleep(RETENTION_PAUSE)
+        return {'items': purged, 'bytes': reclaimed}
+
+    def _remove_upload(self, image_url):
+        """Unlink a pre-blob-store upload with its renditions and archive - returns bytes"""
+        if not image_url.startswith('static/uploads/'):
+            return 0
+        path = os.path.join(os.path.dirname(self.uploads_dir), os.path.relpath(image_url, 'static'))
+        stem = os.path.splitext(path)[0]
+        victims = [path] + [f"{stem}{suffix}.webp" for suffix in _RENDITION_SUFFIXES]
+        if self.dry_run:
+            return sum(os.path.getsize(victim) for victim in victims if os.path.exists(victim))
+        return sum(_remove(victim) for victim in victims)
+
+    def purge_text(self, tier_name, days):
+        """Drop extracted_text of the tier's scans older than days"""
+        if days is None:
+            return {'items': 0, 'bytes': 0}
+        cutoff = _cutoff(days)
+
+        after, purged, reclaimed = _FIRST_KEY, 0, 0
+        while True:
+            rows = self.repo.purge_text(tier_name, cutoff, after, RETENTION_BATCH, apply=not self.dry_run)
+            if not rows:
+                break
+            reclaimed += sum(row['size'] for row in rows)
+            purged += len(rows)
+            after = (rows[-1]['scan_date'], rows[-1]['id'])
+            if not self.dry_run:
+                time.sleep(RETENTION_PAUSE)
+        return {'items': purged, 'bytes': reclaimed}
+
+class RetentionSchedule:
+    """Runs a retention pass once per interval per host, from whichever worker gets there first"""
+
+    def __init__(self, make_engine, interval_hours=RETENTION_INTERVAL_HOURS, state_dir=RETENTION_STATE_DIR):
+        self.make_engine = make_engine
+        self.interval = interval_hours * 3600
+        self.lock_path = os.path.join(state_dir, 'foodfixr-retention.lock')
+        self.stamp_path = os.path.join(state_dir, 'foodfixr-retention.stamp')
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_report = None
+        self._last_error = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='retention', daemon=True).start()
+
+    def _run(self):
+        while self._pid == os.getpid():
+            try:
+                self.run_if_due()
+            except Exception as e:
+                self._last_error = str(e)
+                print(f"DEBUG: Retention pass failed, will retry: {e}")
+            time.sleep(CHECK_INTERVAL)
+
+    def run_if_due(self):
+        """Run a pass if none ran within the interval - returns the report, or None"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None   # another worker is running it
+            try:
+                if os.path.exists(self.stamp_path) and time.time() - os.path.getmtime(self.stamp_path) < self.interval:
+                    return None
+                self._last_report = self.make_engine().run()
+                with open(self.stamp_path, 'w') as stamp:
+                    stamp.write(datetime.now().isoformat())
+                return self._last_report
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        last_run = os.path.getmtime(self.stamp_path) if os.path.exists(self.stamp_path) else None
+        return {
+            'interval_hours': self.interval / 3600,
+            'last_run': datetime.fromtimestamp(last_run).isoformat() if last_run else None,
+            'last_reclaimed_bytes': sum(result['bytes'] for result in self._last_report.values()) if self._last_report else None,
+            'last_error': self._last_error,
+        }
+
+_schedule = None
+
+def configure(repo, uploads_dir):
+    """Set the repository (RetentionRepo) and the pre-blob-store uploads directory"""
+    global _schedule
+    _schedule = RetentionSchedule(lambda: RetentionEngine(repo, uploads_dir))
+
+def start():
+    """Start this worker's schedule thread (no-op when RETENTION_INTERVAL_HOURS=0)"""
+    if _schedule is not None:
+        _schedule.start()
+
+def stats():
+    return _schedule.stats() if _schedule is not None else {}
+
+if __name__ == '__main__':
+    import db_pool
+    from repositories import RetentionRepo, connect_database
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in ('run', 'train-dictionary'):
+        print("usage: python retention.py run [--dry-run] | train-dictionary")
+        sys.exit(2)
+
+    engine = RetentionEngine(RetentionRepo(lambda: db_pool.get_connection(connect_database)),
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads'),
+                             dry_run='--dry-run' in sys.argv)
+    if command == 'train-dictionary':
+        engine.dictionary(retrain=True)
+    else:
+        engine.run()
@@ -0,0 +1,32 @@
+# scan_stats.py - Rebuild per-user scan stats from scan_history
+#
+# Migration 7 backfills user_scan_stats when it creates the table; from then on
+# every history write keeps it current. Recount after restoring a backup or
+# editing scan_history by hand:
+#
+#     python scan_stats.py              # every user
+#     python scan_stats.py --user 42    # one user
+
+import sys
+import time
+
+import db_pool
+from repositories import ScanStatsRepo, connect_database
+
+def rebuild(user_ids=None):
+    """Recount stats for the given users (default: all) - one short transaction per user"""
+    repo = ScanStatsRepo(lambda: db_pool.get_connection(connect_database))
+    started = time.monotonic()
+    scans = 0
+
+    user_ids = user_ids or repo.user_ids()
+    for user_id in user_ids:
+        scans += repo.rebuild(user_id)
+
+    print(f"INFO: Rebuilt scan stats for {len(user_ids)} users ({scans} scans) in {time.monotonic() - started:.1f}s")
+
+if __name__ == '__main__':
+    if '--user' in sys.argv:
+        rebuild([int(sys.argv[sys.argv.index('--user') + 1])])
+    else:
+        rebuild()
@@ -269,3 +269,193 @@ gmo_keywords = [
     "lab-grown",
     "precision fermentation"
 ]
+
+# INGREDIENT DICTIONARY - stable integer ids for stored scan matches
+# Scan history stores matches as ids into this list (see ingredient_codec.py), so it
+# is append-only: never reorder, rename or remove an entry. When adding keywords
+# above, append them here too and bump INGREDIENT_DICTIONARY_VERSION.
+INGREDIENT_DICTIONARY_VERSION = 1
+INGREDIENT_DICTIONARY = [
+    "partially hydrogenated oil",
+    "partially hydrogenated soybean oil",
+    "partially hydrogenated cottonseed oil",
+    "partially hydrogenated palm oil",
+    "partially hydrogenated canola oil",
+    "vegetable shortening",
+    "shortening",
+    "hydrogenated oil",
+    "interesterified fats",
+    "high-stability oil",
+    "hydrogenated fat",
+    "margarine",
+    "frying oil",
+    "modified fat",
+    "synthetic fat",
+    "lard substitute",
+    "monoglycerides",
+    "diglycerides",
+    "fully hydrogenated oil",
+    "palm oil",
+    "coconut oil",
+    "butter",
+    "ghee",
+    "cold-pressed oil",
+    "olive oil",
+    "avocado oil",
+    "monosodium glutamate",
+    "msg",
+    "aspartame",
+    "hydrolyzed vegetable protein",
+    "hvp",
+    "hydrolyzed soy protein",
+    "hydrolyzed corn protein",
+    "disodium inosinate",
+    "disodium guanylate",
+    "autolyzed yeast",
+    "calcium caseinate",
+    "sodium caseinate",
+    "torula yeast",
+    "natural flavors",
+    "natural flavoring",
+    "non-brewed soy sauce",
+    "hydrolyzed soy sauce",
+    "enzyme modified cheese",
+    "whey protein isolate",
+    "whey protein hydrolysate",
+    "bouillon",
+    "bouillon flavor",
+    "maltodextrin",
+    "modified food starch",
+    "textured vegetable protein",
+    "tvp",
+    "corn syrup solids",
+    "carrageenan",
+    "high fructose corn syrup",
+    "hfcs",
+    "corn syrup",
+    "cornstarch",
+    "modified cornstarch",
+    "dextrose",
+    "fructose",
+    "glucose",
+    "citric acid",
+    "ascorbic acid",
+    "erythritol",
+    "sorbitol",
+    "xylitol",
+    "caramel color",
+    "vanillin",
+    "corn flour",
+    "cornmeal",
+    "corn oil",
+    "corn alcohol",
+    "corn ethanol",
+    "corn-based vinegars",
+    "lactic acid",
+    "xanthan gum",
+    "guar gum",
+    "lecithin",
+    "tocopherols",
+    "polydextrose",
+    "inositol",
+    "mono- and diglycerides",
+    "calcium stearate",
+    "magnesium stearate",
+    "whole grain corn",
+    "masa",
+    "organic masa",
+    "sodium erythorbate",
+    "ethyl maltol",
+    "sodium citrate",
+    "potassium citrate",
+    "masa harina",
+    "sorbitan monooleate",
+    "sorbitan tristearate",
+    "zein",
+    "high-fructose corn syrup",
+    "glucose-fructose syrup",
+    "crystalline fructose",
+    "anhydrous dextrose",
+    "invert sugar",
+    "glucose solids",
+    "refiner's syrup",
+    "agave syrup",
+    "agave nectar",
+    "sucrose",
+    "beet sugar",
+    "brown sugar",
+    "coconut sugar",
+    "date sugar",
+    "palm sugar",
+    "evaporated cane juice",
+    "fruit juice concentrates",
+    "apple juice concentrate",
+    "grape juice concentrate",
+    "barley malt syrup",
+    "brown rice syrup",
+    "rice syrup",
+    "golden syrup",
+    "sorghum syrup",
+    "molasses",
+    "treacle",
+    "carob syrup",
+    "yacon syrup",
+    "honey",
+    "maple syrup",
+    "maple sugar",
+    "coconut nectar",
+    "date syrup",
+    "date paste",
+    "banana puree",
+    "raisin juice concentrate",
+    "fig paste",
+    "grape must",
+    "apple puree",
+    "pineapple juice concentrate",
+    "diastatic malt",
+    "malt syrup",
+    "malt extract",
+    "cane sugar",
+    "corn starch",
+    "modified corn starch",
+    "soybean oil",
+    "soy lecithin",
+    "soy protein isolate",
+    "canola oil",
+    "cottonseed oil",
+    "cottonseed",
+    "sugar",
+    "yeast extract",
+    "heme",
+    "soy leghemoglobin",
+    "enzymes",
+    "glycerin",
+    "glycerol",
+    "sodium lactate",
+    "bioengineered food",
+    "contains bioengineered ingredients",
+    "fermentation-derived dairy proteins",
+    "synbio vanillin",
+    "vegetable oil",
+    "modified starch",
+    "flavoring",
+    "natural flavor",
+    "artificial flavor",
+    "alcohol",
+    "ethanol",
+    "fruit juice concentrate",
+    "papaya",
+    "zucchini",
+    "yellow summer squash",
+    "arctic apple",
+    "innate potato",
+    "pink pineapple",
+    "genetically engineered",
+    "genetically modified organism",
+    "bioengineered",
+    "fermentation-derived proteins",
+    "synthetic biology",
+    "synbio",
+    "lab-grown",
+    "precision fermentation"
+]
@@ -0,0 +1,106 @@
+# scratch.py - Per-request scratch space for scan temp files
+#
+# Scan temp files (the upload, OCR renditions, compression output) used to go to
+# the shared system temp dir under time-stamped names, and every scan listed and
+# stat()ed that whole directory to sweep up what earlier scans had left behind.
+# Each scan now gets a directory of its own, removed when the request ends however
+# it ends:
+#
+#     @scratch.scoped
+#     def scan():
+#         path = scratch.path('upload.jpg')    # unique within the request's directory
+#
+# Directories live on /dev/shm when it exists and has SCRATCH_MIN_FREE_MB free
+# (tmpfs - no disk I/O for files that live a few seconds), otherwise in the system
+# temp dir; SCRATCH_DIR overrides both. Directory names carry the worker pid, so
+# the first workspace a process opens removes those of workers that died mid-scan.
+
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+SCRATCH_DIR = os.getenv('SCRATCH_DIR')
+SCRATCH_MIN_FREE_MB = int(os.getenv('SCRATCH_MIN_FREE_MB', '256'))
+SHM_DIR = '/dev/shm'
+PREFIX = 'foodfixr-scan-'
+
+_local = threading.local()
+_root = None
+_root_pid = None
+_root_lock = threading.Lock()
+
+def _has_room(directory):
+    try:
+        stats = os.statvfs(directory)
+    except OSError:
+        return False
+    return os.access(directory, os.W_OK) and stats.f_bavail * stats.f_frsize >= SCRATCH_MIN_FREE_MB * 1024 * 1024
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _remove_orphans(root):
+    """Scratch directories of processes that no longer exist"""
+    for name in os.listdir(root):
+        if not name.startswith(PREFIX):
+            continue
+        pid = name[len(PREFIX):].split('-', 1)[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+def root():
+    """Directory scratch workspaces are created in - chosen once per process"""
+    global _root, _root_pid
+    with _root_lock:
+        if _root_pid != os.getpid():
+            if SCRATCH_DIR:
+                os.makedirs(SCRATCH_DIR, exist_ok=True)
+                _root = SCRATCH_DIR
+            else:
+                _root = SHM_DIR if _has_room(SHM_DIR) else tempfile.gettempdir()
+            _root_pid = os.getpid()
+            try:
+                _remove_orphans(_root)
+            except OSError as e:
+                print(f"DEBUG: Scratch orphan cleanup failed: {e}")
+        return _root
+
+@contextmanager
+def workspace():
+    """A fresh scratch directory for the current thread, removed on exit"""
+    outer = (getattr(_local, 'directory', None), getattr(_local, 'counter', 0))
+    directory = tempfile.mkdtemp(prefix=f"{PREFIX}{os.getpid()}-", dir=root())
+    _local.directory, _local.counter = directory, 0
+    try:
+        yield directory
+    finally:
+        _local.directory, _local.counter = outer
+        shutil.rmtree(directory, ignore_errors=True)
+
+def scoped(view):
+    """Run a view inside its own scratch workspace"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with workspace():
+            return view(*args, **kwargs)
+    return wrapper
+
+def path(name):
+    """A unique path ending in name - in the current workspace, else an empty temp file the caller removes"""
+    directory = getattr(_local, 'directory', None)
+    if directory is None:
+        fd, temp_path = tempfile.mkstemp(prefix=PREFIX, suffix=f"-{name}", dir=root())
+        os.close(fd)
+        return temp_path
+
+    _local.counter += 1
+    return os.path.join(directory, f"{_local.counter}-{name}")
@@ -0,0 +1,125 @@
+# test_admission.py - Stress test of admission control with concurrent synthetic large images
+#
+# Threads (and forked worker processes, which share the host-wide budget) push
+# large uploads through admission.reserve() and decode them while holding the
+# reservation. Every booking is checked against ADMISSION_BUDGET_MB under the
+# admission lock, so the test sees the true peak rather than a sampled one.
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import admission
+from image_asset import ImageAsset
+
+BUDGET_MB = 200
+HOLD_SECONDS = 0.2     # how long an admitted scan keeps its pixels
+
+def _image(path, size, format='JPEG'):
+    Image.new('RGB', size, (200, 120, 40)).save(path, format)
+    return str(path)
+
+@pytest.fixture
+def budget(monkeypatch):
+    """A BUDGET_MB budget whose peak reservation is recorded at every booking"""
+    monkeypatch.setattr(admission, 'ADMISSION_BUDGET_MB', float(BUDGET_MB))
+    monkeypatch.setattr(admission, 'ADMISSION_QUEUE_TIMEOUT', 30.0)
+    peak = multiprocessing.Value('d', 0.0, lock=False)   # written under admission's lock
+    book = admission._book
+
+    def recording_book(delta_mb):
+        book(delta_mb)
+        peak.value = max(peak.value, admission._total_mb())
+
+    monkeypatch.setattr(admission, '_book', recording_book)
+    assert admission.reserved_mb() == 0
+    yield peak
+    assert admission.reserved_mb() == 0
+
+def _scan(path, timeout=None):
+    """Reserve, decode and hold like a scan - (decoded size, decode_size) or the rejection"""
+    with ImageAsset(path) as asset:
+        try:
+            with admission.reserve(asset, timeout=timeout):
+                pixels = asset.image()
+                time.sleep(HOLD_SECONDS)
+                return pixels.size, asset.decode_size
+        except admission.AdmissionRejected as e:
+            return e
+
+def test_concurrent_threads_stay_within_budget(budget, tmp_path):
+    # ~88 MB projected each - only two fit at once
+    path = _image(tmp_path / 'large.jpg', (4000, 3000))
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda _: _scan(path), range(16)))
+
+    assert all(not isinstance(result, Exception) for result in results)
+    assert admission.estimate_decode_mb(ImageAsset(path)) * 2 <= BUDGET_MB
+    assert 0 < budget.value <= BUDGET_MB
+
+def _process_scans(path, count, failures):
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        for result in pool.map(lambda _: _scan(path), range(count)):
+            if isinstance(result, Exception):
+                failures.value += 1
+
+def test_concurrent_processes_share_the_budget(budget, tmp_path):
+    path = _image(tmp_path / 'large.jpg', (4000, 3000))
+    failures = multiprocessing.Value('i', 0)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_process_scans, args=(path, 4, failures)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    assert failures.value == 0
+    assert 0 < budget.value <= BUDGET_MB
+
+def test_oversized_jpegs_get_a_capped_decode(budget, tmp_path):
+    # ~310 MB projected at full size - more than the whole budget
+    path = _image(tmp_path / 'huge.jpg', (8000, 6000))
+    assert admission.estimate_decode_mb(ImageAsset(path)) > BUDGET_MB
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: _scan(path), range(8)))
+
+    for result in results:
+        assert not isinstance(result, Exception)
+        decoded, decode_size = result
+        assert decoded == decode_size
+        assert max(decoded) < 8000
+        assert admission.projected_cost_mb(*decoded, 'RGB') <= BUDGET_MB
+    assert budget.value <= BUDGET_MB
+
+def test_scans_that_cant_wait_are_rejected_with_retry_after(budget, tmp_path):
+    path = _image(tmp_path / 'large.jpg', (4000, 3000))
+    started = threading.Barrier(12)
+
+    def scan(_):
+        started.wait()
+        return _scan(path, timeout=0.05)
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        results = list(pool.map(scan, range(12)))
+
+    admitted = [result for result in results if not isinstance(result, Exception)]
+    rejected = [result for result in results if isinstance(result, Exception)]
+    assert 1 <= len(admitted) < 12
+    assert len(admitted) + len(rejected) == 12
+    assert all(e.retry_after == admission.ADMISSION_RETRY_AFTER for e in rejected)
+    assert budget.value <= BUDGET_MB
+
+def test_oversized_images_that_cant_be_capped_are_rejected_outright(budget, tmp_path):
+    # PNG has no draft mode, so the decode can't be reduced below full size
+    path = _image(tmp_path / 'huge.png', (8000, 6000), 'PNG')
+    result = _scan(path)
+
+    assert isinstance(result, admission.AdmissionRejected)
+    assert result.retry_after is None
+    assert budget.value == 0
@@ -0,0 +1,136 @@
+# test_db_pool.py - Load test of ConnectionPool against a SQLite stand-in
+#
+# More threads than connections run short queries at once, so most checkouts find
+# the pool saturated and queue. The pool must never open more than max_size
+# connections, must account for every wait in its metrics, must raise PoolTimeout
+# when nothing frees up, and must hand on the slot of a connection that was
+# dropped without close().
+
+import gc
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import db_pool
+import resource_profile
+from conftest import sqlite_factory
+
+POOL_SIZE = 4
+
+@pytest.fixture
+def pool(tmp_path):
+    opened = []
+    factory = sqlite_factory(str(tmp_path / 'pool.db'))
+
+    def connect():
+        conn = factory()
+        opened.append(conn)
+        return conn
+
+    pool = db_pool.ConnectionPool(connect, max_size=POOL_SIZE, timeout=5, max_lifetime=1800)
+    pool.opened = opened
+    yield pool
+    pool.close_all()
+
+def test_saturated_pool_queues_and_reports_waits(pool):
+    threads, queries = 32, 10
+    in_use, peak = [0], [0]
+    lock = threading.Lock()
+
+    def client(_):
+        for _ in range(queries):
+            with pool.acquire() as conn:
+                with lock:
+                    in_use[0] += 1
+                    peak[0] = max(peak[0], in_use[0])
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1 AS one')
+                assert cursor.fetchone()['one'] == 1
+                time.sleep(0.002)
+                with lock:
+                    in_use[0] -= 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(client, range(threads)))
+    elapsed = time.perf_counter() - started
+
+    stats = pool.stats()
+    print(f"INFO: {threads * queries} checkouts in {elapsed:.2f}s: {stats}")
+    assert peak[0] <= POOL_SIZE
+    assert len(pool.opened) <= POOL_SIZE
+    assert stats['checkouts'] == threads * queries
+    assert stats['saturated_checkouts'] > threads
+    assert 0 < stats['wait_ms_max'] <= stats['wait_ms_total']
+    assert stats['in_use'] == 0 and stats['waiting'] == 0
+    assert stats['idle'] == stats['created'] - stats['discarded']
+
+def test_checkout_times_out_when_nothing_frees_up(pool):
+    pool.timeout = 0.2
+    held = [pool.acquire() for _ in range(POOL_SIZE)]
+
+    started = time.perf_counter()
+    with pytest.raises(db_pool.PoolTimeout):
+        pool.acquire()
+    assert time.perf_counter() - started >= 0.2
+    assert pool.stats()['waiting'] == 0
+
+    for conn in held:
+        conn.close()
+    with pool.acquire():
+        pass
+    assert pool.stats()['in_use'] == 0
+
+def test_unclosed_connection_slot_is_reclaimed_for_a_waiter(pool):
+    held = [pool.acquire() for _ in range(POOL_SIZE)]
+    results = []
+
+    def waiter():
+        conn = pool.acquire()
+        results.append(conn)
+        conn.close()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(0.1)
+    assert pool.stats()['waiting'] == 1
+
+    # An error path drops a checked-out connection without close()
+    del held[0]
+    gc.collect()
+    thread.join(db_pool.ORPHAN_CHECK_INTERVAL * 4)
+
+    assert not thread.is_alive() and len(results) == 1
+    stats = pool.stats()
+    assert stats['discarded'] == 1
+    assert stats['in_use'] == POOL_SIZE - 1
+
+    for conn in held:
+        conn.close()
+    assert pool.stats()['in_use'] == 0
+
+def test_with_block_commits_on_success_and_rolls_back_on_error(pool):
+    with pool.acquire() as conn:
+        conn.cursor().execute('CREATE TABLE items (name TEXT)')
+    with pool.acquire() as conn:
+        conn.cursor().execute("INSERT INTO items VALUES ('kept')")
+    with pytest.raises(RuntimeError):
+        with pool.acquire() as conn:
+            conn.cursor().execute("INSERT INTO items VALUES ('dropped')")
+            raise RuntimeError('handler failed')
+
+    with pool.acquire() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name FROM items')
+        assert [row['name'] for row in cursor.fetchall()] == ['kept']
+
+def test_pool_is_sized_for_effective_threads(monkeypatch):
+    monkeypatch.setenv('GUNICORN_THREADS', '12')
+    profile = resource_profile.load_profile()
+    assert profile.threads == 12
+    assert profile.db_pool_size == 12 + resource_profile.BACKGROUND_DB_THREADS
+
+    monkeypatch.setenv('GUNICORN_WORKER_CLASS', 'sync')
+    assert resource_profile.load_profile().db_pool_size == 1 + resource_profile.BACKGROUND_DB_THREADS
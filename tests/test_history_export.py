@@ -0,0 +1,78 @@
+# test_history_export.py - Streaming export of 100k synthetic history rows
+#
+# Each format is streamed from ScanHistoryRepo.stream_for_user() to a file, the
+# file is parsed back to check it is well-formed and holds every row, and the
+# Python heap is traced while streaming: the peak must stay a small fraction of
+# the export's size, as it does when only one batch and one chunk are ever held.
+
+import csv
+import json
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytest
+
+import ingredient_codec
+from history_export import CSV_FIELDS, EXPORT_FORMATS
+from repositories import ScanHistoryRepo
+
+ROWS = 100_000
+MAX_PEAK_MB = 8
+
+@pytest.fixture
+def long_history(database, make_user):
+    """A premium user with ROWS scans"""
+    user_id = make_user(is_premium=True)
+    ingredients = ingredient_codec.dumps({'sugar': ['cane sugar'], 'corn': ['corn syrup']})
+    text = 'INGREDIENTS: WATER, CANE SUGAR, CORN SYRUP, CITRIC ACID, NATURAL FLAVORS, SALT ' * 3
+    started = datetime(2024, 1, 1)
+
+    with database.acquire() as conn:
+        conn.cursor().executemany('''
+            INSERT INTO scan_history (user_id, scan_date, result_rating, ingredients_found, scan_id,
+                                      extracted_text, text_length, confidence, text_quality)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'high', 'good')
+        ''', ((user_id, (started + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'), 'Proceed carefully',
+               ingredients, f"scan-{i:06d}", f"{text}{i}", len(text)) for i in range(ROWS)))
+    return user_id
+
+@pytest.mark.parametrize('export_format', sorted(EXPORT_FORMATS))
+def test_export_streams_in_constant_memory(database, long_history, export_format, tmp_path):
+    encode, _, extension = EXPORT_FORMATS[export_format]
+    history = ScanHistoryRepo(database.acquire)
+    path = tmp_path / f"export.{extension}"
+
+    tracemalloc.start()
+    try:
+        with open(path, 'w', encoding='utf-8', newline='') as out:
+            for chunk in encode(history.stream_for_user(long_history), 'user@example.com', '2024-06-01T00:00:00'):
+                out.write(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    size_mb = path.stat().st_size / 1024 / 1024
+    print(f"INFO: {export_format}: {size_mb:.1f} MB exported, peak {peak / 1024 / 1024:.2f} MB traced")
+    assert peak < MAX_PEAK_MB * 1024 * 1024
+    assert peak < path.stat().st_size / 10
+
+    with open(path, encoding='utf-8', newline='') as exported:
+        if export_format == 'json':
+            document = json.load(exported)
+            records = document['scans']
+            assert document['total_scans'] == ROWS
+        elif export_format == 'ndjson':
+            records = [json.loads(line) for line in exported]
+        else:
+            reader = csv.DictReader(exported)
+            assert reader.fieldnames == CSV_FIELDS
+            records = list(reader)
+
+    assert len(records) == ROWS
+    assert records[0]['scan_id'] == f"scan-{ROWS - 1:06d}"      # newest first
+    assert records[-1]['scan_id'] == 'scan-000000'
+    assert len({record['scan_id'] for record in records}) == ROWS
+    ingredients = records[0]['ingredients_found']
+    if export_format == 'csv':
+        ingredients = json.loads(ingredients)
+    assert ingredients['sugar'] == ['cane sugar']
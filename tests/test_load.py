@@ -0,0 +1,138 @@
+# test_load.py - Load test of the concurrent worker profile against a stub OCR server
+#
+# Serves the app the way one gthread worker does - PROFILE.threads requests at
+# once - and points OCR_SPACE_URL at a local stub that takes OCR_DELAY seconds per
+# call, like the real API. The same scans are timed one at a time and then
+# PROFILE.threads at a time: concurrent scans must overlap on the OCR wait rather
+# than queue behind each other, and every scan must write its history row and
+# leave no scratch files behind.
+
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from PIL import Image
+from werkzeug.serving import make_server
+
+OCR_DELAY = 1.0        # seconds the stub takes per OCR call
+SCANS_PER_THREAD = 2
+MIN_SPEEDUP = 2.0      # concurrent over serial throughput
+OCR_TEXT = 'INGREDIENTS: WATER, SUGAR, CORN SYRUP, SOYBEAN OIL, SALT, CITRIC ACID, NATURAL FLAVORS'
+
+class StubOCR(BaseHTTPRequestHandler):
+    """Answers every upload like OCR.space, after OCR_DELAY"""
+
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with StubOCR.lock:
+            StubOCR.calls += 1
+        time.sleep(OCR_DELAY)
+        body = json.dumps({
+            'IsErroredOnProcessing': False,
+            'ParsedResults': [{'ParsedText': OCR_TEXT, 'FileParseExitCode': 1}],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+@pytest.fixture
+def ocr_server(monkeypatch):
+    server = _serve(ThreadingHTTPServer(('127.0.0.1', 0), StubOCR))
+    url = f"http://127.0.0.1:{server.server_port}/parse/image"
+    monkeypatch.setenv('OCR_SPACE_URL', url)
+    import ingredient_scanner
+    monkeypatch.setattr(ingredient_scanner, 'OCR_SPACE_URL', url)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def app_server(ocr_server):
+    import app
+    app.app.config['TESTING'] = True
+    server = _serve(make_server('127.0.0.1', 0, app.app, threaded=True))
+    yield app, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+def _jpeg(width=1600, height=1200):
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+def _client(app, base_url, index):
+    """A logged-in premium user's session"""
+    import password_hasher
+    email = f"load{index}-{os.getpid()}@example.com"
+    user_id = app.user_repo.create(f"Load {index}", email, password_hasher.hash_password('load-test'))
+    app.user_repo.activate_premium(user_id)
+
+    client = requests.Session()
+    response = client.post(f"{base_url}/login", data={'email': email, 'password': 'load-test'}, allow_redirects=False)
+    assert response.status_code == 302
+    return user_id, client
+
+def test_concurrent_scans_overlap_on_ocr(app_server):
+    app, base_url = app_server
+    from resource_profile import PROFILE
+
+    threads = PROFILE.threads
+    image = _jpeg()
+    clients = [_client(app, base_url, index) for index in range(threads)]
+    StubOCR.calls = 0
+
+    def scan_loop(client, count=SCANS_PER_THREAD):
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            response = client.post(f"{base_url}/", files={'image': ('label.jpg', image, 'image/jpeg')}, timeout=60)
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200
+        return timings
+
+    serial_user, serial_client = clients[0]
+    started = time.perf_counter()
+    scan_loop(serial_client, threads)
+    serial_rate = threads / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        timings = [t for result in pool.map(scan_loop, [client for _, client in clients]) for t in result]
+    scans = threads * SCANS_PER_THREAD
+    rate = scans / (time.perf_counter() - started)
+
+    print(f"INFO: 1 in flight: {serial_rate:.2f} scans/s; {threads} in flight: {rate:.2f} scans/s, "
+          f"p50 {sorted(timings)[len(timings) // 2]:.2f}s, {StubOCR.calls} OCR calls")
+
+    # Every scan was served and recorded
+    assert StubOCR.calls >= threads + scans
+    with app.get_db_connection() as conn:
+        cursor = conn.cursor()
+        for user_id, _ in clients:
+            cursor.execute('SELECT COUNT(*) AS scans FROM scan_history WHERE user_id = ?', (user_id,))
+            assert cursor.fetchone()['scans'] == SCANS_PER_THREAD + (threads if user_id == serial_user else 0)
+
+    # Scans overlap on the OCR wait instead of queueing behind one another
+    assert rate >= serial_rate * MIN_SPEEDUP
+
+    # Per-request scratch directories are gone
+    scratch_dir = os.environ['SCRATCH_DIR']
+    assert not os.path.isdir(scratch_dir) or not os.listdir(scratch_dir)
@@ -0,0 +1,117 @@
+# test_record_scan.py - Concurrency test of the atomic quota reservation (SQLite path)
+#
+# Many threads record scans for the same user at once. The quota check and
+# increment are one UPDATE, so no increment may be lost and no scan may slip past
+# the free limit; every scan must also take one connection checkout and one
+# commit, where it used to take four connections.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import db_pool
+import migrations
+from conftest import sqlite_factory
+from repositories import ScanHistoryRepo, UserRepo
+
+FREE_SCAN_LIMIT = 5
+THREADS = 32
+RESULT = {
+    'rating': 'Safe',
+    'matched_ingredients': {'sugar': ['cane sugar']},
+    'extracted_text': 'INGREDIENTS: WATER, CANE SUGAR',
+    'extracted_text_length': 30,
+}
+
+@pytest.fixture
+def traced(tmp_path):
+    """(pool, statements) - every SQL statement the pool's connections run is recorded"""
+    statements = []
+    lock = threading.Lock()
+    factory = sqlite_factory(str(tmp_path / 'scans.db'))
+
+    def trace(sql):
+        with lock:
+            statements.append(sql)
+
+    def connect():
+        conn = factory()
+        conn.set_trace_callback(trace)
+        return conn
+
+    pool = db_pool.ConnectionPool(connect, max_size=8, timeout=30, max_lifetime=1800)
+    with pool.acquire() as conn:
+        migrations.migrate(conn)
+    yield pool, statements
+    pool.close_all()
+
+def _user(pool, is_premium=False, trial_started=None):
+    users = UserRepo(pool.acquire)
+    user_id = users.create('Scanner', f"scanner-{is_premium}-{trial_started}@example.com", 'not-a-hash')
+    if is_premium:
+        users.activate_premium(user_id)
+    if trial_started:
+        with pool.acquire() as conn:
+            conn.cursor().execute('UPDATE users SET trial_start_date = ? WHERE id = ?',
+                                  (trial_started.strftime('%Y-%m-%d %H:%M:%S'), user_id))
+    return user_id
+
+def _record_concurrently(pool, user_id):
+    history = ScanHistoryRepo(pool.acquire)
+    trial_cutoff = datetime.now() - timedelta(hours=48)
+    barrier = threading.Barrier(THREADS)
+
+    def record(_):
+        barrier.wait()
+        return history.record_scan(user_id, RESULT, None, FREE_SCAN_LIMIT, trial_cutoff)
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        return list(executor.map(record, range(THREADS)))
+
+def _counts(pool, user_id):
+    with pool.acquire() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT scans_used, total_scans_ever FROM users WHERE id = ?', (user_id,))
+        user = cursor.fetchone()
+        cursor.execute('SELECT COUNT(*) AS rows FROM scan_history WHERE user_id = ?', (user_id,))
+        return user['scans_used'], user['total_scans_ever'], cursor.fetchone()['rows']
+
+def test_free_quota_has_no_lost_updates_or_overruns(traced):
+    pool, statements = traced
+    user_id = _user(pool)
+    checkouts = pool.stats()['checkouts']
+    del statements[:]
+
+    results = _record_concurrently(pool, user_id)
+    checkouts = pool.stats()['checkouts'] - checkouts
+    statements = list(statements)
+
+    admitted = sorted(result for result in results if result is not None)
+    assert admitted == list(range(1, FREE_SCAN_LIMIT + 1))     # each increment seen exactly once
+    assert results.count(None) == THREADS - FREE_SCAN_LIMIT
+    assert _counts(pool, user_id) == (FREE_SCAN_LIMIT, FREE_SCAN_LIMIT, FREE_SCAN_LIMIT)
+
+    # One checkout, one quota UPDATE and at most one commit per scan - rejected scans write nothing
+    assert checkouts == THREADS
+    assert sum(sql.lstrip().upper().startswith('UPDATE USERS') for sql in statements) == THREADS
+    assert sum(sql.strip().upper() == 'COMMIT' for sql in statements) == FREE_SCAN_LIMIT
+
+def test_premium_scans_are_all_recorded(traced):
+    pool, _ = traced
+    user_id = _user(pool, is_premium=True)
+
+    results = _record_concurrently(pool, user_id)
+
+    assert None not in results
+    assert _counts(pool, user_id) == (0, THREADS, THREADS)
+
+def test_expired_trial_rejects_every_scan(traced):
+    pool, _ = traced
+    user_id = _user(pool, trial_started=datetime.now() - timedelta(hours=72))
+
+    results = _record_concurrently(pool, user_id)
+
+    assert results == [None] * THREADS
+    assert _counts(pool, user_id) == (0, 0, 0)
@@ -0,0 +1,69 @@
+# text_codec.py - Dictionary-compressed storage for old extracted_text
+#
+# Label text is short (at most 1000 characters) and very repetitive across scans -
+# "INGREDIENTS:", "CONTAINS 2% OR LESS OF", "NUTRITION FACTS", the same additive
+# names over and over. Plain zlib can't exploit that on a single short string, so
+# compression uses a preset dictionary (zlib's zdict) trained on stored label text
+# and kept in text_dictionaries. retention.py moves old rows from extracted_text
+# to extracted_text_z in this format:
+#
+#     [version] [dictionary id, 4 bytes big-endian] [raw deflate stream]
+#
+# Dictionary id 0 means no dictionary. Dictionaries are never changed once stored,
+# so every payload stays decodable; new training adds a new id.
+
+import re
+import zlib
+from collections import Counter
+
+FORMAT_VERSION = 1
+DICTIONARY_SIZE = 32 * 1024   # deflate can't reach further back than its 32KB window
+NO_DICTIONARY = 0
+
+_WORD_RUN = re.compile(r'\S+(?:\s+\S+){0,3}')
+
+def train(samples, size=DICTIONARY_SIZE):
+    """Preset dictionary from sample texts - the most valuable phrases, best last
+
+    Phrases of one to four words are scored by how many bytes they would save
+    (occurrences x length). deflate finds matches nearest the end of the
+    dictionary most cheaply, so the highest scores go last.
+    """
+    counts = Counter()
+    for text in samples:
+        words = text.split()
+        for start in range(len(words)):
+            for end in range(start + 1, min(start + 5, len(words) + 1)):
+                counts[' '.join(words[start:end])] += 1
+
+    scored = sorted(((count * len(phrase), phrase) for phrase, count in counts.items() if count > 1), reverse=True)
+
+    chosen, used = [], 0
+    for _, phrase in scored:
+        encoded = phrase.encode('utf-8') + b' '
+        if used + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        used += len(encoded)
+
+    return b''.join(reversed(chosen))
+
+def compress(text, dictionary_id=NO_DICTIONARY, dictionary=None):
+    """Payload for extracted_text_z"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zdict=dictionary) if dictionary else \
+        zlib.compressobj(9, zlib.DEFLATED, -15, 9)
+    data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+    return bytes([FORMAT_VERSION]) + dictionary_id.to_bytes(4, 'big') + data
+
+def decompress(payload, load_dictionary):
+    """Text from a compress() payload - load_dictionary(id) returns the dictionary bytes"""
+    payload = bytes(payload)   # psycopg2 returns BYTEA as memoryview
+    if not payload or payload[0] != FORMAT_VERSION:
+        return ''
+
+    dictionary_id = int.from_bytes(payload[1:5], 'big')
+    if dictionary_id == NO_DICTIONARY:
+        decompressor = zlib.decompressobj(-15)
+    else:
+        decompressor = zlib.decompressobj(-15, zdict=load_dictionary(dictionary_id))
+    return (decompressor.decompress(payload[5:]) + decompressor.flush()).decode('utf-8')
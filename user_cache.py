@@ -0,0 +1,109 @@
+# user_cache.py - Short-TTL cache of users rows
+#
+# Nearly every authenticated page starts with get_user_data(), a SELECT * on the
+# users table. Rows are now cached per worker for USER_CACHE_TTL seconds and
+# dropped on every write that changes them (UserRepo writes and record_scan).
+#
+# Invalidation reaches every worker: each user hashes to a slot in a shared
+# version array, a write bumps the slot after it commits, and a cached row is only
+# served while its slot still has the version read before the row was loaded.
+# Like admission.py, the array is created at import, so with preload_app=True it
+# is shared by all workers on the host; without preload each worker only sees its
+# own writes and relies on the TTL.
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '30'))       # seconds a row may be served from cache
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '2000'))     # rows per worker, oldest evicted first
+VERSION_SLOTS = 4096
+
+_versions = multiprocessing.Array('Q', VERSION_SLOTS)   # writers bump under its lock; readers read the raw array
+_raw_versions = _versions.get_obj()
+
+class UserCache:
+    """Per-worker users-row cache, validated against the shared version slots"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # user_id -> (expires_at, version, row)
+
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._invalidated = 0   # entries found stale because another write bumped their slot
+
+    def get(self, user_id, load):
+        """Cached row for user_id, or load(user_id) on a miss - always returns a copy"""
+        slot = user_id % VERSION_SLOTS
+        version = _raw_versions[slot]   # read before loading - a write after this point invalidates
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires_at, entry_version, row = entry
+                if expires_at > now and entry_version == version:
+                    self._hits += 1
+                    return dict(row)
+                del self._entries[user_id]
+                if entry_version != version:
+                    self._invalidated += 1
+                else:
+                    self._expired += 1
+            self._misses += 1
+
+        row = load(user_id)
+        if row is None or self.ttl <= 0:
+            return row
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, version, row)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return dict(row)
+
+    def invalidate(self, user_id):
+        """Call after a write to the user's row has committed"""
+        slot = user_id % VERSION_SLOTS
+        with _versions.get_lock():
+            _raw_versions[slot] += 1
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'expired': self._expired,
+                'invalidated': self._invalidated,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else None,
+            }
+
+_cache = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+def get(user_id, load):
+    return _cache.get(user_id, load)
+
+def invalidate(user_id):
+    _cache.invalidate(user_id)
+
+def stats():
+    """Hit-rate metrics for this worker"""
+    return _cache.stats()